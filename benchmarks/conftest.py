@@ -0,0 +1,34 @@
+"""
+Command line options and fixtures shared by Eyes-on-Docs micro-benchmarks
+"""
+
+import os
+
+import pytest
+
+# Collectors build EnvVariables at import time, so the benchmarks need placeholder values to import them
+for _var in ("DB_HOST", "DB_PORT", "DB_CSV", "DB_USER", "DB_ORPH", "DB_ZUUL", "DB_PASSWORD", "GITEA_TOKEN",
+             "GITHUB_TOKEN", "GITHUB_FALLBACK_TOKEN"):
+    os.environ.setdefault(_var, "benchmark")
+# Storage writes go through FakeConnection, SQLite backend runs them as plain executemany() calls
+os.environ.setdefault("EOD_STORAGE", "sqlite")
+
+DEFAULT_SIZES = "1000,10000,100000"
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("eod", "Eyes-on-Docs benchmarks")
+    group.addoption("--bench-sizes", default=os.getenv("EOD_BENCH_SIZES", DEFAULT_SIZES),
+                    help="comma separated synthetic input sizes (default: %(default)s)")
+    group.addoption("--bench-rounds", type=int, default=3, help="rounds per benchmark (default: %(default)s)")
+
+
+def pytest_generate_tests(metafunc):
+    if "size" in metafunc.fixturenames:
+        sizes = [int(size) for size in metafunc.config.getoption("--bench-sizes").split(",") if size]
+        metafunc.parametrize("size", sizes, ids=[f"{size}rows" for size in sizes])
+
+
+@pytest.fixture
+def rounds(request):
+    return request.config.getoption("--bench-rounds")
@@ -0,0 +1,101 @@
+"""
+Synthetic inputs and DB-API stand-ins used by the micro-benchmarks
+"""
+
+import random
+from datetime import datetime, timedelta
+
+GITEA_URL = "https://gitea.eco.tsi-dev.otc-service.com"
+SERVICES_COUNT = 300
+
+
+class FakeCursor:
+    """DB-API cursor stand-in: swallows writes and serves preset rows, so only Python work is measured"""
+
+    def __init__(self, rows=None):
+        self.rows = rows or []
+        self.executed = 0
+
+    def execute(self, query, params=None):
+        self.executed += 1
+
+    def executemany(self, query, params_seq):
+        self.executed += 1
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, cursor=None):
+        self._cursor = cursor or FakeCursor()
+
+    def cursor(self, *args, **kwargs):
+        return self._cursor
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def service_names(count=SERVICES_COUNT):
+    return [f"service-{i}" for i in range(count)]
+
+
+def rtc_rows(count=SERVICES_COUNT):
+    """repo_title_category rows as returned by SELECT *: id, Repository, Title, Category, Squad, Env"""
+    return [(i, repo, f"Service {i} Title", "Compute", f"Squad {i % 12}", "public")
+            for i, repo in enumerate(service_names(count), start=1)]
+
+
+def auto_pr_body(parent_number, org="docs"):
+    return (f"This is an automatically created Pull Request for changes to {org}/doc-exports#{parent_number}.\n\n"
+            "Please do not edit it manually, since update to the original PR will overwrite local changes.")
+
+
+def proposalbot_rows(size, seed=42):
+    """Proposalbot PRs after titles and squads have been applied, in the order of AutoPR fields"""
+    rnd = random.Random(seed)
+    services = rtc_rows()
+    rows = []
+    for number in range(1, size + 1):
+        _, _, title, _, squad, _ = rnd.choice(services)
+        state = rnd.choice(("open", "open", "closed"))
+        rows.append((number, title, squad, f"{GITEA_URL}/docs/{title}/pulls/{number}", state, state == "closed",
+                     "Gitea"))
+    return rows
+
+
+def doc_exports_rows(size, seed=43):
+    """doc-exports PRs, in the order of ParentPR fields"""
+    rnd = random.Random(seed)
+    rows = []
+    for number in range(1, size + 1):
+        state = rnd.choice(("open", "closed", "closed"))
+        rows.append((number, f"Parent PR {number}", f"{GITEA_URL}/docs/doc-exports/pulls/{number}", state,
+                     state == "closed"))
+    rnd.shuffle(rows)
+    return rows
+
+
+def zuul_buildsets(size, orgs=("docs", "docs-swiss"), seed=47):
+    """Check buildsets as Zuul builds API returns them, newest first and all within EOD_ZUUL_DAYS"""
+    rnd = random.Random(seed)
+    repos = service_names()
+    results = ("SUCCESS", "FAILURE", "POST_FAILURE", "TIMED_OUT", "CANCELED", "DEQUEUED", "SKIPPED", None)
+    now = datetime.utcnow()
+    return [{"uuid": f"buildset-{number}", "project": f"{rnd.choice(orgs)}/{rnd.choice(repos)}",
+             "change": str(number // 2), "patchset": f"sha-{number // 2}", "pipeline": "check",
+             "result": rnd.choice(results), "event_timestamp": (now - timedelta(seconds=number)).isoformat()}
+            for number in range(size)]
@@ -0,0 +1,17 @@
+import random
+
+from benchmarks.datasets import GITEA_URL, service_names
+from scripts import eod_10_huawei
+
+
+def requested_prs(size, seed=47):
+    rnd = random.Random(seed)
+    repos = service_names()
+    return [(f"{GITEA_URL}/docs/{rnd.choice(repos)}/pulls/{number}", rnd.randint(4, 60), f"reviewer-{number % 40}")
+            for number in range(1, size + 1)]
+
+
+def test_parse_pr_url(benchmark, size, rounds):
+    prs = requested_prs(size)
+
+    benchmark.pedantic(eod_10_huawei.parse_pr_url, args=(prs, "docs"), rounds=rounds)
@@ -0,0 +1,32 @@
+import asyncio
+
+from benchmarks.datasets import GITEA_URL
+from scripts import eod_12_huawei_files_lines
+
+FILE_CONTENT = "\n".join(f"line {i} of a restructured text document" for i in range(200))
+
+
+class InMemoryClient:
+    """Serves the same file body for every URL, so only the counting and batching logic is measured"""
+
+    async def fetch_text_with_rate_limit(self, url):
+        return FILE_CONTENT
+
+
+def pr_files(size):
+    extensions = (".rst", ".rst", ".yaml", ".png")
+    return [{"repo": "service-1", "pr_number": number // 20,
+             "file_url": f"{GITEA_URL}/docs/service-1/raw/file-{number}{extensions[number % 4]}",
+             "is_text": extensions[number % 4] != ".png"} for number in range(size)]
+
+
+def test_count_lines_async(benchmark, size, rounds):
+    client = InMemoryClient()
+
+    def setup():
+        return (pr_files(size), client), {}
+
+    def count_lines(files, client):
+        return asyncio.run(eod_12_huawei_files_lines.count_lines_async(files, client))
+
+    benchmark.pedantic(count_lines, setup=setup, rounds=rounds)
@@ -0,0 +1,45 @@
+import random
+
+from benchmarks.datasets import FakeConnection, FakeCursor, doc_exports_rows, proposalbot_rows, rtc_rows, service_names
+from scripts import eod_2_gitea_info
+from scripts.eod_2_gitea_info import AutoPR, ParentPR
+
+
+def raw_auto_prs(size, seed=44):
+    """Proposalbot PRs as yielded by get_parent_pr: repository names, no squad yet"""
+    rnd = random.Random(seed)
+    repos = service_names()
+    return [AutoPR(number, rnd.choice(repos), None, f"https://gitea/docs/pulls/{number}", "open", False, "Gitea")
+            for number in range(1, size + 1)]
+
+
+def test_update_service_titles(benchmark, size, rounds):
+    auto_prs = raw_auto_prs(size)
+    cursor = FakeCursor(rtc_rows())
+
+    def update_service_titles():
+        titles, _ = eod_2_gitea_info.fetch_service_maps(cursor, "repo_title_category")
+        return list(eod_2_gitea_info.update_service_titles(auto_prs, titles))
+
+    benchmark.pedantic(update_service_titles, rounds=rounds)
+
+
+def test_add_squad_column(benchmark, size, rounds):
+    rtc = rtc_rows()
+    auto_prs = [pr._replace(service=rtc[pr.parent_pr % len(rtc)][2]) for pr in raw_auto_prs(size)]
+    cursor = FakeCursor(rtc)
+
+    def add_squad_column():
+        _, squads = eod_2_gitea_info.fetch_service_maps(cursor, "repo_title_category")
+        return list(eod_2_gitea_info.add_squad_column(auto_prs, squads))
+
+    benchmark.pedantic(add_squad_column, rounds=rounds)
+
+
+def test_match_parent_prs(benchmark, size, rounds):
+    auto_prs = [AutoPR(*row) for row in proposalbot_rows(size)]
+    doc_exports_prs = [ParentPR(*row) for row in doc_exports_rows(size)]
+    conn_csv, conn_orph = FakeConnection(), FakeConnection()
+
+    benchmark.pedantic(eod_2_gitea_info.match_parent_prs,
+                       args=(conn_csv, conn_orph, "open_prs", auto_prs, doc_exports_prs), rounds=rounds)
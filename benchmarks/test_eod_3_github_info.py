@@ -0,0 +1,26 @@
+import random
+
+from benchmarks.datasets import GITEA_URL, FakeConnection, service_names
+from scripts import eod_3_github_info
+
+
+def orphan_rows(size, seed=45):
+    rnd = random.Random(seed)
+    repos = service_names()
+    return [(number, f"{GITEA_URL}/docs/{rnd.choice(repos)}/pulls/{number}") for number in range(1, size + 1)]
+
+
+def github_auto_prs(size, seed=46):
+    rnd = random.Random(seed)
+    repos = service_names()
+    return [{"base": {"repo": {"name": rnd.choice(repos)}}, "state": rnd.choice(("open", "closed")),
+             "merged_at": None if number % 3 else "2024-01-01T00:00:00Z"} for number in range(1, size + 1)]
+
+
+def test_update_orphaned_prs(benchmark, size, rounds):
+    rows = orphan_rows(size)
+    auto_prs = github_auto_prs(size)
+    conn = FakeConnection()
+
+    benchmark.pedantic(eod_3_github_info.update_orphaned_prs,
+                       args=("docs", conn.cursor(), conn, rows, auto_prs, "open_prs"), rounds=rounds)
@@ -0,0 +1,26 @@
+import pytest
+
+from benchmarks.datasets import zuul_buildsets
+from scripts import eod_4_failed_zuul
+from tests.stand_ins import ZuulStandIn
+
+
+@pytest.fixture
+def zuul(monkeypatch):
+    def start(buildsets):
+        stand_in = ZuulStandIn(buildsets)
+        monkeypatch.setattr(eod_4_failed_zuul.env_vars, "zuul_url", stand_in.url)
+        monkeypatch.setattr(eod_4_failed_zuul.env_vars, "zuul_tenant", stand_in.tenant)
+        eod_4_failed_zuul.tenant_buildsets.clear()
+        return stand_in
+    yield start
+    eod_4_failed_zuul.tenant_buildsets.clear()
+
+
+def test_get_zuul_buildsets(benchmark, zuul, size, rounds):
+    with zuul(zuul_buildsets(size)):
+        def both_zones():
+            eod_4_failed_zuul.tenant_buildsets.clear()
+            return eod_4_failed_zuul.get_zuul_buildsets("docs"), eod_4_failed_zuul.get_zuul_buildsets("docs-swiss")
+
+        benchmark.pedantic(both_zones, rounds=rounds)
@@ -0,0 +1,15 @@
+import pytest
+
+from benchmarks.datasets import auto_pr_body
+from scripts import eod_2_gitea_info, eod_4_failed_zuul, eod_7_request_changes
+
+
+@pytest.mark.parametrize("module", [eod_2_gitea_info, eod_4_failed_zuul, eod_7_request_changes],
+                         ids=lambda module: module.__name__.rsplit(".", 1)[-1])
+def test_extract_number_from_body(benchmark, module, size, rounds):
+    bodies = [auto_pr_body(number) for number in range(1, size + 1)]
+
+    def extract_all():
+        return [module.extract_number_from_body(body) for body in bodies]
+
+    benchmark.pedantic(extract_all, rounds=rounds)
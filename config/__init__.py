@@ -1,10 +1,18 @@
 import logging
 
+from .api import TokenPool, create_github, create_session
 from .classes import Database, EnvVariables, Timer
+from .http_cache import HttpCache
+from .inventory import RepoInventory, parse_datetime
+from .mirrors import GitMirrors
+from .runs import RunRecorder, count_api_call, count_rows_written, stage
+from .storage import PostgresStorage, SQLiteStorage, Storage
 
 
 def setup_logging():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-__all__ = ['EnvVariables', 'Database', 'Timer']
+__all__ = ['EnvVariables', 'Database', 'Timer', 'Storage', 'PostgresStorage', 'SQLiteStorage',
+           'RunRecorder', 'stage', 'count_api_call', 'count_rows_written', 'create_session', 'create_github',
+           'TokenPool', 'HttpCache', 'RepoInventory', 'parse_datetime', 'GitMirrors']
@@ -0,0 +1,153 @@
+"""
+This script contains HTTP clients shared by collectors: every API call they make is counted in run history, GitHub
+calls are spread over a pool of tokens according to their rate limits and can be revalidated against HttpCache
+"""
+
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from github import Github
+from github.Requester import HTTPRequestsConnectionClass, HTTPSRequestsConnectionClass, Requester
+
+from .http_cache import ConditionalCacheAdapter
+from .runs import count_api_call
+
+# Requests a token is assumed to have per rate limit resource until GitHub reports its actual state: core API allows
+# 5000 per hour, search API 30 per minute (10 for code search), each counted separately
+GITHUB_RATE_LIMITS = {"core": 5000, "search": 30, "code_search": 10, "graphql": 5000}
+
+
+def count_response(response, *args, **kwargs):
+    count_api_call()
+
+
+def get_resource(url):
+    """Rate limit resource a GitHub API request is counted against, as reported in X-RateLimit-Resource"""
+    path = urlparse(url).path
+    if path.startswith("/search/code"):
+        return "code_search"
+    if path.startswith("/search/"):
+        return "search"
+    if path.startswith("/graphql"):
+        return "graphql"
+    return "core"
+
+
+class TokenPool:
+    """
+    GitHub tokens with their X-RateLimit-Remaining/X-RateLimit-Reset state per rate limit resource. Every request takes
+    the token with the most requests left for its resource, the pool waits only when all the tokens are exhausted for
+    it, until the earliest of them is reset
+    """
+
+    def __init__(self, tokens):
+        self.tokens = list(dict.fromkeys(token for token in tokens if token))
+        if not self.tokens:
+            raise Exception("Token pool: at least one GitHub token is required")
+        self.remaining: dict = {}  # (token, resource) -> requests left
+        self.reset: dict = {}  # (token, resource) -> epoch time the limit is reset at
+        self.lock = threading.Lock()
+
+    def get_remaining(self, token, resource, now):
+        key = (token, resource)
+        if key not in self.remaining or (self.remaining[key] <= 0 and self.reset[key] <= now):
+            self.remaining[key] = GITHUB_RATE_LIMITS.get(resource, GITHUB_RATE_LIMITS["core"])
+            self.reset[key] = 0.0
+        return self.remaining[key]
+
+    def acquire(self, resource="core"):
+        while True:
+            with self.lock:
+                now = time.time()
+                token = max(self.tokens, key=lambda t: self.get_remaining(t, resource, now))
+                if self.remaining[(token, resource)] > 0:
+                    self.remaining[(token, resource)] -= 1
+                    return token
+                wait = max(min(self.reset[(t, resource)] for t in self.tokens) - now, 0) + 1
+            logging.warning("Token pool: all %s GitHub tokens are rate limited for %s, waiting %.0f seconds",
+                            len(self.tokens), resource, wait)
+            time.sleep(wait)
+
+    def update(self, token, response):
+        """Take rate limit state of a token from response headers, returns True if request should be retried"""
+        headers = response.headers
+        resource = headers.get("X-RateLimit-Resource") or get_resource(response.request.url)
+        key = (token, resource)
+        with self.lock:
+            if token not in self.tokens:
+                return False
+            self.get_remaining(token, resource, time.time())
+            if "X-RateLimit-Remaining" in headers:
+                self.remaining[key] = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Reset" in headers:
+                self.reset[key] = float(headers["X-RateLimit-Reset"])
+            if response.status_code not in (403, 429):
+                return False
+            if "Retry-After" in headers:  # secondary rate limit
+                self.remaining[key] = 0
+                self.reset[key] = time.time() + int(headers["Retry-After"])
+                return True
+            return self.remaining[key] == 0
+
+
+class TokenPoolAuth(requests.auth.AuthBase):
+    """Authorizes each request with the healthiest token of the pool and retries rate limited ones with another"""
+
+    def __init__(self, token_pool):
+        self.token_pool = token_pool
+
+    def __call__(self, request):
+        request.headers["Authorization"] = f"token {self.token_pool.acquire(get_resource(request.url))}"
+        request.register_hook("response", self.handle_response)
+        return request
+
+    def handle_response(self, response, **kwargs):
+        token = response.request.headers["Authorization"].split(" ", 1)[1]
+        if not self.token_pool.update(token, response):
+            return response
+        logging.info("Token pool: GitHub rate limit hit, retrying %s with another token", response.url)
+        response.close()
+        request = response.request.copy()
+        request.headers["Authorization"] = f"token {self.token_pool.acquire(get_resource(request.url))}"
+        retry = response.connection.send(request, **kwargs)
+        retry.history.append(response)
+        retry.request = request
+        count_api_call()
+        return self.handle_response(retry, **kwargs)
+
+
+def create_session(token_pool=None, cache=None):
+    """Session for Gitea and raw GitHub calls, the latter should pass a token pool instead of Authorization header"""
+    session = requests.Session()
+    session.hooks["response"].append(count_response)
+    if token_pool is not None:
+        session.auth = TokenPoolAuth(token_pool)
+    if cache is not None:
+        session.mount("https://", ConditionalCacheAdapter(cache))
+    return session
+
+
+class PooledHTTPSConnection(HTTPSRequestsConnectionClass):
+    """Connection class PyGithub uses for api.github.com, sharing the token pool, cache and API call counting"""
+    token_pool = None
+    cache = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session.hooks["response"].append(count_response)
+        if self.token_pool is not None:
+            self.session.auth = TokenPoolAuth(self.token_pool)
+        if self.cache is not None:
+            self.adapter = ConditionalCacheAdapter(self.cache, max_retries=self.retry, pool_connections=self.pool_size,
+                                                   pool_maxsize=self.pool_size)
+            self.session.mount("https://", self.adapter)
+
+
+def create_github(token_pool, cache=None):
+    PooledHTTPSConnection.token_pool = token_pool
+    PooledHTTPSConnection.cache = cache
+    Requester.injectConnectionClasses(HTTPRequestsConnectionClass, PooledHTTPSConnection)
+    return Github(token_pool.tokens[0])
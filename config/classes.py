@@ -5,7 +5,7 @@ import logging
 import os
 import time
 
-import psycopg2
+from .storage import create_storage
 
 
 class EnvVariables:
@@ -13,6 +13,7 @@ class EnvVariables:
         "DB_HOST", "DB_PORT", "DB_CSV", "DB_USER", "DB_ORPH", "DB_ZUUL", "DB_PASSWORD", "GITEA_TOKEN", "GITHUB_TOKEN",
         "GITHUB_FALLBACK_TOKEN"
     ]
+    postgres_env_vars = ["DB_HOST", "DB_PORT", "DB_USER", "DB_PASSWORD"]
 
     def __init__(self):
         self.db_host = os.getenv("DB_HOST")
@@ -25,35 +26,28 @@ class EnvVariables:
         self.gitea_token = os.getenv("GITEA_TOKEN")
         self.github_token = os.getenv("GITHUB_TOKEN")
         self.github_fallback_token = os.getenv("GITHUB_FALLBACK_TOKEN")
+        self.github_tokens = [self.github_token, self.github_fallback_token]  # pooled by rate limits, see TokenPool
         self.api_key = os.getenv("OTC_BOT_API")
+        self.zuul_url = os.getenv("ZUUL_URL")  # optional, eod_4 takes failed checks from Zuul builds API if it's set
+        self.zuul_tenant = os.getenv("ZUUL_TENANT", "eco")
+        self.storage = os.getenv("EOD_STORAGE", "postgres")  # "sqlite" runs collectors without a Postgres server
+        self.sqlite_dir = os.getenv("EOD_SQLITE_DIR")  # SQLite databases are kept in memory if it's not set
         self.check_env_variables()
 
     def check_env_variables(self):
         for var in self.required_env_vars:
+            if self.storage != "postgres" and var in self.postgres_env_vars:
+                continue
             if os.getenv(var) is None:
                 raise Exception("Missing environment variable: %s" % var)
 
 
 class Database:
     def __init__(self, env):
-        self.db_host = env.db_host
-        self.db_port = env.db_port
-        self.db_user = env.db_user
-        self.db_password = env.db_password
+        self.storage = create_storage(env)
 
-    def connect_to_db(self, db_name):
-        logging.info("Connecting to Postgres (%s)...", db_name)
-        try:
-            return psycopg2.connect(
-                host=self.db_host,
-                port=self.db_port,
-                dbname=db_name,
-                user=self.db_user,
-                password=self.db_password
-            )
-        except psycopg2.Error as e:
-            logging.error("Connecting to Postgres: an error occurred while trying to connect: %s", e)
-            return None
+    def connect_to_db(self, db_name, shared=True):
+        return self.storage.connect(db_name, shared)
 
 
 class Timer:
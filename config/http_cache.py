@@ -0,0 +1,203 @@
+"""
+This script contains conditional-request cache for GitHub API: responses are stored with their ETag/Last-Modified, and
+repeated requests are revalidated with If-None-Match/If-Modified-Since. GitHub doesn't count 304 Not Modified against
+rate limit, so unchanged payloads cost neither quota nor download
+"""
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+from requests.adapters import HTTPAdapter
+
+HTTP_CACHE_TABLE = "http_cache"
+HTTP_CACHE_COLUMNS = {
+    "URL": "TEXT",
+    "ETag": "VARCHAR(255)",
+    "Last modified": "VARCHAR(255)",
+    "Headers": "TEXT",
+    "Body": "TEXT",
+    "Size": "INT",
+    "Used at": "TIMESTAMP"
+}
+CACHED_HEADERS = ("Content-Type", "Link", "ETag", "Last-Modified")
+
+
+class HttpCache:
+    """
+    URL -> validators and body, kept in http_cache table. Validators and sizes are loaded once per connection, so the
+    table is read only for revalidated bodies, and last use times are written in one batch on flush() or close().
+    Least recently used entries are evicted when total size of bodies exceeds EOD_HTTP_CACHE_MB (256 by default)
+    """
+    shared_caches: dict = {}
+
+    @classmethod
+    def shared(cls, database, db_name):
+        """One cache per database in a process: collectors run by main.py use the same one, closing it after a run"""
+        if db_name not in cls.shared_caches:
+            cls.shared_caches[db_name] = cls(database, db_name)
+        return cls.shared_caches[db_name]
+
+    def __init__(self, database, db_name, max_size_mb=None):
+        self.database = database
+        self.db_name = db_name
+        self.max_size = int(max_size_mb or os.getenv("EOD_HTTP_CACHE_MB", "256")) * 1024 * 1024
+        self.conn = None
+        self.entries: dict = {}  # URL -> (ETag, Last modified, Size)
+        self.touched: set = set()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn is None:
+            # own connection: pages are fetched in threads, a commit here mustn't commit a half-written batch of a
+            # collector sharing the connection under SQLite
+            self.conn = self.database.connect_to_db(self.db_name, shared=False)
+            self.database.storage.create_table(self.conn, HTTP_CACHE_TABLE, HTTP_CACHE_COLUMNS, unique=["URL"])
+            self.load()
+        return self.conn
+
+    def load(self):
+        rows = self.database.storage.query(
+            self.conn, f'SELECT "URL", "ETag", "Last modified", "Size" FROM {HTTP_CACHE_TABLE};'
+        )
+        self.entries = {url: (etag, last_modified, size) for url, etag, last_modified, size in rows}
+        self.size = sum(size for _, _, size in self.entries.values())
+
+    def validators(self, url):
+        """(ETag, Last modified) of a cached response or None, without a database query"""
+        with self.lock:
+            try:
+                self.connect()
+            except Exception as e:
+                logging.error("HTTP cache: an error occurred while loading %s: %s", HTTP_CACHE_TABLE, e)
+                self.conn = None
+                return None
+        entry = self.entries.get(url)
+        return entry[:2] if entry else None
+
+    def get(self, url):
+        """Headers and body of a revalidated response, its last use time is written on the next flush"""
+        with self.lock:
+            try:
+                rows = self.database.storage.query(
+                    self.connect(), f'SELECT "Headers", "Body" FROM {HTTP_CACHE_TABLE} WHERE "URL" = %s;', (url,)
+                )
+            except Exception as e:
+                logging.error("HTTP cache: an error occurred while reading %s: %s", url, e)
+                self.conn.rollback()
+                return None
+            if not rows:
+                return None
+            self.touched.add(url)
+        headers, body = rows[0]
+        return {"headers": json.loads(headers), "body": body}
+
+    def write_touched(self):
+        if not self.touched:
+            return
+        cur = self.conn.cursor()
+        used_at = datetime.utcnow()
+        cur.executemany(f'UPDATE {HTTP_CACHE_TABLE} SET "Used at" = %s WHERE "URL" = %s;',
+                        [(used_at, url) for url in self.touched])
+        self.conn.commit()
+        self.touched.clear()
+
+    def flush(self):
+        with self.lock:
+            if self.conn is None:
+                return
+            try:
+                self.write_touched()
+            except Exception as e:
+                logging.error("HTTP cache: an error occurred while updating last use times: %s", e)
+                self.conn.rollback()
+
+    def close(self):
+        """Flush last use times and release the connection, the next request connects again"""
+        self.flush()
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def put(self, url, response):
+        headers = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+        body = response.text
+        with self.lock:
+            try:
+                self.database.storage.upsert(
+                    self.connect(), HTTP_CACHE_TABLE, list(HTTP_CACHE_COLUMNS),
+                    [(url, headers.get("ETag"), headers.get("Last-Modified"), json.dumps(headers), body, len(body),
+                      datetime.utcnow())],
+                    ["URL"]
+                )
+                old = self.entries.get(url)
+                self.size += len(body) - (old[2] if old else 0)  # a replaced entry no longer counts
+                self.entries[url] = (headers.get("ETag"), headers.get("Last-Modified"), len(body))
+                self.touched.discard(url)
+                if self.size > self.max_size:
+                    self.evict()
+            except Exception as e:
+                logging.error("HTTP cache: an error occurred while storing %s: %s", url, e)
+                self.conn.rollback()
+
+    def evict(self):
+        """Drop least recently used entries down to 90% of the limit, leaving room for a while"""
+        self.write_touched()
+        cur = self.conn.cursor()
+        cur.execute(
+            f"""DELETE FROM {HTTP_CACHE_TABLE} WHERE "URL" IN (
+                    SELECT "URL" FROM (
+                        SELECT "URL", SUM("Size") OVER (ORDER BY "Used at" DESC, "URL") AS total
+                        FROM {HTTP_CACHE_TABLE}
+                    ) AS sized
+                    WHERE total > %s
+                );""",
+            (int(self.max_size * 0.9),)
+        )
+        self.conn.commit()
+        self.load()
+        logging.info("HTTP cache: evicted %s entries, %s bytes left", cur.rowcount, self.size)
+
+
+class ConditionalCacheAdapter(HTTPAdapter):
+    """Transport adapter revalidating GET requests against HttpCache and serving cached bodies on 304"""
+
+    def __init__(self, cache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != "GET" or kwargs.get("stream"):
+            return super().send(request, **kwargs)
+
+        validators = self.cache.validators(request.url)
+        if validators:
+            etag, last_modified = validators
+            if etag:
+                request.headers["If-None-Match"] = etag
+            if last_modified:
+                request.headers["If-Modified-Since"] = last_modified
+
+        response = super().send(request, **kwargs)
+
+        if validators and response.status_code == 304:
+            entry = self.cache.get(request.url)
+            if entry:
+                response.status_code = 200
+                response.reason = "OK"
+                response.headers.update(entry["headers"])
+                response._content = entry["body"].encode("utf-8")
+                response.encoding = "utf-8"
+                return response
+            request.headers.pop("If-None-Match", None)  # evicted meanwhile, ask for the body
+            request.headers.pop("If-Modified-Since", None)
+            response = super().send(request, **kwargs)
+
+        if response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers) \
+                and response.headers.get("Content-Type", "").startswith("application/json"):
+            self.cache.put(request.url, response)
+        return response
@@ -0,0 +1,160 @@
+"""
+This script contains shared repository inventory: each Gitea and Github org is listed once per EOD_INVENTORY_TTL and
+stored in repo_inventory table, so collectors read repositories from it instead of crawling the orgs on their own
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+import requests
+
+from .api import create_session
+
+GITEA_API_ENDPOINT = "https://gitea.eco.tsi-dev.otc-service.com/api/v1"
+GITHUB_API_ENDPOINT = "https://api.github.com"
+INVENTORY_TABLE = "repo_inventory"
+INVENTORY_COLUMNS = {
+    "Platform": "VARCHAR(255)",
+    "Org": "VARCHAR(255)",
+    "Name": "VARCHAR(255)",
+    "Archived": "BOOLEAN",
+    "Empty": "BOOLEAN",
+    "Default branch": "VARCHAR(255)",
+    "Updated at": "TIMESTAMP",
+    "Pushed at": "TIMESTAMP",
+    "Open issues": "INT",
+    "Open PRs": "INT",
+    "Fetched at": "TIMESTAMP"
+}
+MAX_PAGES = 50
+
+
+class Repo(NamedTuple):
+    name: str
+    archived: bool
+    empty: bool
+    default_branch: Optional[str]
+    updated_at: Optional[datetime]
+    pushed_at: Optional[datetime]
+    open_issues: Optional[int]
+    open_prs: Optional[int]  # not known for Github repos, its open_issues counter includes PRs
+
+
+def parse_datetime(value):
+    """API timestamps, and SQLite ones which are kept as text, to naive UTC datetime"""
+    if not value or isinstance(value, datetime):
+        return value
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def gitea_repo(data):
+    return Repo(data["name"], data["archived"], data.get("empty", False), data.get("default_branch"),
+                parse_datetime(data.get("updated_at")), None, data.get("open_issues_count"),
+                data.get("open_pr_counter"))
+
+
+def github_repo(data):
+    return Repo(data["name"], data["archived"], data.get("size", 0) == 0, data.get("default_branch"),
+                parse_datetime(data.get("updated_at")), parse_datetime(data.get("pushed_at")),
+                data.get("open_issues_count"), None)
+
+
+class RepoInventory:
+    """
+    Repositories of an org are crawled when there is no inventory of it younger than EOD_INVENTORY_TTL minutes (60 by
+    default), otherwise they are read from the table. Archived repositories are kept, collectors filter them themselves
+    """
+
+    def __init__(self, database, env, token_pool=None, cache=None):
+        self.database = database
+        self.db_name = env.db_csv
+        self.gitea_token = env.gitea_token
+        self.ttl = timedelta(minutes=int(os.getenv("EOD_INVENTORY_TTL", "60")))
+        self.gitea_session = create_session()
+        self.github_session = create_session(token_pool, cache)
+        self.repos: dict = {}
+        self.lock = threading.Lock()
+
+    def gitea_repos(self, org):
+        return self.get_repos("gitea", org)
+
+    def github_repos(self, org):
+        return self.get_repos("github", org)
+
+    def get_repos(self, platform, org):
+        with self.lock:
+            if (platform, org) not in self.repos:
+                conn = self.database.connect_to_db(self.db_name)
+                self.database.storage.create_table(conn, INVENTORY_TABLE, INVENTORY_COLUMNS,
+                                                   unique=["Platform", "Org", "Name"])
+                repos = self.load(conn, platform, org)
+                if repos is None:
+                    repos, complete = self.crawl(platform, org)
+                    if complete:
+                        self.save(conn, platform, org, repos)
+                conn.close()
+                self.repos[(platform, org)] = repos
+            return self.repos[(platform, org)]
+
+    def load(self, conn, platform, org):
+        fetched_at = self.database.storage.query(
+            conn, f'SELECT MAX("Fetched at") FROM {INVENTORY_TABLE} WHERE "Platform" = %s AND "Org" = %s;',
+            (platform, org)
+        )[0][0]
+        fetched_at = parse_datetime(fetched_at)
+        if fetched_at is None or datetime.utcnow() - fetched_at > self.ttl:
+            return None
+        rows = self.database.storage.query(
+            conn,
+            f"""SELECT "Name", "Archived", "Empty", "Default branch", "Updated at", "Pushed at", "Open issues",
+                "Open PRs" FROM {INVENTORY_TABLE} WHERE "Platform" = %s AND "Org" = %s ORDER BY "Name";""",
+            (platform, org)
+        )
+        logging.info("Inventory: %s repos of %s/%s are fetched at %s", len(rows), platform, org, fetched_at)
+        return [Repo(row[0], bool(row[1]), bool(row[2]), row[3], parse_datetime(row[4]), parse_datetime(row[5]), row[6],
+                     row[7]) for row in rows]
+
+    def crawl(self, platform, org):
+        """Returns repos and whether all of them were listed, partial listing isn't stored"""
+        logging.info("Inventory: gathering repos of %s/%s...", platform, org)
+        if platform == "gitea":
+            url = f"{GITEA_API_ENDPOINT}/orgs/{org}/repos"
+            params = {"limit": 50, "token": self.gitea_token}
+            session, parse = self.gitea_session, gitea_repo
+        else:
+            url = f"{GITHUB_API_ENDPOINT}/orgs/{org}/repos"
+            params = {"per_page": 100}
+            session, parse = self.github_session, github_repo
+
+        repos = []
+        for page in range(1, MAX_PAGES + 1):
+            try:
+                repos_resp = session.get(url, params=dict(params, page=page), timeout=30)
+                repos_resp.raise_for_status()
+                repos += [parse(repo) for repo in repos_resp.json()]
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logging.error("Inventory: an error occurred while trying to get repos of %s: %s", org, e)
+                return repos, False
+            if "next" not in repos_resp.links:
+                break
+        else:
+            logging.warning("Inventory: reached maximum page limit for %s", org)
+        logging.info("Inventory: %s repos of %s/%s have been gathered", len(repos), platform, org)
+        return repos, True
+
+    def save(self, conn, platform, org, repos):
+        fetched_at = datetime.utcnow()
+        try:
+            cur = conn.cursor()
+            cur.execute(f'DELETE FROM {INVENTORY_TABLE} WHERE "Platform" = %s AND "Org" = %s;', (platform, org))
+            self.database.storage.bulk_insert(conn, INVENTORY_TABLE, list(INVENTORY_COLUMNS),
+                                              [(platform, org) + tuple(repo) + (fetched_at,) for repo in repos])
+        except Exception as e:
+            logging.error("Inventory: an error occurred while saving repos of %s: %s", org, e)
+            conn.rollback()
@@ -0,0 +1,191 @@
+"""
+This script contains run history recording: every collector run is stored in eod_runs table with its stages, API calls,
+rows written and peak memory, and compared with a rolling baseline of previous runs to catch performance regressions
+"""
+
+import json
+import logging
+import os
+import resource
+import statistics
+import threading
+import time
+import tracemalloc
+from contextlib import closing, contextmanager
+from datetime import datetime
+from typing import Optional
+
+import git
+
+RUNS_TABLE = "eod_runs"
+RUNS_COLUMNS = {
+    "Script": "VARCHAR(255)",
+    "Zone": "VARCHAR(255)",
+    "Status": "VARCHAR(255)",
+    "Started at": "TIMESTAMP",
+    "Duration": "DOUBLE PRECISION",
+    "Stages": "TEXT",
+    "API calls": "INT",
+    "Rows written": "INT",
+    "Peak memory MB": "DOUBLE PRECISION",
+    "Git SHA": "VARCHAR(64)",
+    "Baseline duration": "DOUBLE PRECISION",
+    "Baseline API calls": "INT",
+    "Slower": "BOOLEAN",
+    "More expensive": "BOOLEAN"
+}
+BASELINE_RUNS = 10
+
+_current_run: Optional["Run"] = None
+
+
+def get_git_sha():
+    sha = os.getenv("GIT_SHA")
+    if sha:
+        return sha
+    try:
+        return git.Repo(os.path.dirname(__file__), search_parent_directories=True).head.commit.hexsha
+    except Exception as e:
+        logging.debug("Git SHA: an error occurred while reading repository HEAD: %s", e)
+        return None
+
+
+class Run:
+    def __init__(self, script, zone):
+        self.script = script
+        self.zone = zone
+        self.status = "running"
+        self.started_at = datetime.utcnow()
+        self.start_time = time.monotonic()
+        self.duration = None
+        self.stages: dict = {}
+        self.api_calls = 0
+        self.rows_written = 0
+        self.peak_memory = None
+        self.lock = threading.Lock()
+        # tracemalloc slows allocation-heavy code down several times, which would distort Duration, so by default peak
+        # is a process-wide ru_maxrss high-water mark, and EOD_TRACE_MEMORY traces memory of every run on its own
+        self.traces_memory = bool(os.getenv("EOD_TRACE_MEMORY")) and not tracemalloc.is_tracing()
+        if self.traces_memory:
+            tracemalloc.start()
+
+    def add_stage(self, name, duration):
+        with self.lock:
+            self.stages[name] = round(self.stages.get(name, 0) + duration, 3)
+
+    def add_api_call(self):
+        with self.lock:
+            self.api_calls += 1
+
+    def add_rows_written(self, rows):
+        with self.lock:
+            self.rows_written += rows
+
+    def finish(self, status):
+        self.status = status
+        self.duration = round(time.monotonic() - self.start_time, 3)
+        if self.traces_memory:
+            self.peak_memory = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+            tracemalloc.stop()
+        else:
+            self.peak_memory = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)  # KB on Linux
+
+
+@contextmanager
+def stage(name):
+    """Time a part of a collector run, does nothing outside of RunRecorder.zone()"""
+    run = _current_run
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        if run is not None:
+            run.add_stage(name, time.monotonic() - start_time)
+
+
+def count_api_call():
+    run = _current_run
+    if run is not None:
+        run.add_api_call()
+
+
+def count_rows_written(rows):
+    """Add rows a collector has written to or deleted from its output tables, returns rows for chaining"""
+    run = _current_run
+    if run is not None and rows:
+        run.add_rows_written(rows)
+    return rows
+
+
+class RunRecorder:
+    """
+    Records a run per zone. Run is flagged when it's more than EOD_REGRESSION_THRESHOLD percent (25 by default) slower
+    or makes more API calls than a median of the last successful runs of the same script and zone
+    """
+
+    def __init__(self, script, database, db_name):
+        self.script = script
+        self.database = database
+        self.db_name = db_name
+        self.threshold = float(os.getenv("EOD_REGRESSION_THRESHOLD", "25"))
+        self.git_sha = get_git_sha()
+
+    @contextmanager
+    def zone(self, zone):
+        global _current_run
+        run = Run(self.script, zone)
+        _current_run = run
+        status = "failed"
+        try:
+            yield run
+            status = "success"
+        finally:
+            _current_run = None
+            run.finish(status)
+            self.save(run)
+
+    def get_baseline(self, conn, zone):
+        rows = self.database.storage.query(
+            conn,
+            f"""SELECT "Duration", "API calls" FROM {RUNS_TABLE}
+                WHERE "Script" = %s AND "Zone" = %s AND "Status" = 'success'
+                ORDER BY "Started at" DESC LIMIT %s;""",
+            (self.script, zone, BASELINE_RUNS)
+        )
+        if not rows:
+            return None, None
+        return statistics.median(row[0] for row in rows), int(statistics.median(row[1] for row in rows))
+
+    def exceeds(self, value, baseline):
+        return bool(baseline) and value > baseline * (1 + self.threshold / 100)
+
+    def save(self, run):
+        conn = self.database.connect_to_db(self.db_name)
+        if conn is None:
+            return
+        with closing(conn):
+            self.save_run(conn, run)
+
+    def save_run(self, conn, run):
+        try:
+            storage = self.database.storage
+            storage.create_table(conn, RUNS_TABLE, RUNS_COLUMNS)
+            baseline_duration, baseline_api_calls = self.get_baseline(conn, run.zone)
+            slower = self.exceeds(run.duration, baseline_duration)
+            more_expensive = self.exceeds(run.api_calls, baseline_api_calls)
+            storage.bulk_insert(conn, RUNS_TABLE, list(RUNS_COLUMNS), [(
+                run.script, run.zone, run.status, run.started_at, run.duration, json.dumps(run.stages),
+                run.api_calls, run.rows_written, run.peak_memory, self.git_sha, baseline_duration,
+                baseline_api_calls, slower, more_expensive
+            )])
+        except Exception as e:
+            logging.error("Run history: an error occurred while saving %s run: %s", run.script, e)
+            conn.rollback()
+            return
+
+        logging.info("%s (%s) %s in %.1fs: %s API calls, %s rows written, stages: %s", run.script, run.zone,
+                     run.status, run.duration, run.api_calls, run.rows_written, run.stages)
+        if slower or more_expensive:
+            logging.warning("Performance regression in %s (%s): %.1fs and %s API calls against baseline of %.1fs and "
+                            "%s API calls", run.script, run.zone, run.duration, run.api_calls, baseline_duration,
+                            baseline_api_calls)
@@ -0,0 +1,428 @@
+"""
+This script contains storage backends: Postgres for production runs and embedded SQLite for local runs, benchmarks and
+profiling without a Postgres server
+"""
+
+import hashlib
+import io
+import logging
+import os
+import re
+import sqlite3
+
+import psycopg2
+import psycopg2.extras
+
+BATCH_SIZE = 500
+OTHER_SQUAD_REPOS = ("doc-exports", "docs_on_docs", "docsportal")
+
+
+def quote_columns(columns):
+    return ", ".join(f'"{column}"' for column in columns)
+
+
+def upsert_clause(columns, key_columns):
+    updates = ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in columns if column not in key_columns)
+    return f"ON CONFLICT ({quote_columns(key_columns)}) DO UPDATE SET {updates}"
+
+
+def unique_rows(columns, rows, key_columns):
+    """Last row wins for a key: a single INSERT ... ON CONFLICT statement can't update the same row twice"""
+    key_indexes = [list(columns).index(column) for column in key_columns]
+    return list({tuple(row[i] for i in key_indexes): row for row in rows}.values())
+
+
+class Storage:
+    """
+    Operations collectors need from a database. Every method takes a connection returned by connect(), so collectors
+    can mix them with their own queries, SQL dialect differences stay inside the backends.
+    """
+    name = ""
+    serial_type = ""
+    Error = (psycopg2.Error, sqlite3.Error)  # backends narrow it down to the errors of their driver
+
+    def connect(self, db_name, shared=True):
+        """shared=False asks for a connection nothing else writes through, for a writer running in another thread"""
+        raise NotImplementedError
+
+    def dict_cursor(self, conn):
+        raise NotImplementedError
+
+    def create_table_sql(self, table_name, columns, unique=None):
+        column_defs = [f"id {self.serial_type}"] + [f'"{column}" {ctype}' for column, ctype in columns.items()]
+        if unique:
+            column_defs.append(f"UNIQUE({quote_columns(unique)})")
+        return f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(column_defs)});"
+
+    def create_table(self, conn, table_name, columns, unique=None):
+        cur = conn.cursor()
+        cur.execute(self.create_table_sql(table_name, columns, unique))
+        conn.commit()
+
+    def add_columns(self, conn, table_name, columns):
+        raise NotImplementedError
+
+    def table_exists(self, conn, table_name):
+        cur = conn.cursor()
+        try:
+            cur.execute(f"SELECT 1 FROM {table_name} LIMIT 1;")
+            return True
+        except Exception:
+            conn.rollback()
+            return False
+
+    def drop_tables(self, conn, *table_names):
+        cur = conn.cursor()
+        for table_name in table_names:
+            cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+        conn.commit()
+
+    def days_since(self, column):
+        """SQL expression of whole days passed since a TIMESTAMP column, for values computed at query time"""
+        raise NotImplementedError
+
+    def create_view(self, conn, view_name, select_sql):
+        """(Re)create a view, a table of the same name left by an older version of a collector is dropped"""
+        raise NotImplementedError
+
+    def bulk_insert(self, conn, table_name, columns, rows):
+        raise NotImplementedError
+
+    def upsert(self, conn, table_name, columns, rows, key_columns):
+        """Insert rows or update the existing ones by key_columns, which should be UNIQUE in the table"""
+        raise NotImplementedError
+
+    def enrich(self, conn, table_name, rtc_table, key_column="Service Name", other_repos=OTHER_SQUAD_REPOS):
+        """Replace repository names with service titles and set squads from RTC table in one statement"""
+        cur = conn.cursor()
+        cur.execute(
+            f"""UPDATE {table_name}
+                SET "{key_column}" = rtc."Title", "Squad" = rtc."Squad"
+                FROM {rtc_table} AS rtc
+                WHERE {table_name}."{key_column}" = rtc."Repository";"""
+        )
+        if other_repos:
+            cur.execute(
+                f"""UPDATE {table_name}
+                    SET "Squad" = 'Other'
+                    WHERE "{key_column}" IN ({', '.join(['%s'] * len(other_repos))});""",
+                tuple(other_repos)
+            )
+        conn.commit()
+
+    def publish(self, conn, staging_table, table_name):
+        """Atomically replace table with its freshly built staging copy, so readers never see a half-built table"""
+        cur = conn.cursor()
+        try:
+            cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+            cur.execute(f"ALTER TABLE {staging_table} RENAME TO {table_name};")
+            conn.commit()
+        except Exception as e:
+            logging.error("Publish: an error occurred while replacing %s with %s: %s", table_name, staging_table, e)
+            conn.rollback()
+
+    def query(self, conn, sql, params=None):
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+    def checksum(self, conn, table_name):
+        """Content checksum of a table, equal for equal tables in any database of the same backend"""
+        md5 = hashlib.md5()
+        cur = conn.cursor()
+        cur.execute(f"SELECT * FROM {table_name} ORDER BY id;")
+        for row in cur:
+            md5.update(repr(tuple(row)).encode("utf-8"))
+        return md5.hexdigest()
+
+    def copy_table(self, source_conn, target_conn, table_name, columns):
+        raise NotImplementedError
+
+    def replicate(self, source_conn, target_conns, table_name, columns):
+        """
+        Copy table created with columns to other databases, keeping its column types. Targets which already have the
+        same content are skipped, returns the number of targets copied to
+        """
+        checksum = self.checksum(source_conn, table_name)
+        copied = 0
+        for target_conn in target_conns:
+            if self.table_exists(target_conn, table_name) and self.checksum(target_conn, table_name) == checksum:
+                continue
+            try:
+                self.copy_table(source_conn, target_conn, table_name, columns)
+                copied += 1
+            except Exception as e:
+                logging.error("Replicate: an error occurred while copying %s: %s", table_name, e)
+                target_conn.rollback()
+        logging.info("%s has been copied to %s of %s databases", table_name, copied, len(target_conns))
+        return copied
+
+
+class PostgresStorage(Storage):
+    name = "postgres"
+    serial_type = "SERIAL PRIMARY KEY"
+    Error = psycopg2.Error
+
+    def __init__(self, env):
+        self.db_host = env.db_host
+        self.db_port = env.db_port
+        self.db_user = env.db_user
+        self.db_password = env.db_password
+
+    def connect(self, db_name, shared=True):
+        logging.info("Connecting to Postgres (%s)...", db_name)
+        try:
+            return psycopg2.connect(
+                host=self.db_host,
+                port=self.db_port,
+                dbname=db_name,
+                user=self.db_user,
+                password=self.db_password
+            )
+        except psycopg2.Error as e:
+            logging.error("Connecting to Postgres: an error occurred while trying to connect: %s", e)
+            return None
+
+    def dict_cursor(self, conn):
+        return conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+    def days_since(self, column):
+        return f"EXTRACT(DAY FROM (NOW() AT TIME ZONE 'UTC') - \"{column}\")::INT"
+
+    def create_view(self, conn, view_name, select_sql):
+        cur = conn.cursor()
+        cur.execute("SELECT table_type FROM information_schema.tables WHERE table_schema = current_schema() AND "
+                    "table_name = %s;", (view_name,))
+        row = cur.fetchone()
+        if row:  # CREATE OR REPLACE VIEW can't change columns of a view, nor replace a table
+            cur.execute(f"DROP {'TABLE' if row[0] == 'BASE TABLE' else 'VIEW'} {view_name};")
+        cur.execute(f"CREATE VIEW {view_name} AS {select_sql};")
+        conn.commit()
+
+    def add_columns(self, conn, table_name, columns):
+        cur = conn.cursor()
+        additions = ", ".join(f'ADD COLUMN IF NOT EXISTS "{column}" {ctype}' for column, ctype in columns.items())
+        cur.execute(f"ALTER TABLE {table_name} {additions};")
+        conn.commit()
+
+    def bulk_insert(self, conn, table_name, columns, rows):
+        rows = list(rows)
+        if not rows:
+            return 0
+        cur = conn.cursor()
+        quoted_columns = quote_columns(columns)
+        psycopg2.extras.execute_values(cur, f"INSERT INTO {table_name} ({quoted_columns}) VALUES %s", rows,
+                                       page_size=BATCH_SIZE)
+        conn.commit()
+        return len(rows)
+
+    def checksum(self, conn, table_name):
+        cur = conn.cursor()
+        cur.execute(f"SELECT md5(COALESCE(string_agg(t::text, E'\\n' ORDER BY id), '')) FROM {table_name} AS t;")
+        return cur.fetchone()[0]
+
+    def copy_table(self, source_conn, target_conn, table_name, columns):
+        """Stream the table with COPY, target table is replaced in a single transaction"""
+        quoted_columns = "id, " + quote_columns(columns)
+        buffer = io.StringIO()
+        source_conn.cursor().copy_expert(f"COPY {table_name} ({quoted_columns}) TO STDOUT", buffer)
+        buffer.seek(0)
+        cur = target_conn.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+        cur.execute(self.create_table_sql(table_name, columns))
+        cur.copy_expert(f"COPY {table_name} ({quoted_columns}) FROM STDIN", buffer)
+        # COPY doesn't advance the id sequence, later INSERTs would collide with the copied ids
+        cur.execute(f"SELECT setval(pg_get_serial_sequence('{table_name}', 'id'), COALESCE(MAX(id), 1), "
+                    f"MAX(id) IS NOT NULL) FROM {table_name};")
+        target_conn.commit()
+
+    def upsert(self, conn, table_name, columns, rows, key_columns):
+        rows = unique_rows(columns, rows, key_columns)
+        if not rows:
+            return 0
+        cur = conn.cursor()
+        psycopg2.extras.execute_values(
+            cur, f"INSERT INTO {table_name} ({quote_columns(columns)}) VALUES %s {upsert_clause(columns, key_columns)}",
+            rows, page_size=BATCH_SIZE
+        )
+        conn.commit()
+        return len(rows)
+
+
+class SQLiteCursor:
+    """DB-API cursor which accepts the Postgres flavour of SQL used across the collectors"""
+
+    drop_many_pattern = re.compile(r"^\s*DROP TABLE IF EXISTS\s+([\w\s,]+?)\s*;?\s*$", re.IGNORECASE)
+    translations = [
+        (re.compile(r"SERIAL PRIMARY KEY", re.IGNORECASE), "INTEGER PRIMARY KEY AUTOINCREMENT"),
+        (re.compile(r"\bpublic\."), ""),
+        (re.compile(r"(?<!%)%s"), "?"),
+        (re.compile(r"%%"), "%"),
+    ]
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    @classmethod
+    def translate(cls, sql):
+        for pattern, replacement in cls.translations:
+            sql = pattern.sub(replacement, sql)
+        return sql
+
+    def execute(self, sql, params=None):
+        drop_many = self.drop_many_pattern.match(sql)
+        if drop_many:
+            for table_name in drop_many.group(1).split(","):
+                self._cursor.execute(f"DROP TABLE IF EXISTS {table_name.strip()};")
+            return self
+        self._cursor.execute(self.translate(sql), tuple(params) if params else ())
+        return self
+
+    def executemany(self, sql, params_seq):
+        self._cursor.executemany(self.translate(sql), params_seq)
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    """
+    Shared connection per database: collectors open several connections to the same database in one process, and
+    SQLite would lock them against each other, so they all use one underlying connection, and close() is a no-op
+    unless the connection is owned
+    """
+
+    def __init__(self, connection, owned=False):
+        self._connection = connection
+        self.owned = owned
+
+    def cursor(self, cursor_factory=None):
+        cursor = self._connection.cursor()
+        if cursor_factory is not None:
+            cursor.row_factory = sqlite3.Row
+        return SQLiteCursor(cursor)
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def close(self):
+        if self.owned:
+            self._connection.close()
+
+
+class SQLiteStorage(Storage):
+    """Database files are kept in EOD_SQLITE_DIR, or in memory for the lifetime of the process if it is not set"""
+    name = "sqlite"
+    serial_type = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    Error = sqlite3.Error
+
+    def __init__(self, env):
+        self.directory = env.sqlite_dir
+        self.connections: dict = {}
+
+    def path(self, db_name):
+        if not self.directory:
+            return ":memory:"
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f"{db_name}.sqlite3")
+
+    def connect(self, db_name, shared=True):
+        """Connection of its own is a separate database if they are kept in memory"""
+        if not shared:
+            logging.info("Connecting to SQLite (%s, %s, own connection)...", db_name, self.path(db_name))
+            return SQLiteConnection(sqlite3.connect(self.path(db_name), check_same_thread=False), owned=True)
+        if db_name not in self.connections:
+            logging.info("Connecting to SQLite (%s, %s)...", db_name, self.path(db_name))
+            self.connections[db_name] = sqlite3.connect(self.path(db_name), check_same_thread=False)
+        return SQLiteConnection(self.connections[db_name])
+
+    def dict_cursor(self, conn):
+        return conn.cursor(cursor_factory=sqlite3.Row)
+
+    def add_columns(self, conn, table_name, columns):
+        cur = conn.cursor()
+        cur.execute(f"PRAGMA table_info({table_name});")
+        existing = {row[1] for row in cur.fetchall()}
+        for column, ctype in columns.items():
+            if column not in existing:
+                cur.execute(f'ALTER TABLE {table_name} ADD COLUMN "{column}" {ctype};')
+        conn.commit()
+
+    def days_since(self, column):
+        return f"CAST(julianday('now') - julianday(\"{column}\") AS INTEGER)"
+
+    def create_view(self, conn, view_name, select_sql):
+        cur = conn.cursor()
+        cur.execute("SELECT type FROM sqlite_master WHERE name = %s;", (view_name,))
+        row = cur.fetchone()
+        if row:
+            cur.execute(f"DROP {row[0].upper()} {view_name};")
+        cur.execute(f"CREATE VIEW {view_name} AS {select_sql};")
+        conn.commit()
+
+    def bulk_insert(self, conn, table_name, columns, rows):
+        rows = list(rows)
+        if not rows:
+            return 0
+        cur = conn.cursor()
+        quoted_columns = quote_columns(columns)
+        placeholders = ", ".join(["%s"] * len(columns))
+        cur.executemany(f"INSERT INTO {table_name} ({quoted_columns}) VALUES ({placeholders})", rows)
+        conn.commit()
+        return len(rows)
+
+    def upsert(self, conn, table_name, columns, rows, key_columns):
+        rows = unique_rows(columns, rows, key_columns)
+        if not rows:
+            return 0
+        cur = conn.cursor()
+        placeholders = ", ".join(["%s"] * len(columns))
+        cur.executemany(f"INSERT INTO {table_name} ({quote_columns(columns)}) VALUES ({placeholders}) "
+                        f"{upsert_clause(columns, key_columns)}", rows)
+        conn.commit()
+        return len(rows)
+
+    def copy_table(self, source_conn, target_conn, table_name, columns):
+        quoted_columns = "id, " + quote_columns(columns)
+        placeholders = ", ".join(["%s"] * (len(columns) + 1))
+        rows = self.query(source_conn, f"SELECT {quoted_columns} FROM {table_name};")
+        cur = target_conn.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+        cur.execute(self.create_table_sql(table_name, columns))
+        cur.executemany(f"INSERT INTO {table_name} ({quoted_columns}) VALUES ({placeholders})",
+                        [tuple(row) for row in rows])
+        target_conn.commit()
+
+
+STORAGES = {
+    PostgresStorage.name: PostgresStorage,
+    SQLiteStorage.name: SQLiteStorage,
+}
+
+
+def create_storage(env):
+    try:
+        return STORAGES[env.storage](env)
+    except KeyError:
+        raise Exception("Unknown storage backend: %s, expected one of: %s" % (env.storage, ", ".join(STORAGES)))
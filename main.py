@@ -23,11 +23,12 @@ def main():
     parser.add_argument('--eod10', action='store_true', help='Huawei')
     parser.add_argument('--eod11', action='store_true', help='Huawei to OTC')
     parser.add_argument('--eod12', action='store_true', help='Huawei files and lines count')
+    parser.add_argument('--force', action='store_true', help='Rebuild services dict even if sources are unchanged')
 
     args = parser.parse_args()
 
     if args.eod1:
-        eod_1_otc_services_dict.run()
+        eod_1_otc_services_dict.run(force=args.force)
     if args.eod2:
         eod_2_gitea_info.run()
     if args.eod3:
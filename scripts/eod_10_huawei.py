@@ -6,13 +6,12 @@ import json
 import logging
 import re
 
-import psycopg2
 import requests
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import Database, EnvVariables, RunRecorder, Timer, count_rows_written, create_session, setup_logging, stage
 
 gitea_api_endpoint = "https://gitea.eco.tsi-dev.otc-service.com/api/v1"
-session = requests.Session()
+session = create_session()
 
 env_vars = EnvVariables()
 database = Database(env_vars)
@@ -35,7 +34,7 @@ def create_prs_table(conn, cur, huawei):
         )
         conn.commit()
         logging.info("Table %s has been created successfully", huawei)
-    except psycopg2.Error as e:
+    except database.storage.Error as e:
         logging.error("Tables creating: an error occurred while trying to create a table %s in the database: %s",
                       huawei, e)
 
@@ -223,28 +222,16 @@ def insert_analyzed_prs(conn, cur, huawei, analyzed_prs):
                  pr["huawei_comment"])
             )
         conn.commit()
+        count_rows_written(len(analyzed_prs))
         logging.info("Inserted %d analyzed PRs into %s", len(analyzed_prs), huawei)
-    except psycopg2.Error as e:
+    except database.storage.Error as e:
         logging.error("Error inserting analyzed PRs: %s", e)
 
 
 def update_squad_and_title(cur, conn, rtc, huawei_tab):
     logging.info("Updating squads and titles...")
     try:
-        cur.execute(f"SELECT * FROM {huawei_tab};")
-        open_issues_rows = cur.fetchall()
-
-        for row in open_issues_rows:
-            cur.execute(
-                f"""UPDATE {huawei_tab}
-                    SET "Service Name" = rtc."Title", "Squad" = rtc."Squad"
-                    FROM {rtc} AS rtc
-                    WHERE {huawei_tab}."Service Name" = rtc."Repository"
-                    AND {huawei_tab}.id = %s;""",
-                (row[0],)
-            )
-
-        conn.commit()
+        database.storage.enrich(conn, huawei_tab, rtc, other_repos=None)
 
     except Exception as e:
         logging.error("Error updating squad and title: %s", e)
@@ -261,12 +248,15 @@ def main(conn, cur, org, rtc, changes_tab, huawei_tab):
     requested_prs = get_requested_prs(cur_csv, changes_tab)
     logging.info("Looking for labels in requested changes PRs...")
     parsed_prs = parse_pr_url(requested_prs, org)
-    analyzed_prs = get_analyzed_prs(org, parsed_prs)
-    comments = search_comments(org, analyzed_prs)
-    comments_list = get_review_comments_info(org, comments)
+    with stage("labels"):
+        analyzed_prs = get_analyzed_prs(org, parsed_prs)
+    with stage("comments"):
+        comments = search_comments(org, analyzed_prs)
+        comments_list = get_review_comments_info(org, comments)
 
-    insert_analyzed_prs(conn, cur, huawei_tab, comments_list)
-    update_squad_and_title(cur_csv, conn_csv, rtc, huawei_tab)
+    with stage("write"):
+        insert_analyzed_prs(conn, cur, huawei_tab, comments_list)
+        update_squad_and_title(cur_csv, conn_csv, rtc, huawei_tab)
 
 
 def run():
@@ -288,9 +278,12 @@ def run():
 
     conn_csv.commit()
 
-    main(conn_csv, cur_csv, org_string, rtc_table, changes_table, huawei_label_table)
-    main(conn_csv, cur_csv, f"{org_string}-swiss", f"{rtc_table}_swiss", f"{changes_table}_swiss",
-         f"{huawei_label_table}_swiss")
+    recorder = RunRecorder("eod_10_huawei", database, env_vars.db_csv)
+    with recorder.zone("Public"):
+        main(conn_csv, cur_csv, org_string, rtc_table, changes_table, huawei_label_table)
+    with recorder.zone("Hybrid"):
+        main(conn_csv, cur_csv, f"{org_string}-swiss", f"{rtc_table}_swiss", f"{changes_table}_swiss",
+             f"{huawei_label_table}_swiss")
 
     if done:
         logging.info("Search successfully finish!")
@@ -6,13 +6,12 @@ import json
 import logging
 from datetime import datetime
 
-import psycopg2
 import requests
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import Database, EnvVariables, RunRecorder, Timer, count_rows_written, create_session, setup_logging, stage
 
 gitea_api_endpoint = "https://gitea.eco.tsi-dev.otc-service.com/api/v1"
-session = requests.Session()
+session = create_session()
 
 env_vars = EnvVariables()
 database = Database(env_vars)
@@ -34,7 +33,7 @@ def create_prs_table(conn, cur, table_name):
         )
         conn.commit()
         logging.info("Table %s has been created successfully", table_name)
-    except psycopg2.Error as e:
+    except database.storage.Error as e:
         logging.error("Tables creating: an error occurred while trying to create a table %s in the database: %s",
                       table_name, e)
 
@@ -181,24 +180,13 @@ def insert_data_postgres(prs_tab, pr, conn, cur):
         ON CONFLICT ("PR Number", "Service Name") DO NOTHING;
         """, (pr_number, repo, '', pr_url, days_passed, if_rst))
     conn.commit()
+    count_rows_written(cur.rowcount)
 
 
 def update_squad_and_title(conn, cur, rtc, prs_tab):
     logging.info("Updating squads and titles...")
     try:
-        cur.execute(f"SELECT * FROM {prs_tab};")
-        open_issues_rows = cur.fetchall()
-
-        for row in open_issues_rows:
-            cur.execute(
-                f"""UPDATE {prs_tab}
-                    SET "Service Name" = rtc."Title", "Squad" = rtc."Squad"
-                    FROM {rtc} AS rtc
-                    WHERE {prs_tab}."Service Name" = rtc."Repository"
-                    AND {prs_tab}.id = %s;""",
-                (row[0],)
-            )
-        conn.commit()
+        database.storage.enrich(conn, prs_tab, rtc, other_repos=None)
 
     except Exception as e:
         logging.error("Error updating squad and title: %s", e)
@@ -215,12 +203,15 @@ def main(org, rtc, prs_tab):
     repos = get_repos(cur_csv, rtc)
     logging.info("Gathering all child PRs...")
 
-    all_prs = gather_prs(org, repos)
-    if_rst = check_rst(org, all_prs)
+    with stage("prs"):
+        all_prs = gather_prs(org, repos)
+    with stage("rst"):
+        if_rst = check_rst(org, all_prs)
 
-    for pr in if_rst:
-        insert_data_postgres(prs_tab, pr, conn_csv, cur_csv)
-    update_squad_and_title(conn_csv, cur_csv, rtc, prs_tab)
+    with stage("write"):
+        for pr in if_rst:
+            insert_data_postgres(prs_tab, pr, conn_csv, cur_csv)
+        update_squad_and_title(conn_csv, cur_csv, rtc, prs_tab)
 
 
 def run():
@@ -241,8 +232,11 @@ def run():
 
     conn_csv.commit()
 
-    main(org_string, rtc_table, prs_table)
-    main(f"{org_string}-swiss", f"{rtc_table}_swiss", f"{prs_table}_swiss")
+    recorder = RunRecorder("eod_11_huawei_to_otc", database, env_vars.db_csv)
+    with recorder.zone("Public"):
+        main(org_string, rtc_table, prs_table)
+    with recorder.zone("Hybrid"):
+        main(f"{org_string}-swiss", f"{rtc_table}_swiss", f"{prs_table}_swiss")
 
     if done:
         logging.info("Search successfully finish!")
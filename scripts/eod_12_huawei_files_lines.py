@@ -7,10 +7,8 @@ from datetime import datetime
 from typing import Dict, List
 
 import aiohttp  # type: ignore
-import psycopg2
-import psycopg2.extras
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import Database, EnvVariables, RunRecorder, Timer, count_api_call, count_rows_written, setup_logging, stage
 
 # Async conf
 MAX_CONCURRENT_REQUESTS = 20
@@ -52,6 +50,7 @@ class OptimizedAPIClient:
             for attempt in range(3):  # Retry до 3 раз
                 try:
                     await asyncio.sleep(REQUEST_DELAY)  # Rate limiting
+                    count_api_call()
                     async with self.session.get(url) as response:
                         if response.status == 429:  # Rate limit exceeded
                             wait_time = 2 ** attempt
@@ -72,6 +71,7 @@ class OptimizedAPIClient:
             for attempt in range(3):
                 try:
                     await asyncio.sleep(REQUEST_DELAY)
+                    count_api_call()
                     async with self.session.get(url) as response:
                         if response.status == 429:
                             wait_time = 2 ** attempt
@@ -210,22 +210,20 @@ async def count_lines_async(files: List[Dict], client: OptimizedAPIClient) -> Li
 
 def batch_insert_to_db(conn, cur, data: List[Dict], table: str, columns: List[str]):
     if not data:
-        return
+        return 0
 
     values = []
     for item in data:
         values.append(tuple(item.get(col, None) for col in columns))
 
-    escaped_columns = [f'"{col}"' for col in columns]
-    query = f"INSERT INTO {table} ({', '.join(escaped_columns)}) VALUES %s"
-
     try:
-        psycopg2.extras.execute_values(cur, query, values, page_size=BATCH_SIZE)
-        conn.commit()
-        logging.info(f"Inserted {len(values)} records into {table}")
+        inserted = database.storage.bulk_insert(conn, table, columns, values)
+        logging.info(f"Inserted {inserted} records into {table}")
+        return inserted
     except Exception as e:
         logging.error(f"Error batch inserting into {table}: {e}")
         conn.rollback()
+        return 0
 
 
 async def main_async(org: str, rtc: str, fil_lin_tab: str, temp_tab: str):
@@ -245,7 +243,8 @@ async def main_async(org: str, rtc: str, fil_lin_tab: str, temp_tab: str):
 
         async with OptimizedAPIClient() as client:
             logging.info("Gathering PRs...")
-            all_prs = await gather_prs_async(org, repos, client)
+            with stage("prs"):
+                all_prs = await gather_prs_async(org, repos, client)
             logging.info(f"Found {len(all_prs)} PRs")
 
             if not all_prs:
@@ -264,14 +263,16 @@ async def main_async(org: str, rtc: str, fil_lin_tab: str, temp_tab: str):
                     "Lines count": 0
                 })
 
-            batch_insert_to_db(conn_csv, cur_csv, pr_data, fil_lin_tab, pr_columns)
+            count_rows_written(batch_insert_to_db(conn_csv, cur_csv, pr_data, fil_lin_tab, pr_columns))
 
             logging.info("Gathering PR files...")
-            all_files = await get_pr_files_async(org, all_prs, client)
+            with stage("files"):
+                all_files = await get_pr_files_async(org, all_prs, client)
             logging.info(f"Found {len(all_files)} files")
 
             logging.info("Counting lines in files...")
-            processed_files = await count_lines_async(all_files, client)
+            with stage("lines"):
+                processed_files = await count_lines_async(all_files, client)
 
             temp_columns = ["repo", "pr_number", "file_url", "lines_count"]
             temp_data = []
@@ -305,9 +306,12 @@ def run():
     files_lines_table = "huawei_files_lines"
     temp_table = "temp_huawei_files_lines"
 
-    asyncio.run(main_async(org_string, rtc_table, files_lines_table, temp_table))
-    asyncio.run(main_async(f"{org_string}-swiss", f"{rtc_table}_swiss",
-                           f"{files_lines_table}_swiss", f"{temp_table}_swiss"))
+    recorder = RunRecorder("eod_12_huawei_files_lines", database, env_vars.db_csv)
+    with recorder.zone("Public"):
+        asyncio.run(main_async(org_string, rtc_table, files_lines_table, temp_table))
+    with recorder.zone("Hybrid"):
+        asyncio.run(main_async(f"{org_string}-swiss", f"{rtc_table}_swiss",
+                               f"{files_lines_table}_swiss", f"{temp_table}_swiss"))
 
     timer.stop()
     logging.info("Async Huawei filles-lines script completed successfully!")
@@ -329,7 +333,7 @@ def create_prs_table(conn, cur, table_name):
         )
         conn.commit()
         logging.info("Table %s has been created successfully", table_name)
-    except psycopg2.Error as e:
+    except database.storage.Error as e:
         logging.error("Tables creating: an error occurred while trying to create a table %s in the database: %s",
                       table_name, e)
 
@@ -347,7 +351,7 @@ def create_temp_table(conn, cur, temp_tab):
         )
         conn.commit()
         logging.info("Table %s has been created successfully", temp_tab)
-    except psycopg2.Error as e:
+    except database.storage.Error as e:
         logging.error("Tables creating: an error occurred while trying to create a table %s in the database: %s",
                       temp_tab, e)
 
@@ -383,19 +387,7 @@ def aggregate_lines_count(conn, cur, temp_tab, fil_lin_tab):
 def update_squad_and_title(conn, cur, rtc, fil_lin_tab):
     logging.info("Updating squads and titles...")
     try:
-        cur.execute(f"SELECT * FROM {fil_lin_tab};")
-        open_issues_rows = cur.fetchall()
-
-        for row in open_issues_rows:
-            cur.execute(
-                f"""UPDATE {fil_lin_tab}
-                    SET "Service Name" = rtc."Title", "Squad" = rtc."Squad"
-                    FROM {rtc} AS rtc
-                    WHERE {fil_lin_tab}."Service Name" = rtc."Repository"
-                    AND {fil_lin_tab}.id = %s;""",
-                (row[0],)
-            )
-        conn.commit()
+        database.storage.enrich(conn, fil_lin_tab, rtc, other_repos=None)
     except Exception as e:
         logging.error("Error updating squad and title: %s", e)
 
@@ -4,38 +4,55 @@ service postgres tables, to match repo names, service full names and its squads
 """
 
 import base64
-import json
+import hashlib
+import io
 import logging
+import tarfile
+from datetime import datetime
 
-import psycopg2
-import requests
 import yaml
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import (Database, EnvVariables, RepoInventory, RunRecorder, Timer, count_rows_written, create_session,
+                    setup_logging, stage)
 
 BASE_URL = "https://gitea.eco.tsi-dev.otc-service.com/api/v1"
-GITEA_API_ENDPOINT = "https://gitea.eco.tsi-dev.otc-service.com/api/v1"
-session = requests.Session()
+session = create_session()
 
 env_vars = EnvVariables()
 database = Database(env_vars)
 gitea_token = env_vars.gitea_token
+inventory = RepoInventory(database, env_vars)
+
+METADATA_DIR = "otc_metadata/data/"
+STYRING_REPO = "infra/gitstyring"
+RTC_COLUMNS = {
+    "Repository": "VARCHAR(255)",
+    "Title": "VARCHAR(255)",
+    "Category": "VARCHAR(255)",
+    "Squad": "VARCHAR(255)",
+    "Env": "VARCHAR(255)"
+}
+DOC_COLUMNS = {
+    "Service Type": "VARCHAR(255)",
+    "Title": "VARCHAR(255)",
+    "Document Type": "VARCHAR(255)",
+    "Link": "VARCHAR(255)"
+}
+SOURCES_TABLE = "eod_sources"
+SOURCES_COLUMNS = {
+    "Table": "VARCHAR(255)",
+    "Metadata SHA": "VARCHAR(64)",
+    "Styring SHA": "VARCHAR(64)",
+    "Built at": "TIMESTAMP",
+    "Repos hash": "VARCHAR(64)"
+}
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)  # libyaml based loader, if PyYAML is built with it
 
 
 def create_rtc_table(conn_csv, cur_csv, table_name):
     logging.info("Creating new service table %s...", table_name)
     try:
-        cur_csv.execute(
-            f'''CREATE TABLE IF NOT EXISTS {table_name} (
-            id SERIAL PRIMARY KEY,
-            "Repository" VARCHAR(255),
-            "Title" VARCHAR(255),
-            "Category" VARCHAR(255),
-            "Squad" VARCHAR(255),
-            "Env" VARCHAR(255)
-            );'''
-        )
-        conn_csv.commit()
+        database.storage.create_table(conn_csv, table_name, RTC_COLUMNS)
     except Exception as e:
         logging.error("RTC: an error occurred while trying to create a table: %s", e)
         return
@@ -44,95 +61,102 @@ def create_rtc_table(conn_csv, cur_csv, table_name):
 def create_doc_table(conn_csv, cur_csv, table_name):
     logging.info("Creating new doc table %s...", table_name)
     try:
-        cur_csv.execute(
-            f'''CREATE TABLE IF NOT EXISTS {table_name} (
-            id SERIAL PRIMARY KEY,
-            "Service Type" VARCHAR(255),
-            "Title" VARCHAR(255),
-            "Document Type" VARCHAR(255),
-            "Link" VARCHAR(255)
-            );'''
-        )
-        conn_csv.commit()
+        database.storage.create_table(conn_csv, table_name, DOC_COLUMNS)
     except Exception as e:
         logging.error("Doc Table: an error occurred while trying to create a table: %s", e)
 
 
-def get_pretty_category_names(base_dir, category_dir):
-    response = requests.get(f"{BASE_URL}{category_dir}", timeout=10)
-    response.raise_for_status()
-    all_files = [item['path'] for item in response.json() if item['type'] == 'file']
-
-    category_mapping = {}
-
-    for file_path in all_files:
-        if file_path.endswith('.yaml'):
-            response = requests.get(f"{BASE_URL}{base_dir}{file_path}", timeout=10)
-            response.raise_for_status()
+def get_head_sha(repo):
+    repo_resp = session.get(f"{BASE_URL}/repos/{repo}?token={gitea_token}", timeout=10)
+    repo_resp.raise_for_status()
+    branch = repo_resp.json()["default_branch"]
 
-            file_content_base64 = response.json()['content']
-            file_content = base64.b64decode(file_content_base64).decode('utf-8')
+    branch_resp = session.get(f"{BASE_URL}/repos/{repo}/branches/{branch}?token={gitea_token}", timeout=10)
+    branch_resp.raise_for_status()
+    return branch_resp.json()["commit"]["id"]
 
-            data_dict = yaml.safe_load(file_content)
-            category_mapping[data_dict['name']] = data_dict['title']
 
-    return category_mapping
+def get_repos_hash():
+    """Fingerprint of docs org repositories tech repos are taken from, a new repository changes it"""
+    names = sorted(repo.name for repo in inventory.gitea_repos("docs") if not repo.archived)
+    return hashlib.sha256("\n".join(names).encode()).hexdigest()
 
 
-def get_service_categories(base_dir, category_dir, services_dir):
-    pretty_names = get_pretty_category_names(base_dir, category_dir)
+def get_source_shas(conn, table_name):
+    database.storage.create_table(conn, SOURCES_TABLE, SOURCES_COLUMNS, unique=["Table"])
+    database.storage.add_columns(conn, SOURCES_TABLE, {"Repos hash": SOURCES_COLUMNS["Repos hash"]})
+    rows = database.storage.query(
+        conn, f'SELECT "Metadata SHA", "Styring SHA", "Repos hash" FROM {SOURCES_TABLE} WHERE "Table" = %s;',
+        (table_name,)
+    )
+    return tuple(rows[0]) if rows else None
 
-    response = requests.get(f"{BASE_URL}{services_dir}", timeout=10)
-    response.raise_for_status()
-    all_files = [item['path'] for item in response.json() if item['type'] == 'file']
-
-    all_data = []
 
-    for file_path in all_files:
-        if file_path.endswith('.yaml'):
-            response = requests.get(f"{BASE_URL}{base_dir}{file_path}", timeout=10)
-            response.raise_for_status()
+def save_source_shas(conn, table_name, metadata_sha, styring_sha, repos_hash):
+    try:
+        database.storage.upsert(conn, SOURCES_TABLE, list(SOURCES_COLUMNS),
+                                [(table_name, metadata_sha, styring_sha, datetime.utcnow(), repos_hash)], ["Table"])
+    except Exception as e:
+        logging.error("Sources: an error occurred while saving source SHAs of %s: %s", table_name, e)
+        conn.rollback()
+
+
+def get_metadata_files(metadata_repo, sha):
+    """
+    Download the whole metadata repository as a single archive and parse its YAML files locally, instead of a contents
+    API call per file. Returns parsed files by their path in the repository
+    """
+    archive_resp = session.get(f"{BASE_URL}/repos/{metadata_repo}/archive/{sha}.tar.gz?token={gitea_token}",
+                               timeout=60)
+    archive_resp.raise_for_status()
+
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(archive_resp.content), mode="r:gz") as archive:
+        for member in archive:
+            # Archive members are prefixed with a repository name directory
+            path = member.name.split("/", 1)[-1]
+            if not member.isfile() or not path.startswith(METADATA_DIR) or not path.endswith(".yaml"):
+                continue
+            files[path] = yaml.load(archive.extractfile(member), Loader=YamlLoader)
+    logging.info("%s metadata files have been loaded from %s", len(files), metadata_repo)
+    return files
 
-            file_content_base64 = response.json()['content']
-            file_content = base64.b64decode(file_content_base64).decode('utf-8')
 
-            data_dict = yaml.safe_load(file_content)
-            technical_name = data_dict.get('service_category')
-            data_dict['service_category'] = pretty_names.get(technical_name, technical_name)
-            teams = data_dict.get('teams', [])
-            if teams:
-                squad_name = teams[0].get('name', '')
-                data_dict['squad'] = squad_name
-            else:
-                data_dict['squad'] = ''
+def get_data_dir(files, data_dir):
+    """Parsed files of one data directory, in the order contents API lists them"""
+    prefix = f"{METADATA_DIR}{data_dir}/"
+    return [files[path] for path in sorted(files) if path.startswith(prefix) and "/" not in path[len(prefix):]]
 
-            all_data.append(data_dict)
 
-    return all_data
+def get_pretty_category_names(files):
+    return {data_dict['name']: data_dict['title'] for data_dict in get_data_dir(files, "service_categories")}
 
 
-def get_docs_info(base_dir, doc_dir):
-    response = requests.get(f"{BASE_URL}{doc_dir}", timeout=10)
-    response.raise_for_status()
-    all_files = [item['path'] for item in response.json() if item['type'] == 'file']
+def get_service_categories(files):
+    pretty_names = get_pretty_category_names(files)
 
     all_data = []
 
-    for file_path in all_files:
-        if file_path.endswith('.yaml'):
-            response = requests.get(f"{BASE_URL}{base_dir}{file_path}", timeout=10)
-            response.raise_for_status()
+    for data_dict in get_data_dir(files, "services"):
+        technical_name = data_dict.get('service_category')
+        data_dict['service_category'] = pretty_names.get(technical_name, technical_name)
+        teams = data_dict.get('teams', [])
+        if teams:
+            squad_name = teams[0].get('name', '')
+            data_dict['squad'] = squad_name
+        else:
+            data_dict['squad'] = ''
 
-            file_content_base64 = response.json()['content']
-            file_content = base64.b64decode(file_content_base64).decode('utf-8')
-
-            data_dict = yaml.safe_load(file_content)
-            all_data.append(data_dict)
+        all_data.append(data_dict)
 
     return all_data
 
 
-def get_tech_repos(cur_csv, gitea_token, rtc_table):
+def get_docs_info(files):
+    return get_data_dir(files, "documents")
+
+
+def get_tech_repos(cur_csv, rtc_table):
     tech_repos = []
 
     try:
@@ -144,44 +168,32 @@ def get_tech_repos(cur_csv, gitea_token, rtc_table):
         logging.error("Fetching exclude repos for internal services: %s", e)
         return exclude_repos
 
-    max_pages = 50
-    page = 1
-
-    while True:
-        try:
-            repos_resp = session.get(f"{GITEA_API_ENDPOINT}/orgs/docs/repos?page={page}&limit=50&token={gitea_token}")
-            repos_resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logging.error("Get repos: an error occurred while trying to get repos: %s", e)
-            break
-
-        try:
-            repos_dict = json.loads(repos_resp.content.decode())
-        except json.JSONDecodeError as e:
-            logging.error("JSON decode: an error occurred while trying to decode JSON: %s", e)
-            break
-
-        for repo in repos_dict:
-            if repo["archived"] or repo["name"] in exclude_repos:
-                continue
-            tech_repos.append(repo["name"])
-
-        if page > max_pages:
-            logging.warning("Reached maximum page limit for docs")
-            break
+    for repo in inventory.gitea_repos("docs"):
+        if repo.archived or repo.name in exclude_repos:
+            continue
+        tech_repos.append(repo.name)
 
-        link_header = repos_resp.headers.get("Link")
-        if link_header is None or "rel=\"next\"" not in link_header:
-            break
-        page += 1
     logging.info("%s repos have been processed", len(tech_repos))
     return tech_repos
 
 
+def get_services_rows(all_data, descriptions):
+    """RTC rows of services, with squad slugs already replaced by squad descriptions from gitstyring"""
+    rows = []
+    for item in all_data:
+        if not isinstance(item, dict):
+            logging.error("Unexpected data type: %s, value: %s", type(item), item)
+            continue
+        squad = item.get("squad")
+        rows.append((item.get("service_uri"), item.get("service_title"), item.get("service_category"),
+                     descriptions.get(squad) or squad, item.get("environment")))
+    return rows
+
+
 def insert_services_data(item, conn_csv, cur_csv, table_name):
     if not isinstance(item, dict):
         logging.error("Unexpected data type: %s, value: %s", type(item), item)
-        return
+        return 0
 
     insert_query = f"""INSERT INTO {table_name} ("Repository", "Title", "Category", "Squad", "Env")
                       VALUES (%s, %s, %s, %s, %s);"""
@@ -195,6 +207,7 @@ def insert_services_data(item, conn_csv, cur_csv, table_name):
     cur_csv.execute(insert_query, (repository, title, category, squad, senv))
 
     conn_csv.commit()
+    return cur_csv.rowcount
 
 
 def insert_tech_repos_data(conn_csv, cur_csv, tech_repo, table_name):
@@ -214,40 +227,26 @@ def insert_tech_repos_data(conn_csv, cur_csv, tech_repo, table_name):
     cur_csv.execute(insert_query, (repository, title, category, squad, senv))
 
     conn_csv.commit()
+    return cur_csv.rowcount
 
 
 def get_squad_description(styring_url):
-    response = requests.get(styring_url, timeout=10)
+    """Squad slug -> description map of gitstyring data.yaml pinned to a commit"""
+    response = session.get(styring_url, timeout=10)
     response.raise_for_status()
 
     file_content_base64 = response.json()['content']
     file_content = base64.b64decode(file_content_base64).decode('utf-8')
 
-    data = yaml.safe_load(file_content)
+    data = yaml.load(file_content, Loader=YamlLoader)
 
     return {item['slug']: item['description'] for item in data['teams']}
 
 
-def update_squad_title(conn, styring_url, table_name):
-    descriptions = get_squad_description(styring_url)
-
-    cur = conn.cursor()
-    cur.execute(f"SELECT DISTINCT \"Squad\" FROM {table_name};")
-    squads = cur.fetchall()
-
-    for (squad,) in squads:
-        description = descriptions.get(squad)
-        if description:
-            cur.execute(f"UPDATE {table_name} SET \"Squad\" = %s WHERE \"Squad\" = %s;", (description, squad))
-
-    conn.commit()
-    cur.close()
-
-
 def insert_docs_data(item, conn_csv, cur_csv, table_name):
     if not isinstance(item, dict):
         logging.error("Unexpected data type: %s, value: %s", type(item), item)
-        return
+        return 0
 
     insert_query = f"""INSERT INTO {table_name} ("Service Type", "Title", "Document Type", "Link")
                       VALUES (%s, %s, %s, %s);"""
@@ -259,6 +258,7 @@ def insert_docs_data(item, conn_csv, cur_csv, table_name):
 
     cur_csv.execute(insert_query, (stype, title, dtype, link))
     conn_csv.commit()
+    return cur_csv.rowcount
 
 
 def add_obsolete_services(conn_csv, cur_csv, rtc_table):
@@ -269,84 +269,80 @@ def add_obsolete_services(conn_csv, cur_csv, rtc_table):
          "service_type": "das", "squad": "Other", "environment": "hidden"}
     ]
 
-    for item in data_to_insert:
-        insert_services_data(item, conn_csv, cur_csv, rtc_table)
+    return sum(insert_services_data(item, conn_csv, cur_csv, rtc_table) for item in data_to_insert)
 
 
-def copy_rtc(cur_csv, cursors, conns, rtctable):
-    logging.info("Start copy %s to other DBs...", rtctable)
-    try:
-        cur_csv.execute(f"SELECT * FROM {rtctable};")
-    except psycopg2.Error as e:
-        logging.error("Error fetching data from %s: %s", rtctable, e)
-        return
+def replicate_tables(conn_csv, rtctable, doctable):
+    """Copy service tables to ORPH and ZUUL databases, which already up to date are skipped by checksum"""
+    conns = [database.connect_to_db(env_vars.db_orph), database.connect_to_db(env_vars.db_zuul)]
+    database.storage.replicate(conn_csv, conns, rtctable, RTC_COLUMNS)
+    database.storage.replicate(conn_csv, conns, doctable, DOC_COLUMNS)
+    for conn in conns:
+        conn.close()
+
 
-    rows = cur_csv.fetchall()
-    columns = [desc[0] for desc in cur_csv.description]
-    columns_quoted = [f'"{col}"' for col in columns]
-    for conn, cur in zip(conns, cursors):
-        try:
-            cur.execute(
-                f"""CREATE TABLE IF NOT EXISTS {rtctable} (
-            {', '.join(['%s text' % col for col in columns_quoted])}
-            );
-            """)
-            for row in rows:
-                placeholders = ', '.join(['%s'] * len(row))
-                cur.execute(f"INSERT INTO {rtctable} VALUES ({placeholders});", row)
-            conn.commit()
-        except psycopg2.Error as e:
-            logging.error("Error copying data to %s in target DB: %s", rtctable, e)
-            conn.rollback()
-
-
-def main(base_dir, rtctable, doctable, styring_path):
-    services_dir = f"{base_dir}otc_metadata/data/services"
-    category_dir = f"{base_dir}otc_metadata/data/service_categories"
-    doc_dir = f"{base_dir}otc_metadata/data/documents"
-    styring_url = f"{BASE_URL}{styring_path}{env_vars.gitea_token}"
-
-    conn_orph = database.connect_to_db(env_vars.db_orph)
-    cur_orph = conn_orph.cursor()
-
-    conn_zuul = database.connect_to_db(env_vars.db_zuul)
-    cur_zuul = conn_zuul.cursor()
+def main(metadata_repo, rtctable, doctable, styring_path, styring_sha, force=False, obsolete_services=False):
+    """
+    Rebuild service tables of a zone, unless they were built from the same metadata and gitstyring commits and the same
+    docs org repositories
+    """
+    styring_url = f"{BASE_URL}{styring_path}{env_vars.gitea_token}&ref={styring_sha}"
 
     conn_csv = database.connect_to_db(env_vars.db_csv)
     cur_csv = conn_csv.cursor()
 
-    conns = [conn_orph, conn_zuul]
-    cursors = [cur_orph, cur_zuul]
-
-    cur_csv.execute(f"DROP TABLE IF EXISTS {rtctable}, {doctable}")
-    conn_csv.commit()
-    for conn, cur in zip(conns, cursors):
-        cur.execute(f"DROP TABLE IF EXISTS {rtctable}, {doctable}")
-        conn.commit()
-
-    all_data = get_service_categories(base_dir, category_dir, services_dir)
-    create_rtc_table(conn_csv, cur_csv, rtctable)
-    for data in all_data:
-        insert_services_data(data, conn_csv, cur_csv, rtctable)
-
-    update_squad_title(conn_csv, styring_url, rtctable)
-
-    create_doc_table(conn_csv, cur_csv, doctable)
-    all_doc_data = get_docs_info(base_dir, doc_dir)
-    for doc_data in all_doc_data:
-        insert_docs_data(doc_data, conn_csv, cur_csv, doctable)
+    metadata_sha = get_head_sha(metadata_repo)
+    repos_hash = get_repos_hash()
+    if not force and get_source_shas(conn_csv, rtctable) == (metadata_sha, styring_sha, repos_hash) \
+            and database.storage.table_exists(conn_csv, rtctable) and database.storage.table_exists(conn_csv, doctable):
+        logging.info("%s is up to date with %s@%s, %s@%s and docs repos, skipping", rtctable, metadata_repo,
+                     metadata_sha[:10], STYRING_REPO, styring_sha[:10])
+        with stage("replicate"):
+            replicate_tables(conn_csv, rtctable, doctable)
+        conn_csv.close()
+        return
 
-    tech_repos = get_tech_repos(cur_csv, gitea_token, rtctable)
-    for tech_repo in tech_repos:
-        insert_tech_repos_data(conn_csv, cur_csv, tech_repo, rtctable)
-    copy_rtc(cur_csv, cursors, conns, rtctable)
+    # Tables are built under staging names and published at once, downstream collectors never see them half-built
+    rtc_staging = f"{rtctable}_staging"
+    doc_staging = f"{doctable}_staging"
+    database.storage.drop_tables(conn_csv, rtc_staging, doc_staging)
+
+    with stage("metadata"):
+        files = get_metadata_files(metadata_repo, metadata_sha)
+
+    with stage("squads"):
+        descriptions = get_squad_description(styring_url)
+
+    with stage("services"):
+        all_data = get_service_categories(files)
+        create_rtc_table(conn_csv, cur_csv, rtc_staging)
+        services_rows = get_services_rows(all_data, descriptions)
+        count_rows_written(database.storage.bulk_insert(conn_csv, rtc_staging, list(RTC_COLUMNS), services_rows))
+
+    with stage("documents"):
+        create_doc_table(conn_csv, cur_csv, doc_staging)
+        all_doc_data = get_docs_info(files)
+        for doc_data in all_doc_data:
+            count_rows_written(insert_docs_data(doc_data, conn_csv, cur_csv, doc_staging))
+
+    with stage("tech_repos"):
+        tech_repos = get_tech_repos(cur_csv, rtc_staging)
+        for tech_repo in tech_repos:
+            count_rows_written(insert_tech_repos_data(conn_csv, cur_csv, tech_repo, rtc_staging))
+        if obsolete_services:
+            count_rows_written(add_obsolete_services(conn_csv, cur_csv, rtc_staging))
+
+    with stage("publish"):
+        database.storage.publish(conn_csv, rtc_staging, rtctable)
+        database.storage.publish(conn_csv, doc_staging, doctable)
+    with stage("replicate"):
+        replicate_tables(conn_csv, rtctable, doctable)
+    save_source_shas(conn_csv, rtctable, metadata_sha, styring_sha, repos_hash)
 
-    for conn in conns:
-        conn.close()
     conn_csv.close()
 
 
-def run():
+def run(force=False):
     timer = Timer()
     timer.start()
 
@@ -354,21 +350,22 @@ def run():
 
     logging.info("-------------------------OTC SERVICES DICT SCRIPT IS RUNNING-------------------------")
 
-    BASE_DIR_SWISS = "/repos/infra/otc-metadata-swiss/contents/"
-    BASE_DIR_REGULAR = "/repos/infra/otc-metadata/contents/"
+    METADATA_REPO_SWISS = "infra/otc-metadata-swiss"
+    METADATA_REPO_REGULAR = "infra/otc-metadata"
     STYRING_URL_REGULAR = "/repos/infra/gitstyring/contents/data/github/orgs/opentelekomcloud-docs/data.yaml?token="
     STYRING_URL_SWISS = "/repos/infra/gitstyring/contents/data/github/orgs/opentelekomcloud-docs-swiss/data.yaml?token="
     BASE_RTC_TABLE = "repo_title_category"
     BASE_DOC_TABLE = "doc_types"
 
-    main(BASE_DIR_REGULAR, BASE_RTC_TABLE, BASE_DOC_TABLE, STYRING_URL_REGULAR)
-    main(BASE_DIR_SWISS, f"{BASE_RTC_TABLE}_swiss", f"{BASE_DOC_TABLE}_swiss", STYRING_URL_SWISS)
-    conn_csv = database.connect_to_db(env_vars.db_csv)
-    cur_csv = conn_csv.cursor()
-    add_obsolete_services(conn_csv, cur_csv, BASE_RTC_TABLE)
+    styring_sha = get_head_sha(STYRING_REPO)
 
-    conn_csv.commit()
-    conn_csv.close()
+    recorder = RunRecorder("eod_1_otc_services_dict", database, env_vars.db_csv)
+    with recorder.zone("Public"):
+        main(METADATA_REPO_REGULAR, BASE_RTC_TABLE, BASE_DOC_TABLE, STYRING_URL_REGULAR, styring_sha, force,
+             obsolete_services=True)
+    with recorder.zone("Hybrid"):
+        main(METADATA_REPO_SWISS, f"{BASE_RTC_TABLE}_swiss", f"{BASE_DOC_TABLE}_swiss", STYRING_URL_SWISS, styring_sha,
+             force)
 
     timer.stop()
 
@@ -2,40 +2,70 @@
 This script gather and process info about dependent PRs, its parents and store it in postgres table
 """
 
-import csv
 import json
 import logging
-import pathlib
 import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
 
-import psycopg2
 import requests
-from github import Github
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import (Database, EnvVariables, RepoInventory, RunRecorder, Timer, TokenPool, count_rows_written,
+                    create_session, parse_datetime, setup_logging, stage)
 
 GITEA_API_ENDPOINT = "https://gitea.eco.tsi-dev.otc-service.com/api/v1"
-session = requests.Session()
+GITHUB_API_ENDPOINT = "https://api.github.com"
+MAX_CONCURRENT_REQUESTS = 10  # requests keeps 10 connections per host
+SEARCH_LIMIT = 1000  # results Github search API returns for a query at most
+SEARCH_START = datetime(2008, 1, 1)  # no Github PRs were created before
+AUTO_PR_TEXT = "This is an automatically created Pull Request for changes to"
+session = create_session()
 
 env_vars = EnvVariables()
 database = Database(env_vars)
+token_pool = TokenPool(env_vars.github_tokens)
+inventory = RepoInventory(database, env_vars, token_pool)
+github_session = create_session(token_pool)
 
-github_token = env_vars.github_token
 gitea_token = env_vars.gitea_token
-github_fallback_token = env_vars.github_fallback_token
 
 
-def csv_erase(filenames):
-    try:
-        for filename in filenames:
-            file_path = pathlib.Path(filename)
-            if file_path.exists():
-                file_path.unlink()
-                logging.info("CSV %s has been deleted", filename)
-            else:
-                continue
-    except Exception as e:
-        logging.error("CSV erase: error has been occurred: %s", e)
+class AutoPR(NamedTuple):
+    """Proposalbot PR in a service repo, its fields go in the order of PRS_COLUMNS"""
+    parent_pr: Optional[int]
+    service: str
+    squad: Optional[str]
+    url: str
+    state: str
+    merged: bool
+    env: str
+
+
+class ParentPR(NamedTuple):
+    """doc-exports PR"""
+    number: int
+    title: str
+    url: str
+    state: str
+    merged: bool
+
+
+BATCH_SIZE = 500
+ARCHIVE_TABLE = "pr_archive"
+ARCHIVE_COLUMNS = {
+    "Org": "VARCHAR(255)",
+    "Repo": "VARCHAR(255)",
+    "Number": "INT",
+    "Title": "TEXT",
+    "URL": "VARCHAR(255)",
+    "Merged": "BOOLEAN",
+    "Auto": "BOOLEAN",
+    "Parent PR": "INT",
+    "Updated at": "TIMESTAMP"
+}
+PRS_COLUMNS = ["Parent PR Number", "Service Name", "Squad", "Auto PR URL", "Auto PR State", "If merged", "Environment",
+               "Parent PR State", "Parent PR merged"]
 
 
 def create_prs_table(conn_csv, cur_csv, table_name):
@@ -56,12 +86,12 @@ def create_prs_table(conn_csv, cur_csv, table_name):
         )
         conn_csv.commit()
         logging.info("Table %s has been created successfully", table_name)
-    except psycopg2.Error as e:
+    except database.storage.Error as e:
         logging.error("Tables creating: an error occurred while trying to create a table %s in the database: %s",
                       table_name, e)
 
 
-def get_repos(org, cur_csv, gitea_token, rtc_table):
+def get_repos(org, cur_csv, rtc_table):
     repos = []
 
     try:
@@ -71,128 +101,103 @@ def get_repos(org, cur_csv, gitea_token, rtc_table):
         logging.error("Fetching exclude repos for internal services: %s", e)
         return repos
 
-    max_pages = 50
-    page = 1
+    for repo in inventory.gitea_repos(org):
+        if repo.archived or repo.name in exclude_repos:
+            continue
+        repos.append(repo.name)
 
+    logging.info("%s repos have been processed", len(repos))
+    return repos
+
+
+def list_pulls(org, repo, state, since=None):
+    """
+    Pull requests of a repo, most recently updated first. With since, listing stops at the first PR which hasn't been
+    updated after it
+    """
+    page = 1
     while True:
         try:
-            repos_resp = session.get(f"{GITEA_API_ENDPOINT}/orgs/{org}/repos?page={page}&limit=50&token={gitea_token}")
-            repos_resp.raise_for_status()
+            pulls_resp = session.get(f"{GITEA_API_ENDPOINT}/repos/{org}/{repo}/pulls?state={state}&sort=recentupdate"
+                                     f"&page={page}&limit=50&token={gitea_token}")
+            pulls_resp.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404:
+                logging.info("No repository or pull requests found in %s (404 error). Skipping.", repo)
+            else:
+                logging.error("Error occurred while trying to get %s pull requests of %s: %s", state, repo, e)
+            return
         except requests.exceptions.RequestException as e:
-            logging.error("Get repos: an error occurred while trying to get repos: %s", e)
-            break
+            logging.error("Error occurred while trying to get %s pull requests of %s: %s", state, repo, e)
+            return
 
         try:
-            repos_dict = json.loads(repos_resp.content.decode())
+            pulls = json.loads(pulls_resp.content.decode("utf-8"))
         except json.JSONDecodeError as e:
-            logging.error("JSON decode: an error occurred while trying to decode JSON: %s", e)
-            break
-
-        for repo in repos_dict:
-            if repo["archived"] or repo["name"] in exclude_repos:
-                continue
-            repos.append(repo["name"])
+            logging.error("Error occurred while trying to decode JSON: %s", e)
+            return
 
-        if page > max_pages:
-            logging.warning(f"Reached maximum page limit for {org}")
-            break
+        for pull_req in pulls:
+            if since is not None and parse_datetime(pull_req["updated_at"]) < since:
+                return
+            yield pull_req
 
-        link_header = repos_resp.headers.get("Link")
+        link_header = pulls_resp.headers.get("Link")
         if link_header is None or "rel=\"next\"" not in link_header:
-            break
+            return
         page += 1
 
-    logging.info("%s repos have been processed", len(repos))
-    return repos
 
+def is_auto_pr(body):
+    return (body or "").startswith("This is an automatically created Pull Request")
 
-def check_pull_requests_exist(org, repo):
+
+def get_closed_prs(conn_csv, org, repo):
+    """
+    Closed PRs of a repo from the archive, after PRs closed or updated since its high-water mark are fetched into it.
+    Returns (number, title, url, merged, auto, parent PR) rows
+    """
+    storage = database.storage
     try:
-        initial_resp = session.get(f"{GITEA_API_ENDPOINT}/repos/{org}/{repo}/pulls?state=all&limit=1&token="
-                                   f"{gitea_token}")
-        initial_resp.raise_for_status()
-        pulls = json.loads(initial_resp.content.decode())
-        if not pulls:
-            logging.info("No pull requests found in %s. Skipping.", repo)
-            return False
-        return True
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 404:
-            logging.info("No repository or pull requests found in %s (404 error). Skipping.", repo)
-            return False
-        logging.error("Error checking pull requests in %s: %s", repo, e)
-        return False
-    except requests.exceptions.RequestException as e:
-        logging.error("Unexpected error when checking pull requests in %s: %s", repo, e)
-        return False
+        since = parse_datetime(storage.query(
+            conn_csv, f'SELECT MAX("Updated at") FROM {ARCHIVE_TABLE} WHERE "Org" = %s AND "Repo" = %s;', (org, repo)
+        )[0][0])
+        fetched = [(org, repo, pr["number"], pr["title"], pr["url"], pr["merged"], is_auto_pr(pr["body"]),
+                    extract_number_from_body(pr["body"]) if is_auto_pr(pr["body"]) else None,
+                    parse_datetime(pr["updated_at"])) for pr in list_pulls(org, repo, "closed", since)]
+        storage.upsert(conn_csv, ARCHIVE_TABLE, list(ARCHIVE_COLUMNS), fetched, ["Org", "Repo", "Number"])
+        return storage.query(
+            conn_csv,
+            f"""SELECT "Number", "Title", "URL", "Merged", "Auto", "Parent PR" FROM {ARCHIVE_TABLE}
+                WHERE "Org" = %s AND "Repo" = %s;""",
+            (org, repo)
+        )
+    except Exception as e:
+        logging.error("PR archive: an error occurred while updating closed PRs of %s: %s", repo, e)
+        conn_csv.rollback()
+        return []
 
 
-def get_parent_pr(org, repo):
-    if not check_pull_requests_exist(org, repo):
-        return
-    try:
-        path = pathlib.Path("proposalbot_prs.csv")
-        if path.exists() is False:
-            with open("proposalbot_prs.csv", "w", encoding="utf-8") as csv_2:
-                csv_writer = csv.writer(csv_2)
-                csv_writer.writerow(["Parent PR number", "Service Name", "Auto PR URL", "Auto PR State", "If merged",
-                                     "Environment"])
-        else:
-            with open("proposalbot_prs.csv", "a", encoding="utf-8") as csv_2:
-                csv_writer = csv.writer(csv_2)
-
-                if repo not in {'doc-exports', 'dsf'}:
-                    page = 1
-                    while True:
-                        try:
-                            repo_resp = session.get(f"{GITEA_API_ENDPOINT}/repos/{org}/{repo}/pulls?state=all&page="
-                                                    f"{page}&limit=1000&token={gitea_token}")
-                            repo_resp.raise_for_status()
-                        except requests.exceptions.RequestException as e:
-                            logging.error("Error occurred while trying to get repo pull requests: %s", e)
-                            break
-
-                        try:
-                            pull_request = json.loads(repo_resp.content.decode())
-                        except json.JSONDecodeError as e:
-                            logging.error("Error occurred while trying to decode JSON: %s", e)
-                            break
-
-                        dependency_pull_requests = []
-
-                        for pr in pull_request:
-                            dependency_pull_requests.append(pr)
-
-                        for pull_req in dependency_pull_requests:
-                            body = pull_req["body"]
-                            if body.startswith("This is an automatically created Pull Request"):
-                                if pull_req["state"] == "closed" and pull_req["merged"] is False:
-                                    continue
-                                parent_pr = extract_number_from_body(body)
-                                service = repo
-                                auto_url = pull_req["url"]
-                                auto_state = pull_req["state"]
-                                if_merged = pull_req["merged"]
-                                env = "Gitea"
-                                try:
-                                    csv_writer.writerow([parent_pr, service, auto_url, auto_state, if_merged, env])
-                                except csv.Error as e:
-                                    logging.error("Error occurred while trying to write to CSV file: %s", e)
-                                    break
-                        link_header = repo_resp.headers.get("Link")
-                        if link_header is None or "rel=\"next\"" not in link_header:
-                            break
-                        page += 1
-
-    except IOError as e:
-        logging.error("Proposalbot_prs.csv: an error occurred while trying to open or write to CSV file: %s", e)
+def get_parent_pr(conn_csv, org, repo):
+    if repo in {'doc-exports', 'dsf'}:
         return
+    open_numbers = set()
+    for pull_req in list_pulls(org, repo, "open"):
+        open_numbers.add(pull_req["number"])
+        if is_auto_pr(pull_req["body"]):
+            yield AutoPR(extract_number_from_body(pull_req["body"]), repo, None, pull_req["url"], "open",
+                         pull_req["merged"], "Gitea")
+
+    for number, _, url, merged, auto, parent_pr in get_closed_prs(conn_csv, org, repo):
+        if not auto or not merged or number in open_numbers:  # closed without merge, or reopened since
+            continue
+        yield AutoPR(parent_pr, repo, None, url, "closed", bool(merged), "Gitea")
 
-    try:
-        csv_2.close()
 
-    except IOError as e:
-        logging.error("Error occurred while trying to close CSV file: %s", e)
+def get_auto_prs(conn_csv, org, repos):
+    """Proposalbot PRs of all the repos, streamed repo by repo as they are fetched"""
+    for repo in repos:
+        yield from get_parent_pr(conn_csv, org, repo)
 
 
 def extract_number_from_body(text):
@@ -209,57 +214,18 @@ def extract_number_from_body(text):
     return None
 
 
-def get_pull_requests(org, repo):
+def get_pull_requests(conn_csv, org, repo):
     logging.info("Gathering Gitea's child PRs...")
-    states = ["open", "closed"]
     pull_requests = []
-    try:
-        csv_file = open("doc_exports_prs.csv", "a", newline="", encoding="utf-8")
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(["Parent PR index", "Parent PR title", "Parent PR URL", "Parent PR state", "If merged"])
-    except IOError as e:
-        logging.error("Child PRs: an error occurred while opening or writing to the CSV file: %s", e)
-        return pull_requests
-
-    for state in states:
-        page = 1
-        while True:
-            try:
-                pull_requests_resp = session.get(f"{GITEA_API_ENDPOINT}/repos/{org}/{repo}/pulls?state={state}&page="
-                                                 f"{page}&limit=50&token={gitea_token}")
-                pull_requests_resp.raise_for_status()
-            except requests.exceptions.RequestException as e:
-                logging.error("Child PRs: an error occurred while trying to get pull requests of %s repo: %s",
-                              repo, e)
-                break
-
-            try:
-                pull_requests = json.loads(pull_requests_resp.content.decode("utf-8"))
-            except json.JSONDecodeError as e:
-                logging.error("Child PRs: an error occurred while trying to decode JSON: %s", e)
-                break
-
-            for pr in pull_requests:
-                index = pr["number"]
-                title = pr["title"]
-                url = pr["url"]
-                state = pr["state"]
-                if_merged = pr["merged"]
-                try:
-                    csv_writer.writerow([index, title, url, state, if_merged])
-                except csv.Error as e:
-                    logging.error("Child PRs: an error occurred while trying to write to CSV file: %s", e)
-                    break
-
-            link_header = pull_requests_resp.headers.get("Link")
-            if link_header is None or "rel=\"next\"" not in link_header:
-                break
-            page += 1
-    try:
-        csv_file.close()
-    except IOError as e:
-        logging.error("Child PRs: n error occurred while trying to close CSV file: %s", e)
-
+    open_numbers = set()
+    for pr in list_pulls(org, repo, "open"):
+        open_numbers.add(pr["number"])
+        pull_requests.append(ParentPR(pr["number"], pr["title"], pr["url"], "open", pr["merged"]))
+    for number, title, url, merged, _, _ in get_closed_prs(conn_csv, org, repo):
+        if number not in open_numbers:
+            pull_requests.append(ParentPR(number, title, url, "closed", bool(merged)))
+
+    logging.info("%s child PRs have been gathered", len(pull_requests))
     return pull_requests
 
 
@@ -273,146 +239,71 @@ def fetch_repo_title_category(cur_csv, rtctable):
         return None
 
 
-def update_service_titles(cur_csv, rtctable):
-    logging.info("Updating service titles using %s..", rtctable)
-    try:
-        repo_title_category = fetch_repo_title_category(cur_csv, rtctable)
-    except Exception as e:
-        logging.error("Titles: an error occurred while fetching repo title category: %s", e)
-        return
+def fetch_service_maps(cur_csv, rtctable):
+    """RTC table loaded once into repository -> title and title -> squad maps"""
+    repo_title_category = fetch_repo_title_category(cur_csv, rtctable) or []
+    titles = {row[1]: row[2] for row in repo_title_category}
+    squads = {row[2]: row[4] for row in repo_title_category}
+    return titles, squads
 
-    try:
-        with open("proposalbot_prs.csv", "r", newline="", encoding="utf-8") as file:
-            reader = csv.reader(file)
-            rows = list(reader)
-            header = rows.pop(0)
-            for row in rows:
-                for repo, title in [(r[1], r[2]) for r in repo_title_category]:
-                    if repo == row[1]:
-                        title_index = header.index("Service Name")
-                        row[title_index] = title
-    except IOError as e:
-        logging.error("Titles: an error occurred while reading the file: %s", e)
-        return
-    except Exception as e:
-        logging.error("Titles: an unexpected error occurred: %s", e)
-        return
 
-    try:
-        with open("proposalbot_prs.csv", "w", newline="", encoding="utf-8") as file:
-            writer = csv.writer(file)
-            writer.writerow(header)
-            writer.writerows(rows)
-    except IOError as e:
-        logging.error("Titles: an error occurred while writing to the file: %s", e)
-        return
-    except Exception as e:
-        logging.error("Titles: an unexpected error occurred: %s", e)
-        return
+def update_service_titles(auto_prs, titles):
+    for pr in auto_prs:
+        yield pr._replace(service=titles.get(pr.service, pr.service))
 
 
-def add_squad_column(cur_csv, rtctable):
-    logging.info("Add 'Squad' column into csv file...")
-    try:
-        repo_title_category = fetch_repo_title_category(cur_csv, rtctable)
-    except Exception as e:
-        logging.error("Squad column: an error occurred while fetching repo title category: %s", e)
-        return
+def add_squad_column(auto_prs, squads):
+    for pr in auto_prs:
+        yield pr._replace(squad=squads.get(pr.service, pr.squad))
 
-    try:
-        with open("proposalbot_prs.csv", "r", newline="", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            rows = list(reader)
-            header = rows.pop(0)
-            header.insert(2, "Squad")
-            for row in rows:
-                name_service = row[1]
-                for repo, title, squad in [(r[1], r[2], r[4]) for r in repo_title_category]:
-                    if title == name_service:
-                        row.insert(2, squad)
-    except IOError as e:
-        logging.error("Squad column: an error occurred while reading the file: %s", e)
-        return
-    except Exception as e:
-        logging.error("An unexpected error occurred: %s", e)
-        return
 
+def write_prs(conn, table_name, rows, kind):
     try:
-        with open("proposalbot_prs.csv", "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(header)
-            writer.writerows(rows)
-    except IOError as e:
-        logging.error("Squad column: an error occurred while writing to the file: %s", e)
-        return
+        count_rows_written(database.storage.bulk_insert(conn, table_name, PRS_COLUMNS, rows))
     except Exception as e:
-        logging.error("Squad column: an unexpected error occurred: %s", e)
-        return
+        logging.error("Open and orphans for %s and %s: an error occurred while inserting into the table: %s", kind,
+                      table_name, e)
+        conn.rollback()
 
 
-def compare_csv_files(conn_csv, cur_csv, conn_orph, cur_orph, opentable):
+def match_parent_prs(conn_csv, conn_orph, opentable, auto_prs, doc_exports_prs):
+    """Orphaned PRs, which state differs from the parent one, go to ORPH database, open ones to CSV database"""
     logging.info("Gathering open and orphaned PRs...")
-    try:
-        doc_exports_prs = []
-        proposalbot_prs = []
-
-        with open("proposalbot_prs.csv", "r", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            for row in reader:
-                proposalbot_prs.append(row)
-
-        with open("doc_exports_prs.csv", "r", encoding="utf-8") as f:
-            reader = csv.reader(f)
-            for row in reader:
-                doc_exports_prs.append(row)
-
-    except IOError as e:
-        logging.error("Open and orphans for %s: an error occurred while trying to read the file: %s", opentable, e)
-        return
-
+    parents = {pr.number: pr for pr in doc_exports_prs}
     orphaned = []
     open_prs = []
-    for pr1 in proposalbot_prs:
-        for pr2 in doc_exports_prs:
-            if pr1[0] == pr2[0] and pr1[4] != pr2[3]:
-                if pr1 not in orphaned:
-                    pr1.extend([pr2[3], pr2[4]])
-                    orphaned.append(pr1)
-                    try:
-                        # print("ORPHANED----------------------------------------------", pr1, len(pr1))
-                        cur_orph.execute(f"""
-                            INSERT INTO public.{opentable}
-                            ("Parent PR Number", "Service Name", "Squad", "Auto PR URL", "Auto PR State", "If merged",
-                             "Environment", "Parent PR State", "Parent PR merged")
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        """, tuple(pr1))
-                        conn_orph.commit()
-                    except Exception as e:
-                        logging.error("Open and orphans for ORPHANS and %s: an error occurred while inserting into "
-                                      "the orphaned_prs table: %s", opentable, e)
-
-            elif pr1[0] == pr2[0] and pr1[4] == pr2[3] == "open":
-                if pr1 not in open_prs:
-                    pr1.extend([pr2[3], pr2[4]])
-                    open_prs.append(pr1)
-                    try:
-                        cur_csv.execute(f"""
-                            INSERT INTO public.{opentable}
-                            ("Parent PR Number", "Service Name", "Squad",  "Auto PR URL", "Auto PR State", "If merged",
-                             "Environment", "Parent PR State", "Parent PR merged")
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        """, tuple(pr1))
-                        conn_csv.commit()
-                    except Exception as e:
-                        logging.error("Open and orphans for OPEN and %s: an error occurred while inserting"
-                                      " into the open_prs table: %s", opentable, e)
+    seen = set()
+    for pr in auto_prs:
+        parent = parents.get(pr.parent_pr)
+        if parent is None or pr.url in seen:
+            continue
+        seen.add(pr.url)
+        row = tuple(pr) + (parent.state, parent.merged)
+        if pr.state != parent.state:
+            orphaned.append(row)
+        elif pr.state == "open":
+            open_prs.append(row)
+        if len(orphaned) >= BATCH_SIZE:
+            write_prs(conn_orph, opentable, orphaned, "ORPHANS")
+            orphaned = []
+        if len(open_prs) >= BATCH_SIZE:
+            write_prs(conn_csv, opentable, open_prs, "OPEN")
+            open_prs = []
+
+    write_prs(conn_orph, opentable, orphaned, "ORPHANS")
+    write_prs(conn_csv, opentable, open_prs, "OPEN")
 
 
 def gitea_pr_info(org, parent_pr_name):
     parent_pr_num = None
     parent_pr_state = None
     parent_pr_merged = None
-    pull_request_resp = session.get(f"{GITEA_API_ENDPOINT}/repos/{org}/{parent_pr_name}?token={gitea_token}")
+    try:
+        pull_request_resp = session.get(f"{GITEA_API_ENDPOINT}/repos/{org}/{parent_pr_name}?token={gitea_token}",
+                                        timeout=30)
+    except requests.exceptions.RequestException as e:
+        logging.error("Parent PR: an error occurred while trying to get %s: %s", parent_pr_name, e)
+        return parent_pr_num, parent_pr_state, parent_pr_merged
     if pull_request_resp.status_code == 200:
         parent_info = json.loads(pull_request_resp.content.decode("utf-8"))
         parent_pr_num = parent_info.get("number")
@@ -422,109 +313,116 @@ def gitea_pr_info(org, parent_pr_name):
     return parent_pr_num, parent_pr_state, parent_pr_merged
 
 
-def get_github_open_prs(github_org, conn_csv, cur_csv, opentable, string):
+def search_auto_prs(gh_org, created_from=SEARCH_START, created_to=None):
+    """
+    Open proposalbot PRs of a Github org, found by search API instead of listing PRs of every repo. Search returns
+    SEARCH_LIMIT results at most, so a creation date range matching more is split in halves
+    """
+    created_to = created_to or datetime.utcnow().replace(microsecond=0)
+    created = f"{created_from.strftime('%Y-%m-%dT%H:%M:%SZ')}..{created_to.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+    query = f'org:{gh_org} is:pr is:open in:body "automatically created" created:{created}'
+    found = 0
+    page = 1
+    while True:
+        try:
+            search_resp = github_session.get(f"{GITHUB_API_ENDPOINT}/search/issues",
+                                             params={"q": query, "per_page": 100, "page": page}, timeout=30)
+            search_resp.raise_for_status()
+            search_result = search_resp.json()
+            items = search_result["items"]
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            logging.error("Github PRs: an error occurred while searching PRs of %s: %s", gh_org, e)
+            return
+        splittable = created_to - created_from > timedelta(seconds=1)
+        if page == 1 and search_result["total_count"] > SEARCH_LIMIT and splittable:
+            middle = created_from + (created_to - created_from) // 2
+            yield from search_auto_prs(gh_org, created_from, middle)
+            yield from search_auto_prs(gh_org, middle + timedelta(seconds=1), created_to)
+            return
+        found += len(items)
+        yield from items
+        if "next" not in search_resp.links:
+            break
+        page += 1
+
+    if search_result.get("incomplete_results") or found < search_result["total_count"]:
+        logging.warning("Github PRs: %s of %s PRs of %s created %s have been found", found,
+                        search_result["total_count"], gh_org, created)
+
+
+def get_github_open_prs(gh_org, conn_csv, opentable, string):
     logging.info("Gathering Github open PRs for %s...", string)
 
-    if not github_org or not conn_csv or not cur_csv:
+    if not gh_org or not conn_csv:
         logging.error("Github PRs: error: Invalid input parameters.")
         return
 
-    try:
-        for repo in github_org.get_repos():
-            for pr in repo.get_pulls(state='open'):
-                if pr.body is not None and 'This is an automatically created Pull Request for changes to' in pr.body:
-                    name_service = pr.base.repo.name
-                    squad = ""
-                    github_pr_url = pr.html_url
-                    auto_pr_state = pr.state
-                    if pr.merged_at is None:
-                        merged = False
-                    else:
-                        merged = True
-                    env = "Github"
-                    match_url = re.search(rf"(?<={string})/.*(?=.)", pr.body)
-                    if match_url:
-                        parent_api_name = match_url.group(0)
-                        parent_pr_num, parent_pr_state, parent_pr_merged = gitea_pr_info(parent_api_name, string)
-                        cur_csv.execute(
-                            f"""
-                            INSERT INTO {opentable} ("Parent PR Number", "Service Name", "Squad",  "Auto PR URL",
-                             "Auto PR State", "If merged", "Environment", "Parent PR State", "Parent PR merged")
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
-                            """,
-                            (parent_pr_num, name_service, squad, github_pr_url, auto_pr_state, merged, env,
-                             parent_pr_state, parent_pr_merged)
-                        )
-                        conn_csv.commit()
-    except Exception as e:
-        logging.error('Github PRs: an error occurred:', e)
-
-
-def update_squad_and_title(cursors, conns, rtctable, opentable):
+    github_prs = []
+    for item in search_auto_prs(gh_org):
+        body = item.get("body") or ""
+        if AUTO_PR_TEXT not in body:  # search matches words, not the exact phrase
+            continue
+        match_url = re.search(rf"(?<={string})/.*(?=.)", body)
+        if match_url:
+            name_service = item["repository_url"].rsplit("/", 1)[1]
+            merged = item["pull_request"].get("merged_at") is not None
+            github_prs.append((match_url.group(0).lstrip("/"), name_service, item["html_url"], item["state"], merged))
+
+    parent_names = list({pr[0] for pr in github_prs})
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        parents = dict(zip(parent_names, executor.map(lambda name: gitea_pr_info(string, name), parent_names)))
+    logging.info("%s Github PRs with %s parent PRs have been found", len(github_prs), len(parent_names))
+
+    rows = [(parents[parent_name][0], name_service, "", github_pr_url, auto_pr_state, merged, "Github",
+             parents[parent_name][1], parents[parent_name][2])
+            for parent_name, name_service, github_pr_url, auto_pr_state, merged in github_prs]
+    write_prs(conn_csv, opentable, rows, "Github")
+
+
+def update_squad_and_title(conns, rtctable, opentable):
     logging.info("Updating squads and titles...")
-    for cur in cursors:
+    for conn in conns:
         try:
-            cur.execute(f"SELECT * FROM {opentable};")
-            open_issues_rows = cur.fetchall()
-
-            for row in open_issues_rows:
-                cur.execute(
-                    f"""UPDATE {opentable}
-                        SET "Service Name" = rtc."Title", "Squad" = rtc."Squad"
-                        FROM {rtctable} AS rtc
-                        WHERE {opentable}."Service Name" = rtc."Repository"
-                        AND {opentable}.id = %s;""",
-                    (row[0],)
-                )
-                cur.execute(
-                    f"""UPDATE {opentable}
-                        SET "Squad" = 'Other'
-                        WHERE {opentable}."Service Name" IN ('doc-exports', 'docs_on_docs', 'docsportal')
-                        AND {opentable}.id = %s;""",
-                    (row[0],)
-                )
-                for conn in conns:
-                    conn.commit()
-
+            database.storage.enrich(conn, opentable, rtctable)
         except Exception as e:
             logging.error("Error updating squad and title: %s", e)
+            conn.rollback()
 
 
-def main(org, gh_org, rtctable, opentable, string, token):
-    csv_erase(["proposalbot_prs.csv", "doc_exports_prs.csv", "orphaned_prs.csv"])
-
+def main(org, gh_org, rtctable, opentable, string):
     conn_csv = database.connect_to_db(env_vars.db_csv)
     cur_csv = conn_csv.cursor()
     conn_orph = database.connect_to_db(env_vars.db_orph)
     cur_orph = conn_orph.cursor()
-    g = Github(token)
-    github_org = g.get_organization(gh_org)
 
     cur_csv.execute(f"DROP TABLE IF EXISTS {opentable}")
     conn_csv.commit()
+    cur_orph.execute(f"DROP TABLE IF EXISTS {opentable}")
+    conn_orph.commit()
 
-    cursors = [cur_csv, cur_orph]
     conns = [conn_csv, conn_orph]
 
     create_prs_table(conn_csv, cur_csv, opentable)
-
-    repos = get_repos(org, cur_csv, gitea_token, rtctable)
-    logging.info("Gathering parent PRs...")
-    for repo in repos:
-        get_parent_pr(org, repo)
-    get_pull_requests(org, "doc-exports")
-
-    update_service_titles(cur_csv, rtctable)
-    add_squad_column(cur_csv, rtctable)
-
-    cur_orph.execute(f"DROP TABLE IF EXISTS {opentable}")
-    conn_orph.commit()
     create_prs_table(conn_orph, cur_orph, opentable)
-    compare_csv_files(conn_csv, cur_csv, conn_orph, cur_orph, opentable)
-
-    get_github_open_prs(github_org, conn_csv, cur_csv, opentable, string)
-
-    update_squad_and_title(cursors, conns, rtctable, opentable)
+    database.storage.create_table(conn_csv, ARCHIVE_TABLE, ARCHIVE_COLUMNS, unique=["Org", "Repo", "Number"])
+
+    with stage("repos"):
+        repos = get_repos(org, cur_csv, rtctable)
+    with stage("doc_exports_prs"):
+        doc_exports_prs = get_pull_requests(conn_csv, org, "doc-exports")
+    with stage("parent_prs"):
+        logging.info("Gathering parent PRs...")
+        logging.info("Updating service titles and squads using %s...", rtctable)
+        titles, squads = fetch_service_maps(cur_csv, rtctable)
+        auto_prs = get_auto_prs(conn_csv, org, repos)
+        auto_prs = add_squad_column(update_service_titles(auto_prs, titles), squads)
+        match_parent_prs(conn_csv, conn_orph, opentable, auto_prs, doc_exports_prs)
+
+    with stage("github_prs"):
+        get_github_open_prs(gh_org, conn_csv, opentable, string)
+
+    with stage("enrich"):
+        update_squad_and_title(conns, rtctable, opentable)
 
     for conn in conns:
         conn.close()
@@ -542,23 +440,14 @@ def run():
     ORG_STRING = "docs"
     GH_ORG_STRING = "opentelekomcloud-docs"
 
-    DONE = False
-
-    try:
-        main(ORG_STRING, GH_ORG_STRING, RTC_TABLE, OPEN_TABLE, ORG_STRING, github_token)
-        main(f"{ORG_STRING}-swiss", f"{GH_ORG_STRING}-swiss", f"{RTC_TABLE}_swiss", f"{OPEN_TABLE}_swiss",
-             f"{ORG_STRING}-swiss", github_token)
-        DONE = True
-    except Exception as e:
-        logging.info("Error has been occurred: %s", e)
-        main(ORG_STRING, GH_ORG_STRING, RTC_TABLE, OPEN_TABLE, ORG_STRING, github_fallback_token)
+    recorder = RunRecorder("eod_2_gitea_info", database, env_vars.db_csv)
+    with recorder.zone("Public"):
+        main(ORG_STRING, GH_ORG_STRING, RTC_TABLE, OPEN_TABLE, ORG_STRING)
+    with recorder.zone("Hybrid"):
         main(f"{ORG_STRING}-swiss", f"{GH_ORG_STRING}-swiss", f"{RTC_TABLE}_swiss", f"{OPEN_TABLE}_swiss",
-             f"{ORG_STRING}-swiss", github_fallback_token)
-        DONE = True
-    if DONE:
-        logging.info("Github operations successfully done!")
+             f"{ORG_STRING}-swiss")
+    logging.info("Github operations successfully done!")
 
-    csv_erase(["proposalbot_prs.csv", "doc_exports_prs.csv", "orphaned_prs.csv"])
     timer.stop()
 
 
@@ -4,40 +4,59 @@ This script retrieves info about parent PRs on Github
 
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from github import Github
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import (Database, EnvVariables, HttpCache, RunRecorder, Timer, TokenPool, count_rows_written,
+                    create_session, setup_logging, stage)
+
+MAX_CONCURRENT_REQUESTS = 10  # requests keeps 10 connections per host
+GITEA_PR_LINK = re.compile(r"https?://[^\s/]+/[^\s/]+/[^\s/]+/pulls/\d+")
 
 env_vars = EnvVariables()
 database = Database(env_vars)
+token_pool = TokenPool(env_vars.github_tokens)
+http_cache = HttpCache.shared(database, env_vars.db_csv)
+github_session = create_session(token_pool, http_cache)
 
 
 def extract_pull_links(cur, table_name):
     logging.info("Extracting links...")
     try:
         cur.execute(f'SELECT "Auto PR URL" FROM {table_name};')
-        pull_links = [row[0] for row in cur.fetchall()]
+        pull_links = {row[0] for row in cur.fetchall()}
         return pull_links
     except Exception as e:
         logging.info("Extracting pull links: an error occurred while extracting pull links from %s: %s",
                      table_name, str(e))
-        return []
+        return set()
+
+
+def get_orphan_repos(org_str, pull_links):
+    """Repos which have orphaned PRs, their Github mirrors have the same names"""
+    repo_names = set()
+    for pull_link in pull_links:
+        match = re.search(rf"/{org_str}/(.+?)/", pull_link)
+        if match:
+            repo_names.add(match.group(1))
+    logging.info("%s repos have orphaned PRs", len(repo_names))
+    return sorted(repo_names)
 
 
-def get_auto_prs(gh_string, repo_name, access_token, pull_links):
+def get_auto_prs(gh_string, repo_name, pull_links):
     auto_prs = []
-    headers = {"Authorization": f"Bearer {access_token}"}
     url = f"https://api.github.com/repos/{gh_string}/{repo_name}/pulls"
-    params = {"state": "all"}
+    params = {"state": "all", "per_page": 100}
     try:
-        response = requests.get(url, timeout=10, headers=headers, params=params)
-        response.raise_for_status()
-        for pr in response.json():
-            body = pr.get("body")
-            if body and any(link in body for link in pull_links):
-                auto_prs.append(pr)
+        while url:
+            response = github_session.get(url, timeout=10, params=params)
+            response.raise_for_status()
+            for pr in response.json():
+                if any(link in pull_links for link in GITEA_PR_LINK.findall(pr.get("body") or "")):
+                    auto_prs.append(pr)
+            url = response.links.get("next", {}).get("url")
+            params = None  # next link already carries the query
     except requests.exceptions.RequestException as e:
         logging.info("Get PRs: an error occurred while trying to get pull requests: %s", e)
     return auto_prs
@@ -46,71 +65,65 @@ def get_auto_prs(gh_string, repo_name, access_token, pull_links):
 def add_github_columns(cur, conn, table_name):
     logging.info("Add info to the Postgres (%s)...", table_name)
     try:
-        cur.execute(
-            f'''
-            ALTER TABLE {table_name}
-            ADD COLUMN IF NOT EXISTS "Github PR State" VARCHAR(255),
-            ADD COLUMN IF NOT EXISTS "Github PR Merged" BOOLEAN;
-            '''
-        )
-        conn.commit()
-    except requests.exceptions.RequestException as e:
-        logging.info("Add new column: an error occurred while trying to addidng info to the {table_name}: %s", e)
+        database.storage.add_columns(conn, table_name, {"Github PR State": "VARCHAR(255)",
+                                                        "Github PR Merged": "BOOLEAN"})
+    except Exception as e:
+        logging.info("Add new column: an error occurred while trying to addidng info to the %s: %s", table_name, e)
+        conn.rollback()
 
 
 def update_orphaned_prs(org_str, cur, conn, rows, auto_prs, table_name):
+    """Auto PR is matched by the Gitea PR link in its body, or by repo name if none of them links the row"""
     logging.info("Processing orphaned PRs for %s...", org_str)
-    for row in rows:
-        pr_id, pull_link = row
-        gitea_repo_name = re.search(rf"/{org_str}/(.+?)/", pull_link).group(1)
-        matching_pr = None
-        for pr in auto_prs:
-            github_repo_name = pr["base"]["repo"]["name"]
-            if gitea_repo_name == github_repo_name:
-                matching_pr = pr
-                break
+    repo_pattern = re.compile(rf"/{org_str}/(.+?)/")
+    prs_by_link = {}
+    prs_by_repo = {}
+    for pr in auto_prs:
+        for link in GITEA_PR_LINK.findall(pr.get("body") or ""):
+            prs_by_link.setdefault(link, pr)
+        prs_by_repo.setdefault(pr["base"]["repo"]["name"], pr)
+
+    updates = []
+    for pr_id, pull_link in rows:
+        matching_pr = prs_by_link.get(pull_link)
+        if matching_pr is None:
+            match = repo_pattern.search(pull_link or "")
+            matching_pr = prs_by_repo.get(match.group(1)) if match else None
         if matching_pr:
-            state = matching_pr["state"]
-            if matching_pr["merged_at"] is None:
-                merged = False
-            else:
-                merged = True
-            try:
-                cur.execute(
-                    f'UPDATE {table_name} SET "Github PR State" = %s, "Github PR Merged" = %s WHERE id = %s;',
-                    (state, merged, pr_id)
-                )
-            except Exception as e:
-                logging.info("Orphanes: an error occurred while updating orphaned PRs in the %s table: %s",
-                             table_name, str(e))
-
-        else:
-            continue
+            updates.append((matching_pr["state"], matching_pr["merged_at"] is not None, pr_id))
 
+    try:
+        cur.executemany(f'UPDATE {table_name} SET "Github PR State" = %s, "Github PR Merged" = %s WHERE id = %s;',
+                        updates)
+        count_rows_written(cur.rowcount)
+    except Exception as e:
+        logging.info("Orphanes: an error occurred while updating orphaned PRs in the %s table: %s",
+                     table_name, str(e))
     conn.commit()
 
 
-def main(org, gorg, table_name, token):
-    g = Github(token)
-
-    ghorg = g.get_organization(gorg)
-    repo_names = [repo.name for repo in ghorg.get_repos()]
+def main(org, gorg, table_name):
     conn_orph = database.connect_to_db(env_vars.db_orph)
     cur_orph = conn_orph.cursor()
 
     pull_links = extract_pull_links(cur_orph, table_name)
+    with stage("repos"):
+        repo_names = get_orphan_repos(org, pull_links)
 
     auto_prs = []
-    logging.info("Gathering PRs info...")
-    for repo_name in repo_names:
-        auto_prs += get_auto_prs(gorg, repo_name, env_vars.github_token, pull_links)
+    with stage("auto_prs"):
+        logging.info("Gathering PRs info...")
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            for repo_prs in executor.map(lambda repo_name: get_auto_prs(gorg, repo_name, pull_links), repo_names):
+                auto_prs += repo_prs
 
-    add_github_columns(cur_orph, conn_orph, table_name)
+    with stage("update"):
+        add_github_columns(cur_orph, conn_orph, table_name)
 
-    cur_orph.execute(f'SELECT id, "Auto PR URL" FROM {table_name};')
-    rows = cur_orph.fetchall()
+        cur_orph.execute(f'SELECT id, "Auto PR URL" FROM {table_name};')
+        rows = cur_orph.fetchall()
 
-    update_orphaned_prs(org, cur_orph, conn_orph, rows, auto_prs, table_name)
+        update_orphaned_prs(org, cur_orph, conn_orph, rows, auto_prs, table_name)
 
     cur_orph.close()
     conn_orph.close()
@@ -127,19 +140,14 @@ def run():
     GH_ORG_STR = "opentelekomcloud-docs"
     ORPH_TABLE = "open_prs"
 
-    DONE = False
-    try:
-        main(ORG_STRING, GH_ORG_STR, ORPH_TABLE, env_vars.github_token)
-        main(f"{ORG_STRING}-swiss", f"{GH_ORG_STR}-swiss", f"{ORPH_TABLE}_swiss", env_vars.github_token)
-        DONE = True
-    except Exception as e:
-        logging.info(f"Error has been occurred: {e}")
-        main(ORG_STRING, GH_ORG_STR, ORPH_TABLE, env_vars.github_fallback_token)
-        main(f"{ORG_STRING}-swiss", f"{GH_ORG_STR}-swiss", f"{ORPH_TABLE}_swiss", env_vars.github_fallback_token)
-        DONE = True
-    if DONE:
-        logging.info("Github operations successfully done!")
+    recorder = RunRecorder("eod_3_github_info", database, env_vars.db_csv)
+    with recorder.zone("Public"):
+        main(ORG_STRING, GH_ORG_STR, ORPH_TABLE)
+    with recorder.zone("Hybrid"):
+        main(f"{ORG_STRING}-swiss", f"{GH_ORG_STR}-swiss", f"{ORPH_TABLE}_swiss")
+    logging.info("Github operations successfully done!")
 
+    http_cache.close()
     timer.stop()
 
 
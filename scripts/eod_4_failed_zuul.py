@@ -4,19 +4,41 @@ This script gathers info regarding PRs, which check jobs in zuul has been failed
 
 import json
 import logging
+import os
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 
-import psycopg2
 import requests
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import (Database, EnvVariables, RepoInventory, RunRecorder, Timer, count_rows_written, create_session,
+                    parse_datetime, setup_logging, stage)
 
 GITEA_API_ENDPOINT = "https://gitea.eco.tsi-dev.otc-service.com/api/v1"
-session = requests.Session()
+session = create_session()
 
 env_vars = EnvVariables()
 database = Database(env_vars)
+inventory = RepoInventory(database, env_vars)
+
+STATUS_TABLE = "commit_statuses"
+STATUS_COLUMNS = {
+    "Org": "VARCHAR(255)",
+    "Repo": "VARCHAR(255)",
+    "SHA": "VARCHAR(64)",
+    "Status": "VARCHAR(255)",
+    "Zuul URL": "VARCHAR(255)",
+    "Created at": "TIMESTAMP",
+    "Checked at": "TIMESTAMP"
+}
+ZUUL_DAYS = int(os.getenv("EOD_ZUUL_DAYS", "30"))
+ZUUL_PAGE_SIZE = 100
+ZUUL_FAILURES = {"FAILURE", "ERROR", "POST_FAILURE", "TIMED_OUT", "RETRY_LIMIT", "NODE_FAILURE", "MERGE_CONFLICT",
+                 "MERGE_FAILURE", "CONFIG_ERROR", "DISK_FULL", "LOST"}
+# Other results (CANCELED, ABORTED, DEQUEUED, SKIPPED...) belong to superseded or unfinished buildsets and tell nothing
+ZUUL_RESULTS = ZUUL_FAILURES | {"SUCCESS"}
+CACHED_STATUSES = ("success",)  # a recheck on the same commit can turn failure or error into success
+
+tenant_buildsets: dict = {}  # (Zuul URL, tenant) -> buildsets of the tenant, fetched once per run for all zones
 
 github_token = env_vars.github_token
 github_fallback_token = env_vars.github_fallback_token
@@ -41,63 +63,19 @@ def create_prs_table(conn_zuul, cur_zuul, table_name):
         )
         conn_zuul.commit()
         logging.info("Table %s has been created successfully", table_name)
-    except psycopg2.Error:
+    except database.storage.Error:
         logging.error(
             "Create table: an error occurred while trying to create a table %s in the database: %s", table_name,
             env_vars.db_zuul)
 
 
-def is_repo_empty(org, repo, gitea_token):
-    try:
-        commits_resp = session.get(f"{GITEA_API_ENDPOINT}/repos/{org}/{repo}/commits?token={gitea_token}")
-        commits_resp.raise_for_status()
-
-        commits_data = json.loads(commits_resp.content.decode())
-        if not commits_data:
-            return True
-        return False
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 409:  # Conflict error which might mean empty repo, skip this repo to avoid script\
-            # hangs
-            logging.info("Repo %s is empty, skipping", repo)
-            return True
-        logging.error("Check repo: an error occurred while trying to get commits for repo %s: %s", repo, e)
-        return False
-    except requests.exceptions.RequestException as e:
-        logging.error("Check repo: an error occurred while trying to get commits for repo %s: %s", repo, e)
-        return False
-
-
-def get_repos(org, gitea_token):
+def get_repos(org):
     logging.info("Gathering repos...")
     repos = []
-    page = 1
-    max_pages = 33
-    while True:
-        try:
-            repos_resp = session.get(f"{GITEA_API_ENDPOINT}/orgs/{org}/repos?page={page}&limit=50&token={gitea_token}")
-            repos_resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logging.error("Get repos: an error occurred while trying to get repos: %s", e)
-            break
-
-        try:
-            repos_dict = json.loads(repos_resp.content.decode())
-        except json.JSONDecodeError as e:
-            logging.error("Get repos: an error occurred while trying to decode JSON: %s", e)
-            break
-
-        for repo in repos_dict:
-            if not is_repo_empty(org, repo["name"], gitea_token):  # Skipping empty repos
-                repos.append(repo["name"])
-        if page > max_pages:
-            logging.warning(f"Reached maximum page limit for {org}")
-            break
-
-        link_header = repos_resp.headers.get("Link")
-        if link_header is None or "rel=\"next\"" not in link_header:
-            break
-        page += 1
+    for repo in inventory.gitea_repos(org):
+        if repo.empty or repo.open_prs == 0:  # only open PRs can have failed checks
+            continue
+        repos.append(repo.name)
 
     logging.info("%s repos have been processed", len(repos))
 
@@ -115,45 +93,156 @@ def extract_number_from_body(text):
     return None
 
 
-def get_f_pr_commits(org, repo, f_pr_number, gitea_token):
+def load_statuses(conn_csv, org):
+    """Cached commit statuses of org repos, (repo, sha) -> (status, Zuul URL, created at)"""
+    try:
+        database.storage.create_table(conn_csv, STATUS_TABLE, STATUS_COLUMNS, unique=["Org", "Repo", "SHA"])
+        rows = database.storage.query(
+            conn_csv, f'SELECT "Repo", "SHA", "Status", "Zuul URL", "Created at" FROM {STATUS_TABLE} WHERE "Org" = %s;',
+            (org,)
+        )
+    except Exception as e:
+        logging.error("Status cache: an error occurred while loading statuses of %s: %s", org, e)
+        conn_csv.rollback()
+        return {}
+    return {(repo, sha): (status, zuul_url, parse_datetime(created_at)) for repo, sha, status, zuul_url, created_at
+            in rows}
+
+
+def save_statuses(conn_csv, rows):
     try:
-        zuul_url = None
-        status = None
-        created_at = None
-        days_passed = None
-
-        pull_request_resp = session.get(
-            f"{GITEA_API_ENDPOINT}/repos/{org}/{repo}/pulls/{f_pr_number}/commits?token={gitea_token}")
-        pull_request_resp.raise_for_status()
-
-        f_pr_info = json.loads(pull_request_resp.content.decode("utf-8"))
-
-        if len(f_pr_info) > 0:
-            f_commit_sha = f_pr_info[0]["sha"]
-            commit_status_resp = session.get(
-                f"{GITEA_API_ENDPOINT}/repos/{org}/{repo}/statuses/{f_commit_sha}?token={gitea_token}")
-            commit_status_resp.raise_for_status()
-
-            commit_info = json.loads(commit_status_resp.content.decode("utf-8"))
-            commit_status = commit_info[0]["status"]
-            if commit_status == "failure":
-                status = commit_info[0]["status"]
-                zuul_url = commit_info[0]["target_url"]
-                created_at = datetime.strptime(commit_info[0]["created_at"], '%Y-%m-%dT%H:%M:%SZ')
-                now = datetime.utcnow()
-                days_passed = (now - created_at).days
+        database.storage.upsert(conn_csv, STATUS_TABLE, list(STATUS_COLUMNS), rows, ["Org", "Repo", "SHA"])
+    except Exception as e:
+        logging.error("Status cache: an error occurred while saving statuses: %s", e)
+        conn_csv.rollback()
+
+
+def prune_statuses(conn_csv, org, checked_since):
+    """Statuses not checked by this run belong to PRs which are no longer open or got new commits"""
+    try:
+        cur = conn_csv.cursor()
+        cur.execute(f'DELETE FROM {STATUS_TABLE} WHERE "Org" = %s AND "Checked at" < %s;', (org, checked_since))
+        conn_csv.commit()
+        logging.info("%s commit statuses of closed or updated PRs have been pruned", cur.rowcount)
+    except Exception as e:
+        logging.error("Status cache: an error occurred while pruning statuses of %s: %s", org, e)
+        conn_csv.rollback()
+
+
+def get_commit_status(org, repo, sha, gitea_token, statuses, new_statuses):
+    """Combined status of a commit, successful ones are taken from and added to the cache"""
+    if (repo, sha) in statuses:
+        new_statuses.append((org, repo, sha) + statuses[(repo, sha)] + (datetime.utcnow(),))  # keeps it from pruning
+        return statuses[(repo, sha)]
+
+    status_resp = session.get(f"{GITEA_API_ENDPOINT}/repos/{org}/{repo}/commits/{sha}/status?token={gitea_token}")
+    status_resp.raise_for_status()
+    combined = json.loads(status_resp.content.decode("utf-8"))
+
+    status = combined.get("state")
+    zuul_url = None
+    created_at = None
+    for commit_status in combined.get("statuses") or []:
+        if commit_status.get("status") == status:
+            zuul_url = commit_status.get("target_url")
+            created_at = parse_datetime(commit_status.get("created_at"))
+            break
+
+    result = (status, zuul_url, created_at)
+    if status in CACHED_STATUSES:
+        statuses[(repo, sha)] = result
+        new_statuses.append((org, repo, sha) + result + (datetime.utcnow(),))
+    return result
+
 
+def get_f_pr_status(org, repo, head_sha, gitea_token, statuses, new_statuses):
+    try:
+        status, zuul_url, created_at = get_commit_status(org, repo, head_sha, gitea_token, statuses, new_statuses)
+        if status == "failure" and zuul_url and created_at:
+            days_passed = (datetime.utcnow() - created_at).days
             return zuul_url, status, created_at, days_passed
 
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, ValueError) as e:
         logging.error(
-            "Get failed PR commits: an error occurred while trying to get pull requests of %s repo for %s org: \
-            %s", repo, org, e)
+            "Get failed PR status: an error occurred while trying to get status of %s commit in %s repo for %s org: "
+            "%s", head_sha, repo, org, e)
 
     return None, None, None, None
 
 
-def get_failed_prs(org, repo, gitea_token, conn_zuul, cur_zuul, table_name):
+def get_tenant_buildsets():
+    """
+    Latest conclusive check buildset per (project, PR number, head SHA) of the tenant from the last ZUUL_DAYS days,
+    taken from Zuul builds API in pages instead of a status request per PR. None if Zuul is unreachable
+    """
+    logging.info("Gathering Zuul buildsets of %s tenant...", env_vars.zuul_tenant)
+    since = datetime.utcnow() - timedelta(days=ZUUL_DAYS)
+    url = f"{env_vars.zuul_url.rstrip('/')}/api/tenant/{env_vars.zuul_tenant}/buildsets"
+    buildsets = {}
+    skip = 0
+    while True:
+        try:
+            buildsets_resp = session.get(url, params={"pipeline": "check", "complete": "true", "limit": ZUUL_PAGE_SIZE,
+                                                      "skip": skip}, timeout=30)
+            buildsets_resp.raise_for_status()
+            page = buildsets_resp.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error("Zuul buildsets: an error occurred while trying to get buildsets: %s", e)
+            return None
+
+        for buildset in page:
+            started_at = parse_datetime(buildset.get("event_timestamp") or buildset.get("first_build_start_time"))
+            if started_at and started_at < since:
+                page = []
+                break
+            if buildset.get("change") is None or buildset.get("result") not in ZUUL_RESULTS:
+                continue
+            key = (buildset.get("project") or "", int(buildset["change"]), buildset.get("patchset"))
+            buildsets.setdefault(key, buildset)  # newest buildsets come first
+
+        if len(page) < ZUUL_PAGE_SIZE:
+            break
+        skip += ZUUL_PAGE_SIZE
+
+    logging.info("%s Zuul buildsets have been gathered", len(buildsets))
+    return buildsets
+
+
+def get_zuul_buildsets(org):
+    """Buildsets of org projects by (repo, PR number, head SHA), empty if Zuul isn't configured or unreachable"""
+    if not env_vars.zuul_url:
+        return {}
+    key = (env_vars.zuul_url, env_vars.zuul_tenant)
+    if key not in tenant_buildsets:
+        buildsets = get_tenant_buildsets()
+        if buildsets is None:
+            return {}
+        tenant_buildsets[key] = buildsets
+    return {(project.split("/", 1)[1], change, patchset): buildset
+            for (project, change, patchset), buildset in tenant_buildsets[key].items()
+            if project.startswith(f"{org}/")}
+
+
+def get_zuul_status(buildset):
+    if buildset.get("result") not in ZUUL_FAILURES:
+        return None, None, None, None
+    created_at = parse_datetime(buildset.get("event_timestamp") or buildset.get("first_build_start_time"))
+    if created_at is None:
+        return None, None, None, None
+    zuul_url = f"{env_vars.zuul_url.rstrip('/')}/t/{env_vars.zuul_tenant}/buildset/{buildset['uuid']}"
+    return zuul_url, "failure", created_at, (datetime.utcnow() - created_at).days
+
+
+def get_pr_check(org, repo, pull_req, gitea_token, statuses, new_statuses, buildsets):
+    """Zuul buildset of PR head commit if there is one, Gitea commit status otherwise"""
+    head_sha = pull_req["head"]["sha"]
+    buildset = buildsets.get((repo, pull_req["number"], head_sha))
+    if buildset is not None:
+        return get_zuul_status(buildset)
+    return get_f_pr_status(org, repo, head_sha, gitea_token, statuses, new_statuses)
+
+
+def get_failed_prs(org, repo, gitea_token, conn_zuul, cur_zuul, table_name, statuses, new_statuses, buildsets):
     # logging.info(f"Processing {repo}...")  # Debug print, uncomment in case of script hangs
     try:
         if repo != "doc-exports":
@@ -161,8 +250,8 @@ def get_failed_prs(org, repo, gitea_token, conn_zuul, cur_zuul, table_name):
             while True:
                 # logging.info(f"Fetching PRs for {org} {repo}, page {page}...")  # Debug, uncomment if script hangs
                 repo_resp = session.get(
-                    f"{GITEA_API_ENDPOINT}/repos/{org}/{repo}/pulls?state=open&page={page}&token=\
-                    {gitea_token}")
+                    f"{GITEA_API_ENDPOINT}/repos/{org}/{repo}/pulls?state=open&page={page}&limit=50&token="
+                    f"{gitea_token}")
                 pull_requests = []
                 if repo_resp.status_code == 200:
                     try:
@@ -178,14 +267,13 @@ def get_failed_prs(org, repo, gitea_token, conn_zuul, cur_zuul, table_name):
                             if pull_req["merged"] is True:
                                 continue
                             f_par_pr_num = extract_number_from_body(body)
-                            f_pr_number = pull_req["number"]
                             service_name = repo
                             squad = ""
                             title = pull_req["title"]
                             f_pr_url = pull_req["url"]
                             f_pr_state = pull_req["state"]
-                            zuul_url, status, created_at, days_passed = get_f_pr_commits(org, repo, f_pr_number,
-                                                                                         gitea_token)
+                            zuul_url, status, created_at, days_passed = get_pr_check(
+                                org, repo, pull_req, gitea_token, statuses, new_statuses, buildsets)
                             try:
                                 if all(item is not None for item in [zuul_url, status, created_at, days_passed]):
                                     cur_zuul.execute(f"""
@@ -200,11 +288,15 @@ def get_failed_prs(org, repo, gitea_token, conn_zuul, cur_zuul, table_name):
                                                          days_passed, f_par_pr_num)
                                                      )
                                     conn_zuul.commit()
+                                    count_rows_written(cur_zuul.rowcount)
                             except Exception as e:
                                 logging.error(
                                     "Failed PRs: an error occurred while inserting into %s table: %s", table_name, e)
                         else:
                             continue
+                    link_header = repo_resp.headers.get("Link")
+                    if link_header is None or "rel=\"next\"" not in link_header:
+                        break
                 elif org in ["docs-swiss", "docs"] and repo_resp.status_code != 200:
                     break
                 page += 1
@@ -215,39 +307,7 @@ def get_failed_prs(org, repo, gitea_token, conn_zuul, cur_zuul, table_name):
 def update_squad_and_title(conn_zuul, cur_zuul, rtctable, opentable):
     logging.info("Updating squads and titles in %s...", opentable)
     try:
-        cur_zuul.execute(f"SELECT * FROM {opentable};")
-        failed_prs_rows = cur_zuul.fetchall()
-
-        for row in failed_prs_rows:
-            service_name_index = 1
-            id_index = 0
-
-            cur_zuul.execute(
-                f"""SELECT "Title", "Squad"
-                    FROM {rtctable}
-                    WHERE "Repository" = %s;""",
-                (row[service_name_index],)
-            )
-            rtc_row = cur_zuul.fetchone()
-
-            if rtc_row:
-                cur_zuul.execute(
-                    f"""UPDATE {opentable}
-                        SET "Service Name" = %s, "Squad" = %s
-                        WHERE id = %s;""",
-                    (rtc_row[0], rtc_row[1], row[id_index])
-                )
-
-            if row[service_name_index] in ('doc-exports', 'docs_on_docs', 'docsportal'):
-                cur_zuul.execute(
-                    f"""UPDATE {opentable}
-                        SET "Squad" = 'Other'
-                        WHERE id = %s;""",
-                    (row[id_index],)
-                )
-
-            conn_zuul.commit()
-
+        database.storage.enrich(conn_zuul, opentable, rtctable)
     except Exception as e:
         logging.error("Error updating squad and title: %s", e)
         conn_zuul.rollback()
@@ -263,13 +323,26 @@ def main(org, table_name, rtc):
 
     create_prs_table(conn_zuul, cur_zuul, table_name)
 
-    repos = get_repos(org, env_vars.gitea_token)
-
-    logging.info("Gathering PRs info...")
-    for repo in repos:
-        get_failed_prs(org, repo, env_vars.gitea_token, conn_zuul, cur_zuul, table_name)
-
-    update_squad_and_title(conn_zuul, cur_zuul, rtc, table_name)
+    with stage("repos"):
+        repos = get_repos(org)
+
+    with stage("failed_prs"):
+        logging.info("Gathering PRs info...")
+        conn_csv = database.connect_to_db(env_vars.db_csv)
+        statuses = load_statuses(conn_csv, org)
+        checked_since = datetime.utcnow()
+        new_statuses = []
+        buildsets = get_zuul_buildsets(org)
+        for repo in repos:
+            get_failed_prs(org, repo, env_vars.gitea_token, conn_zuul, cur_zuul, table_name, statuses, new_statuses,
+                           buildsets)
+        save_statuses(conn_csv, new_statuses)
+        prune_statuses(conn_csv, org, checked_since)
+        logging.info("%s successful commit statuses have been cached", len(new_statuses))
+        conn_csv.close()
+
+    with stage("enrich"):
+        update_squad_and_title(conn_zuul, cur_zuul, rtc, table_name)
 
     cur_zuul.close()
     conn_zuul.close()
@@ -286,8 +359,12 @@ def run():
     FAILED_TABLE = "open_prs"
     RTC_TABLE = "repo_title_category"
 
-    main(ORG_STRING, FAILED_TABLE, RTC_TABLE)
-    main(f"{ORG_STRING}-swiss", f"{FAILED_TABLE}_swiss", f"{RTC_TABLE}_swiss")
+    tenant_buildsets.clear()
+    recorder = RunRecorder("eod_4_failed_zuul", database, env_vars.db_csv)
+    with recorder.zone("Public"):
+        main(ORG_STRING, FAILED_TABLE, RTC_TABLE)
+    with recorder.zone("Hybrid"):
+        main(f"{ORG_STRING}-swiss", f"{FAILED_TABLE}_swiss", f"{RTC_TABLE}_swiss")
 
     timer.stop()
 
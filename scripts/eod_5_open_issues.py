@@ -2,75 +2,180 @@
 This script gather info regarding open issues in Gitea and Github
 """
 
-import json
 import logging
+import queue
 import re
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
 
-import psycopg2
 import requests
-from github import Github
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import (Database, EnvVariables, HttpCache, RunRecorder, Timer, TokenPool, count_rows_written,
+                    create_session, parse_datetime, setup_logging, stage)
 
 GITEA_API_ENDPOINT = "https://gitea.eco.tsi-dev.otc-service.com/api/v1"
-session = requests.Session()
+GITHUB_API_ENDPOINT = "https://api.github.com"
+SEARCH_LIMIT = 1000  # results Github search API returns for a query at most
+SEARCH_START = datetime(2008, 1, 1)  # no Github issues were created before
+session = create_session()
 
 env_vars = EnvVariables()
 database = Database(env_vars)
+token_pool = TokenPool(env_vars.github_tokens)
+http_cache = HttpCache.shared(database, env_vars.db_csv)
+github_session = create_session(token_pool, http_cache)
+
+ISSUES_COLUMNS = {
+    "Environment": "VARCHAR(255)",
+    "Service Name": "VARCHAR(255)",
+    "Squad": "VARCHAR(255)",
+    "Issue Number": "INT",
+    "Issue URL": "VARCHAR(255)",
+    "Created by": "VARCHAR(255)",
+    "Created at": "TIMESTAMP",
+    "Comments": "INT",
+    "Assignees": "TEXT",
+    "Synced at": "TIMESTAMP"
+}
+SYNC_TABLE = "issues_sync"
+SYNC_COLUMNS = {
+    "Table": "VARCHAR(255)",
+    "Environment": "VARCHAR(255)",
+    "Synced at": "TIMESTAMP",
+    "Full sync at": "TIMESTAMP"
+}
+FULL_SYNC_DAYS = 7
+BATCH_SIZE = 500
+QUEUE_PAGES = 4
+QUEUE_TIMEOUT = 1  # seconds the fetching thread waits for room in the queue before checking whether to stop
+
+
+class IssueRecord(NamedTuple):
+    row: tuple  # ISSUES_COLUMNS values but "Synced at"
+    open: bool
+    updated_at: Optional[datetime]
+
+
+class Prefetch:
+    """
+    Runs a generator of issue pages in a thread and hands them over through a queue of QUEUE_PAGES, so next pages are
+    fetched while previous ones are written and memory doesn't grow with the number of issues. complete is set to the
+    value returned by the generator once it's exhausted. The consumer calls stop() when it's done, also on errors, so
+    the thread doesn't wait forever for room in the queue nobody drains
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.queue = queue.Queue(maxsize=QUEUE_PAGES)
+        self.stopped = threading.Event()
+        self.complete = False
+        threading.Thread(target=self.produce, daemon=True).start()
+
+    def put(self, item):
+        """Queue an item unless the consumer has stopped, returns whether it's been queued"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-
-def create_open_issues_table(conn, cur, table_name):
+    def produce(self):
+        try:
+            while True:
+                if not self.put((True, next(self.pages))):
+                    self.pages.close()
+                    return
+        except StopIteration as stop:
+            self.put((False, stop.value))
+        except Exception as e:
+            logging.error("Issues: an error occurred while fetching issues: %s", e)
+            self.put((False, False))
+
+    def stop(self):
+        self.stopped.set()
+
+    def __iter__(self):
+        while True:
+            more, value = self.queue.get()
+            if not more:
+                self.complete = bool(value)
+                return
+            yield value
+
+
+def create_open_issues_table(conn, table_name):
+    """Issues are kept in {table_name}_data, table_name is a view over it computing "Duration" at query time"""
+    storage = database.storage
     try:
-        cur.execute(
-            f'''CREATE TABLE IF NOT EXISTS {table_name} (
-            id SERIAL PRIMARY KEY,
-            "Environment" VARCHAR(255),
-            "Service Name" VARCHAR(255),
-            "Squad" VARCHAR(255),
-            "Issue Number" INT,
-            "Issue URL" VARCHAR(255),
-            "Created by" VARCHAR(255),
-            "Created at" TIMESTAMP,
-            "Duration" INT,
-            "Comments" INT,
-            "Assignees" TEXT
-            );'''
+        storage.create_table(conn, f"{table_name}_data", ISSUES_COLUMNS, unique=["Issue URL"])
+        storage.create_table(conn, SYNC_TABLE, SYNC_COLUMNS, unique=["Table", "Environment"])
+        storage.create_view(
+            conn, table_name,
+            f"""SELECT id, "Environment", "Service Name", "Squad", "Issue Number", "Issue URL", "Created by",
+                "Created at", {storage.days_since("Created at")} AS "Duration", "Comments", "Assignees"
+                FROM {table_name}_data"""
         )
-        conn.commit()
         logging.info("Table %s has been created successfully", table_name)
-    except psycopg2.Error as e:
+    except Exception as e:
         logging.error("Tables creating: an error occurred while trying to create a table %s in the "
                       "database %s: %s", table_name, env_vars.db_csv, e)
+        conn.rollback()
+
+
+def get_watermark(conn, table_name, environment):
+    """
+    Time of the latest synced issue update and of the last full sync. The former is None when issues should be synced
+    in full: deleted or transferred issues never show up as updated, so full sync drops them every FULL_SYNC_DAYS
+    """
+    rows = database.storage.query(
+        conn, f'SELECT "Synced at", "Full sync at" FROM {SYNC_TABLE} WHERE "Table" = %s AND "Environment" = %s;',
+        (table_name, environment)
+    )
+    if not rows:
+        return None, None
+    synced_at, full_sync_at = parse_datetime(rows[0][0]), parse_datetime(rows[0][1])
+    if full_sync_at is None or datetime.utcnow() - full_sync_at > timedelta(days=FULL_SYNC_DAYS):
+        return None, full_sync_at
+    return synced_at, full_sync_at
+
 
+def save_watermark(conn, table_name, environment, synced_at, full_sync_at):
+    database.storage.upsert(conn, SYNC_TABLE, list(SYNC_COLUMNS), [(table_name, environment, synced_at, full_sync_at)],
+                            ["Table", "Environment"])
 
-def get_gitea_issues(gitea_token, gitea_org):
+
+def get_gitea_issues(gitea_token, gitea_org, since=None):
+    """Pages of open issues, or of all issues updated since the watermark, as records. Returns whether all are listed"""
     logging.info("Gathering Gitea issues for %s...", gitea_org)
-    gitea_issues = []
+    state = "all" if since else "open"
+    since_param = f"&since={since.strftime('%Y-%m-%dT%H:%M:%SZ')}" if since else ""
     page = 1
     while True:
         url = (
-            f"{GITEA_API_ENDPOINT}/repos/issues/search?state=open&owner={gitea_org}&page={page}"
-            f"&limit=1000&type=issues&token={gitea_token}"
+            f"{GITEA_API_ENDPOINT}/repos/issues/search?state={state}&owner={gitea_org}&page={page}"
+            f"&limit=1000&type=issues{since_param}&token={gitea_token}"
         )
         try:
-            response = requests.get(url, timeout=10)
+            response = session.get(url, timeout=10)
             response.raise_for_status()
 
             if not response.content:
                 logging.error("Received an empty response from the server.")
-                break
+                return False
 
             issues_list = response.json()
             if not issues_list:
                 logging.info("No more issues returned by the server.")
                 break
 
-            gitea_issues.extend(issues_list)
-
         except requests.exceptions.RequestException as e:
             logging.error(f"Gitea issues: an error occurred while trying to get Gitea issues for {gitea_org}: {e}")
-            break
+            return False
+
+        yield [record for record in map(gitea_issue_record, issues_list) if record]
 
         link_header = response.headers.get("Link")
         if not link_header or "rel=\"next\"" not in link_header:
@@ -78,153 +183,163 @@ def get_gitea_issues(gitea_token, gitea_org):
 
         page += 1
 
-    return gitea_issues
-
-
-def get_github_issues(github_token, repo_names, gh_org):
-    logging.info("Gathering Github issues for %s..." % gh_org)
-    headers = {"Authorization": f"Bearer {github_token}"}
-    github_issues = []
-    for repo in repo_names:
-        try:
-            url = f"https://api.github.com/repos/{gh_org}/{repo}/issues"
-            params = {"state": "open", "filter": "all"}
-            repos_resp = requests.get(url, timeout=10, headers=headers, params=params)
-            repos_resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logging.error("Github issues: an error occurred while trying to get Github issues for repo %s "
-                          "in %s org: %s", repo, gh_org, e)
-            continue
-
+    return True
+
+
+def get_github_issues(gh_org, since=None, created_from=SEARCH_START, created_to=None):
+    """
+    Pages of open issues, or of all issues updated since the watermark, of the whole org as records, found by search
+    API: the query filters out pull requests, and results don't depend on the user of the token, unlike org issues API.
+    Search returns SEARCH_LIMIT results at most, so a creation date range matching more is split in halves. Returns
+    whether all are listed
+    """
+    if created_to is None:
+        logging.info("Gathering Github issues for %s..." % gh_org)
+        created_to = datetime.utcnow().replace(microsecond=0)
+    created = f"{created_from.strftime('%Y-%m-%dT%H:%M:%SZ')}..{created_to.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+    state = f"updated:>={since.strftime('%Y-%m-%dT%H:%M:%SZ')}" if since else "is:open"
+    query = f"org:{gh_org} is:issue {state} created:{created}"
+    service_pattern = re.compile(rf"(?<={gh_org}/).([^/]+)")
+    found = 0
+    page = 1
+    while True:
         try:
-            issues_dict = json.loads(repos_resp.content.decode())
-            github_issues.extend(issues_dict)
-        except json.JSONDecodeError as e:
-            logging.error("Github issues: an error occurred while trying to decode JSON: %s", e)
-            continue
-
-    return github_issues
-
+            search_resp = github_session.get(f"{GITHUB_API_ENDPOINT}/search/issues",
+                                             params={"q": query, "per_page": 100, "page": page}, timeout=30)
+            search_resp.raise_for_status()
+            search_result = search_resp.json()
+            items = search_result["items"]
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            logging.error("Github issues: an error occurred while searching issues of %s: %s", gh_org, e)
+            return False
+        splittable = created_to - created_from > timedelta(seconds=1)
+        if page == 1 and search_result["total_count"] > SEARCH_LIMIT and splittable:
+            middle = created_from + (created_to - created_from) // 2
+            if not (yield from get_github_issues(gh_org, since, created_from, middle)):
+                return False
+            return (yield from get_github_issues(gh_org, since, middle + timedelta(seconds=1), created_to))
+        found += len(items)
+        yield [record for record in (github_issue_record(hub, service_pattern) for hub in items) if record]
+        if "next" not in search_resp.links:
+            break
+        page += 1
 
-def get_issues_table(gh_org, gitea_issues, github_issues, cur, conn, table_name):
-    logging.info("Posting data to Postgres (%s)...", env_vars.db_csv)
+    complete = not search_result.get("incomplete_results") and found >= search_result["total_count"]
+    if not complete:
+        logging.warning("Github issues: %s of %s issues of %s created %s have been found", found,
+                        search_result["total_count"], gh_org, created)
+    return complete
+
+
+def gitea_issue_record(tea):
+    if "pulls" in tea['html_url']:
+        return None
+    user = tea['user']['full_name'] or "proposalbot"
+    if 'assignees' in tea and tea['assignees'] is not None:
+        assignees = ', '.join([assignee['login'] for assignee in tea['assignees']])
+    else:
+        assignees = ''
+    return IssueRecord(("Gitea", tea['repository']['name'], "", tea['number'], tea['html_url'], user,
+                        parse_datetime(tea['created_at']), tea['comments'], assignees),
+                       tea['state'] == "open", parse_datetime(tea.get('updated_at')))
+
+
+def github_issue_record(hub, service_pattern):
+    if 'pull_request' in hub:
+        return None
+    service_match = service_pattern.search(hub['url'])
+    if service_match is None:
+        return None
+    assignees = ', '.join([assignee['login'] for assignee in hub['assignees']])
+    return IssueRecord(("Github", service_match.group(0).strip(), "", hub['number'], hub['html_url'],
+                        hub['user']['login'], parse_datetime(hub['created_at']), hub['comments'], assignees),
+                       hub['state'] == "open", parse_datetime(hub.get('updated_at')))
+
+
+def write_batch(conn, data_table, rows, closed_urls):
+    if closed_urls:
+        cur = conn.cursor()
+        cur.executemany(f'DELETE FROM {data_table} WHERE "Issue URL" = %s;', closed_urls)
+        conn.commit()
+        count_rows_written(cur.rowcount)
+    count_rows_written(database.storage.upsert(conn, data_table, list(ISSUES_COLUMNS), rows, ["Issue URL"]))
+
+
+def sync_issues(conn, table_name, environment, pages, full):
+    """
+    Issues are written by BATCH_SIZE while next pages are fetched: open ones are upserted, closed ones deleted. Full
+    sync then removes issues of the environment it hasn't seen. Returns the latest issue update and whether all the
+    issues have been listed and written
+    """
+    data_table = f"{table_name}_data"
+    synced_at = datetime.utcnow()
+    prefetch = Prefetch(pages)
+    latest_update = None
+    rows, closed_urls = [], []
+    upserted = removed = 0
     try:
-        for tea in gitea_issues:
-            environment = "Gitea"
-            service_name = tea['repository']['name']
-            squad = ""
-            number = tea['number']
-            url = tea['html_url']
-            if "pulls" in url:
-                continue
-            url = tea['html_url']
-            user = tea['user']['full_name']
-            if user == "":
-                user = "proposalbot"
-            else:
-                user = tea['user']['full_name']
-            created_at = datetime.strptime(tea['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-            now = datetime.utcnow()
-            duration = now - created_at
-            duration_days = duration.days
-            comments = tea['comments']
-            if 'assignees' in tea and tea['assignees'] is not None:
-                assignees = ', '.join([assignee['login'] for assignee in tea['assignees']])
-            else:
-                assignees = ''
-            cur.execute(f'INSERT INTO {table_name} ("Environment", "Service Name", "Squad", "Issue Number", '
-                        f'"Issue URL", "Created by", "Created at", "Duration", "Comments", "Assignees") '
-                        f'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
-                        (environment, service_name, squad, number, url, user, created_at, duration_days, comments,
-                         assignees))
+        for page in prefetch:
+            for record in page:
+                if record.updated_at and (latest_update is None or record.updated_at > latest_update):
+                    latest_update = record.updated_at
+                if record.open:
+                    rows.append(record.row + (synced_at,))
+                else:
+                    closed_urls.append((record.row[4],))
+            if len(rows) + len(closed_urls) >= BATCH_SIZE:
+                write_batch(conn, data_table, rows, closed_urls)
+                upserted, removed = upserted + len(rows), removed + len(closed_urls)
+                rows, closed_urls = [], []
+        write_batch(conn, data_table, rows, closed_urls)
+        upserted, removed = upserted + len(rows), removed + len(closed_urls)
+        if full and prefetch.complete:
+            cur = conn.cursor()
+            cur.execute(f'DELETE FROM {data_table} WHERE "Environment" = %s AND "Synced at" < %s;',
+                        (environment, synced_at))
             conn.commit()
+            removed += count_rows_written(cur.rowcount)
     except Exception as e:
-        logging.error("Issues table: an error occurred while posting data to Postgres: %s", e)
+        logging.error("Issues table: an error occurred while posting data to table %s: %s", table_name, e)
         conn.rollback()
-
-    service_pattern = re.compile(rf"(?<={gh_org}/).([^/]+)")
-    for hub in github_issues:
-        if 'pull_request' in hub:
-            continue
-
-        environment = "Github"
-        service_match = None
-        for gh in service_pattern.finditer(hub['url']):
-            service_match = gh
-            break
-        if service_match is not None:
-            service_name = service_match.group(0).strip()
-            squad = ""
-            number = hub['number']
-            url = hub['html_url']
-            user = hub['user']['login']
-            created_at = datetime.strptime(hub['created_at'], '%Y-%m-%dT%H:%M:%SZ')
-            now = datetime.utcnow()
-            duration = now - created_at
-            duration_days = duration.days
-            comments = hub['comments']
-            assignees = ', '.join([assignee['login'] for assignee in hub['assignees']])
-
-            try:
-                cur.execute(f'INSERT INTO {table_name} ("Environment", "Service Name", "Squad", "Issue Number", '
-                            f'"Issue URL", "Created by", "Created at", "Duration", "Comments", "Assignees") '
-                            f'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
-                            (environment, service_name, squad, number, url, user, created_at, duration_days, comments,
-                             assignees))
-                conn.commit()
-            except Exception as e:
-                logging.error("Issues table: an error occurred while posting data to table {table_name}: %s", e)
-                conn.rollback()
+        return latest_update, False
+    finally:
+        prefetch.stop()
+    logging.info("%s issues: %s open upserted, %s closed removed (%s sync)", environment, upserted, removed,
+                 "full" if full else "incremental")
+    return latest_update, prefetch.complete
 
 
 def update_squad_and_title(conn, cur, table_name, rtc):
     logging.info("Updating squads and titles in %s...", table_name)
     try:
-        cur.execute(f"SELECT * FROM {table_name};")
-        open_issues_rows = cur.fetchall()
-
-        for row in open_issues_rows:
-            cur.execute(
-                f"""UPDATE {table_name}
-                    SET "Service Name" = rtc."Title", "Squad" = rtc."Squad"
-                    FROM {rtc} AS rtc
-                    WHERE {table_name}."Service Name" = rtc."Repository"
-                    AND {table_name}.id = %s;""",
-                (row[0],)
-            )
-            cur.execute(
-                f"""UPDATE {table_name}
-                    SET "Squad" = 'Other'
-                    WHERE {table_name}."Service Name" IN ('doc-exports', 'docs_on_docs', 'docsportal')
-                    AND {table_name}.id = %s;""",
-                (row[0],)
-            )
-            conn.commit()
-
+        database.storage.enrich(conn, table_name, rtc)
     except Exception as e:
         logging.error("Error updating squad and title for table %s: %s", table_name, e)
         conn.rollback()
 
 
-def main(org, gh_org, table_name, rtc, token):
-    g = Github(token)
-    github_org = g.get_organization(gh_org)
-    repo_names = [repo.name for repo in github_org.get_repos()]
-    logging.info("%s repos have been processed", len(repo_names))
-
-    gitea_issues = get_gitea_issues(env_vars.gitea_token, org)
-    github_issues = get_github_issues(env_vars.github_token, repo_names, gh_org)
+def main(org, gh_org, table_name, rtc):
     conn_csv = database.connect_to_db(env_vars.db_csv)
-    cur_csv = conn_csv.cursor()
-
-    cur_csv.execute(
-        f'''DROP TABLE IF EXISTS {table_name}'''
-    )
-    conn_csv.commit()
+    create_open_issues_table(conn_csv, table_name)
+
+    sources = [
+        ("Gitea", "gitea_issues", lambda since: get_gitea_issues(env_vars.gitea_token, org, since)),
+        ("Github", "github_issues", lambda since: get_github_issues(gh_org, since)),
+    ]
+    for environment, stage_name, get_issues in sources:
+        with stage(stage_name):  # fetching and writing overlap
+            since, full_sync_at = get_watermark(conn_csv, table_name, environment)
+            started_at = datetime.utcnow()
+            latest_update, complete = sync_issues(conn_csv, table_name, environment, get_issues(since), since is None)
+            if not complete:
+                logging.error("%s issues: listing is incomplete, the sync will be repeated on the next run",
+                              environment)
+                continue
+            save_watermark(conn_csv, table_name, environment, latest_update or since or started_at,
+                           started_at if since is None else full_sync_at)
 
-    create_open_issues_table(conn_csv, cur_csv, table_name)
-    get_issues_table(org, gitea_issues, github_issues, cur_csv, conn_csv, table_name)
-    update_squad_and_title(conn_csv, cur_csv, table_name, rtc)
+    with stage("enrich"):
+        update_squad_and_title(conn_csv, conn_csv.cursor(), f"{table_name}_data", rtc)
     conn_csv.close()
 
 
@@ -240,21 +355,14 @@ def run():
     OPEN_TABLE = "open_issues"
     RTC_TABLE = "repo_title_category"
 
-    done = False
-    try:
-        main(ORG_STRING, GH_ORG_STRING, OPEN_TABLE, RTC_TABLE, env_vars.github_token)
-        main(f"{ORG_STRING}-swiss", f"{GH_ORG_STRING}-swiss", f"{OPEN_TABLE}_swiss", f"{RTC_TABLE}_swiss",
-             env_vars.github_token)
-        done = True
-    except Exception as e:
-        logging.error("An error occurred: %s", e)
-        main(ORG_STRING, GH_ORG_STRING, OPEN_TABLE, RTC_TABLE, env_vars.github_fallback_token)
-        main(f"{ORG_STRING}-swiss", f"{GH_ORG_STRING}-swiss", f"{OPEN_TABLE}_swiss", f"{RTC_TABLE}_swiss",
-             env_vars.github_fallback_token)
-        done = True
-    if done:
-        logging.info("Github operations successfully done!")
+    recorder = RunRecorder("eod_5_open_issues", database, env_vars.db_csv)
+    with recorder.zone("Public"):
+        main(ORG_STRING, GH_ORG_STRING, OPEN_TABLE, RTC_TABLE)
+    with recorder.zone("Hybrid"):
+        main(f"{ORG_STRING}-swiss", f"{GH_ORG_STRING}-swiss", f"{OPEN_TABLE}_swiss", f"{RTC_TABLE}_swiss")
+    logging.info("Github operations successfully done!")
 
+    http_cache.close()
     timer.stop()
 
 
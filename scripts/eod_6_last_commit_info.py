@@ -3,18 +3,38 @@ This script provides logic to retrieve info about last date when document was up
 """
 
 import logging
-import shutil
-import tempfile
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
 
-import psycopg2
-from github import Github
-from github.GithubException import GithubException
+import git
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import (Database, EnvVariables, GitMirrors, HttpCache, RepoInventory, RunRecorder, Timer, TokenPool,
+                    count_rows_written, parse_datetime, setup_logging, stage)
 
 env_vars = EnvVariables()
 database = Database(env_vars)
+token_pool = TokenPool(env_vars.github_tokens)
+http_cache = HttpCache.shared(database, env_vars.db_csv)
+inventory = RepoInventory(database, env_vars, token_pool, http_cache)
+mirrors = GitMirrors(env_vars.github_token)
+
+DOC_TYPES = {"umn/source": "UMN", "api-ref/source": "API", "dev_guide/source": "DEV"}
+ALERT_WINDOW_DAYS = 365
+DOC_COMMITS_TABLE = "doc_commits"
+DOC_COMMITS_COLUMNS = {
+    "Org": "VARCHAR(255)",
+    "Repo": "VARCHAR(255)",
+    "Doc Type": "VARCHAR(255)",
+    "SHA": "VARCHAR(64)",
+    "Committed at": "TIMESTAMP",
+    "Pushed at": "TIMESTAMP"
+}
+
+
+class DocCommit(NamedTuple):
+    sha: Optional[str]  # None when the doc type has no .rst commits
+    committed_at: Optional[datetime]
+    pushed_at: Optional[datetime]  # of the repo when it was scanned
 
 
 def create_commits_table(conn, cur, table_name):
@@ -32,100 +52,109 @@ def create_commits_table(conn, cur, table_name):
         )
         conn.commit()
         logging.info("Table %s has been created successfully", table_name)
-    except psycopg2.Error as e:
+    except database.storage.Error as e:
         logging.error("Tables creating: an error occurred while trying to create a table %s in the database: %s",
                       table_name, e)
 
 
-def get_last_commit_url(github_repo, path):
-    logging.debug("%s", path)
-    commits = github_repo.get_commits(path=path)
-    # logging.debug(f"GITHUB REPO---------------------------------- {github_repo}")
-    for commit in commits:
-        # logging.debug(f"COMMIT--------------------------------------- {commit}")
-        files_changed = commit.files
-        if any(file.filename.endswith('.rst') for file in files_changed):
-            # logging.debug(f"COMMIT URL AND DATE---------------------------- {commit.html_url} "
-            #               f"{commit.commit.author.date}")
-            return commit.html_url, commit.commit.author.date  # Return the commit URL and its date
-    return None, None
-
-
-def get_last_commit(org, conn, cur, doctype, string, table_name, rtc):
-    logging.info("Gathering last commit info for %s...", string)
-
+def get_public_repos(gorg, cur, rtc):
     try:
         cur.execute(f"SELECT DISTINCT \"Repository\" FROM {rtc} WHERE \"Env\" NOT IN ('public');")
-        exclude_repos = [row[0] for row in cur.fetchall()]
+        exclude_repos = {row[0] for row in cur.fetchall()}
     except Exception as e:
         logging.error("Fetching public repos: %s", e)
-        return
+        return []
 
-    for repo in org.get_repos():
-        if repo.name in exclude_repos:
+    public_repos = []
+    for repo_info in inventory.github_repos(gorg):
+        if repo_info.name in exclude_repos:
             continue
+        if repo_info.empty:
+            logging.warning("Empty repo, skipping: %s", repo_info.name)
+            continue
+        public_repos.append(repo_info)
+    return public_repos
 
-        tmp_dir = tempfile.mkdtemp()
-
-        try:
-            path = doctype
-            last_commit_url, last_commit_date = get_last_commit_url(repo, path)
-            if not last_commit_url or not last_commit_date:
-                logging.info("No commits found for %s, skipping.", repo.name)
-                continue
-
-            formatted_commit_date = last_commit_date.strftime('%Y-%m-%d')
-            now = datetime.utcnow()
-            duration_days = (now - last_commit_date).days
 
-            doc_type = "UMN" if doctype == "umn/source" else "API"
-            service_name = repo.name
+def load_doc_commits(conn, gorg):
+    rows = database.storage.query(
+        conn, f'SELECT "Repo", "Doc Type", "SHA", "Committed at", "Pushed at" FROM {DOC_COMMITS_TABLE} '
+              f'WHERE "Org" = %s;', (gorg,)
+    )
+    return {(row[0], row[1]): DocCommit(row[2], parse_datetime(row[3]), parse_datetime(row[4])) for row in rows}
 
-            cur.execute(
-                f'INSERT INTO {table_name} ("Service Name", "Doc Type", "Last commit at", "Days passed", "Commit URL") '
-                f'VALUES (%s, %s, %s, %s, %s);',
-                (service_name, doc_type, formatted_commit_date, duration_days, last_commit_url)
-            )
 
-            conn.commit()
+def is_unchanged(repo_info, doc_commits):
+    """Nothing was pushed to the repo since all of its doc types were scanned"""
+    return repo_info.pushed_at is not None and all(
+        commit is not None and commit.pushed_at is not None and commit.pushed_at >= repo_info.pushed_at
+        for commit in doc_commits.values()
+    )
 
-        except GithubException as e:
-            if e.status == 409:
-                logging.warning("Empty repo, skipping: %s", repo.name)
-            else:
-                logging.error("Last commit: an error occurred while processing repo %s: %s", repo.name, str(e))
 
-        except Exception as e:
-            logging.error("Unexpected error processing repo %s: %s", repo.name, str(e))
+def scan_repo(gorg, repo_info, doc_commits):
+    """
+    Latest .rst commit of every doc type, scanning history of the alert window only: when there is none in it, the
+    stored commit is still the latest one. Doc types never scanned before are looked up in the whole history
+    """
+    branch = repo_info.default_branch or "main"
+    repo = mirrors.sync(gorg, repo_info.name, branch)
+    since = datetime.utcnow() - timedelta(days=ALERT_WINDOW_DAYS)
+    scanned = {}
+    for path, doc_type in DOC_TYPES.items():
+        sha, committed_at = mirrors.last_commit(repo, branch, path, since=since)
+        if sha is None and doc_commits[doc_type] is not None:
+            sha, committed_at = doc_commits[doc_type].sha, doc_commits[doc_type].committed_at
+        elif sha is None:
+            sha, committed_at = mirrors.last_commit(repo, branch, path)
+        scanned[doc_type] = DocCommit(sha, committed_at, repo_info.pushed_at)
+    return scanned
+
+
+def get_last_commits(gorg, conn, cur, string, table_name, rtc):
+    """One pass over public repos of the org resolving all DOC_TYPES, repos not pushed since last scan are skipped"""
+    logging.info("Gathering last commit info for %s...", string)
+    stored = load_doc_commits(conn, gorg)
+    now = datetime.utcnow()
+    state_rows = []
+    table_rows = []
+    skipped = 0
+    for repo_info in get_public_repos(gorg, cur, rtc):
+        name = repo_info.name
+        doc_commits = {doc_type: stored.get((name, doc_type)) for doc_type in DOC_TYPES.values()}
+        if is_unchanged(repo_info, doc_commits):
+            skipped += 1
+        else:
+            try:
+                doc_commits = scan_repo(gorg, repo_info, doc_commits)
+                state_rows += [(gorg, name, doc_type) + tuple(commit) for doc_type, commit in doc_commits.items()]
+            except git.GitCommandError as e:
+                logging.error("Last commit: an error occurred while processing repo %s: %s", name, str(e))
+            except Exception as e:  # one broken repo must not stop the whole org
+                logging.error("Last commit: unexpected error while processing repo %s: %s", name, e)
+
+        for doc_type, commit in doc_commits.items():
+            if commit is None or not commit.sha:
+                continue
+            table_rows.append((name, doc_type, commit.committed_at.strftime('%Y-%m-%d'),
+                               (now - commit.committed_at).days, mirrors.commit_url(gorg, name, commit.sha)))
+    logging.info("%s repos have been scanned, %s unchanged ones skipped", len(state_rows) // len(DOC_TYPES), skipped)
 
-        finally:
-            shutil.rmtree(tmp_dir)
+    try:
+        database.storage.upsert(conn, DOC_COMMITS_TABLE, list(DOC_COMMITS_COLUMNS), state_rows,
+                                ["Org", "Repo", "Doc Type"])
+        count_rows_written(database.storage.bulk_insert(
+            conn, table_name, ["Service Name", "Doc Type", "Last commit at", "Days passed", "Commit URL"], table_rows
+        ))
+    except Exception as e:
+        logging.error("Last commit: an error occurred while posting data to table %s: %s", table_name, e)
+        conn.rollback()
 
 
 def update_squad_and_title(conn, cur, table_name, rtc):
     logging.info("Updating squads and titles...")
     try:
-        cur.execute(f"SELECT * FROM {table_name};")
-        open_issues_rows = cur.fetchall()
-
-        for row in open_issues_rows:
-            cur.execute(
-                f"""UPDATE {table_name}
-                    SET "Service Name" = rtc."Title", "Squad" = rtc."Squad"
-                    FROM {rtc} AS rtc
-                    WHERE {table_name}."Service Name" = rtc."Repository"
-                    AND {table_name}.id = %s;""",
-                (row[0],)
-            )
-            cur.execute(
-                f"""UPDATE {table_name}
-                    SET "Squad" = 'Other'
-                    WHERE {table_name}."Service Name" IN ('doc-exports', 'docs_on_docs', 'docsportal')
-                    AND {table_name}.id = %s;""",
-                (row[0],)
-            )
-            conn.commit()
-
+        database.storage.enrich(conn, table_name, rtc)
     except Exception as e:
         logging.error("Error updating squad and title: %s", e)
         conn.rollback()
@@ -139,19 +168,17 @@ def delete_non_public_repos(conn, cur, table_name):
     conn.commit()
 
 
-def main(gorg, table_name, rtc, gh_str, token):
-    g = Github(token)
-    org = g.get_organization(gorg)
+def main(gorg, table_name, rtc, gh_str):
     conn_csv = database.connect_to_db(env_vars.db_csv)
     cur_csv = conn_csv.cursor()
     cur_csv.execute(f"DROP TABLE IF EXISTS {table_name}")
     create_commits_table(conn_csv, cur_csv, table_name)
-    logging.info("Searching for a most recent commit in umn/source...")
-    get_last_commit(org, conn_csv, cur_csv, "umn/source", gh_str, table_name, rtc)
-    logging.info("Searching for a most recent commit in api-ref/source...")
-    get_last_commit(org, conn_csv, cur_csv, "api-ref/source", gh_str, table_name, rtc)
-    update_squad_and_title(conn_csv, cur_csv, table_name, rtc)
-    delete_non_public_repos(conn_csv, cur_csv, table_name)
+    database.storage.create_table(conn_csv, DOC_COMMITS_TABLE, DOC_COMMITS_COLUMNS, unique=["Org", "Repo", "Doc Type"])
+    with stage("scan"):
+        get_last_commits(gorg, conn_csv, cur_csv, gh_str, table_name, rtc)
+    with stage("enrich"):
+        update_squad_and_title(conn_csv, cur_csv, table_name, rtc)
+        delete_non_public_repos(conn_csv, cur_csv, table_name)
     conn_csv.commit()
 
 
@@ -166,22 +193,14 @@ def run():
     COMMIT_TABLE = "last_update_commit"
     RTC_TABLE = "repo_title_category"
 
-    done = False
-    try:
-        main(GH_ORG_STR, COMMIT_TABLE, RTC_TABLE, GH_ORG_STR, env_vars.github_token)
-        main(f"{GH_ORG_STR}-swiss", f"{COMMIT_TABLE}_swiss", f"{RTC_TABLE}_swiss", f"{GH_ORG_STR}"
-                                                                                   f"-swiss", env_vars.github_token)
-        done = True
-    except Exception as e:
-        logging.info("Error has been occurred: %s", e)
-        main(GH_ORG_STR, COMMIT_TABLE, RTC_TABLE, GH_ORG_STR, env_vars.github_fallback_token)
-        main(f"{GH_ORG_STR}-swiss", f"{COMMIT_TABLE}_swiss", f"{RTC_TABLE}_swiss", f"{GH_ORG_STR}"
-                                                                                   f"-swiss", env_vars.
-             github_fallback_token)
-        done = True
-    if done:
-        logging.info("Github operations successfully done!")
+    recorder = RunRecorder("eod_6_last_commit_info", database, env_vars.db_csv)
+    with recorder.zone("Public"):
+        main(GH_ORG_STR, COMMIT_TABLE, RTC_TABLE, GH_ORG_STR)
+    with recorder.zone("Hybrid"):
+        main(f"{GH_ORG_STR}-swiss", f"{COMMIT_TABLE}_swiss", f"{RTC_TABLE}_swiss", f"{GH_ORG_STR}-swiss")
+    logging.info("Github operations successfully done!")
 
+    http_cache.close()
     timer.stop()
 
 
@@ -3,13 +3,12 @@ import logging
 import re
 from datetime import datetime
 
-import psycopg2
 import requests
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import Database, EnvVariables, RunRecorder, Timer, count_rows_written, create_session, setup_logging, stage
 
 gitea_api_endpoint = "https://gitea.eco.tsi-dev.otc-service.com/api/v1"
-session = requests.Session()
+session = create_session()
 
 env_vars = EnvVariables()
 database = Database(env_vars)
@@ -31,7 +30,7 @@ def create_prs_table(conn, cur, table_name):
         )
         conn.commit()
         logging.info("Table %s has been created successfully", table_name)
-    except psycopg2.Error as e:
+    except database.storage.Error as e:
         logging.error("Tables creating: an error occurred while trying to create a table %s in the database: %s",
                       table_name, e)
 
@@ -173,6 +172,7 @@ def insert_data_postgres(org, repo, pr_number, conn, cur, activity_date, changes
         VALUES (%s, %s, %s, %s, %s, %s, %s);
         """, (pr_number, repo, '', pr_url, days_since_last_activity, reviewer_name, 'No changes requested'))
     conn.commit()
+    count_rows_written(cur.rowcount)
 
 
 def parent_pr_changes_check(cur, conn, org, changes_tab):
@@ -238,7 +238,7 @@ def parent_pr_changes_check(cur, conn, org, changes_tab):
                     """, (pr_number, repo))
                     conn.commit()
                     logging.info("Updated PR %s in %s to CHANGES REQUESTED.", pr_number, repo)
-                except psycopg2.Error as e:
+                except database.storage.Error as e:
                     logging.error("Error updating database: %s", e)
 
 
@@ -259,25 +259,12 @@ def extract_number_from_body(text):
 def update_squad_and_title(cur, conn, rtc, changes_tab):
     logging.info("Updating squads and titles...")
     try:
-        cur.execute(f"SELECT * FROM {changes_tab};")
-        open_issues_rows = cur.fetchall()
-
-        for row in open_issues_rows:
-            cur.execute(
-                f"""UPDATE {changes_tab}
-                    SET "Service Name" = rtc."Title", "Squad" = rtc."Squad"
-                    FROM {rtc} AS rtc
-                    WHERE {changes_tab}."Service Name" = rtc."Repository"
-                    AND {changes_tab}.id = %s;""",
-                (row[0],)
-            )
-            cur.execute(
-                f"""UPDATE {changes_tab}
-                    SET "Parent PR Status" = 'CHANGES REQUESTED'
-                    WHERE {changes_tab}."Service Name" IN ('doc-exports', 'docs_on_docs', 'docsportal')
-                    AND {changes_tab}.id = %s;""",
-                (row[0],)
-            )
+        database.storage.enrich(conn, changes_tab, rtc, other_repos=None)
+        cur.execute(
+            f"""UPDATE {changes_tab}
+                SET "Parent PR Status" = 'CHANGES REQUESTED'
+                WHERE {changes_tab}."Service Name" IN ('doc-exports', 'docs_on_docs', 'docsportal');"""
+        )
         conn.commit()
 
     except Exception as e:
@@ -294,17 +281,20 @@ def main(org, rtc, changes_tab):
 
     repos = get_repos(cur_csv, rtc)
 
-    logging.info("Gathering PRs where changes has been requested...")
+    with stage("reviews"):
+        logging.info("Gathering PRs where changes has been requested...")
 
-    for repo in repos:
-        prs = get_pr_number(org, repo)
-        for pr_info in prs:
-            pr_number = pr_info['pr_number']
-            process_pr_reviews(org, repo, pr_number, changes_tab, conn_csv, cur_csv)
+        for repo in repos:
+            prs = get_pr_number(org, repo)
+            for pr_info in prs:
+                pr_number = pr_info['pr_number']
+                process_pr_reviews(org, repo, pr_number, changes_tab, conn_csv, cur_csv)
 
-    parent_pr_changes_check(cur_csv, conn_csv, org, changes_tab)
-    parent_pr_changes_check(cur_csv, conn_csv, org, "our_side_problem")
-    update_squad_and_title(cur_csv, conn_csv, rtc, changes_tab)
+    with stage("parent_prs"):
+        parent_pr_changes_check(cur_csv, conn_csv, org, changes_tab)
+        parent_pr_changes_check(cur_csv, conn_csv, org, "our_side_problem")
+    with stage("enrich"):
+        update_squad_and_title(cur_csv, conn_csv, rtc, changes_tab)
 
 
 def run():
@@ -328,8 +318,11 @@ def run():
 
     conn_csv.commit()
 
-    main(org_string, rtc_table, changes_table)
-    main(f"{org_string}-swiss", f"{rtc_table}_swiss", f"{changes_table}_swiss")
+    recorder = RunRecorder("eod_7_request_changes", database, env_vars.db_csv)
+    with recorder.zone("Public"):
+        main(org_string, rtc_table, changes_table)
+    with recorder.zone("Hybrid"):
+        main(f"{org_string}-swiss", f"{rtc_table}_swiss", f"{changes_table}_swiss")
 
     update_squad_and_title(cur_csv, conn_csv, rtc_table, "our_side_problem")
 
@@ -5,16 +5,15 @@ This script gathers info about github issues in infra repos, for ecosystem squad
 import logging
 from datetime import datetime, timedelta
 
-import psycopg2
-from github import Github
-
-from config import Database, EnvVariables, Timer, setup_logging
+from config import (Database, EnvVariables, HttpCache, RepoInventory, RunRecorder, Timer, TokenPool, count_rows_written,
+                    create_github, setup_logging, stage)
 
 env_vars = EnvVariables()
 database = Database(env_vars)
 
-github_token = env_vars.github_token
-github_fallback_token = env_vars.github_fallback_token
+token_pool = TokenPool(env_vars.github_tokens)
+http_cache = HttpCache.shared(database, env_vars.db_csv)
+inventory = RepoInventory(database, env_vars, token_pool, http_cache)
 
 
 def create_open_issues_table(conn, cur, table_name):
@@ -34,7 +33,7 @@ def create_open_issues_table(conn, cur, table_name):
         )
         conn.commit()
         logging.info("Table %s has been created successfully", table_name)
-    except psycopg2.Error as e:
+    except database.storage.Error as e:
         logging.error("Tables creating: an error occurred while trying to create a table %s in the database \
                         %s: %s", table_name, env_vars.db_csv, e)
 
@@ -60,25 +59,28 @@ def insert_issue_data(conn, cur, table_name, repo, issue):
             )
         )
         conn.commit()
-    except psycopg2.Error as e:
+        count_rows_written(cur.rowcount)
+    except database.storage.Error as e:
         logging.error("Error inserting issue data: %s", e)
         conn.rollback()
 
 
-def gather_issues(ghorg, conn, cur, table_name):
+def gather_issues(g, gorg, conn, cur, table_name):
     logging.info("Gathering issues info...")
     one_year_ago = datetime.now() - timedelta(days=365)
-    for repo in ghorg.get_repos():
-        if repo.archived or repo.pushed_at < one_year_ago:
+    for repo_info in inventory.github_repos(gorg):
+        if repo_info.archived or repo_info.pushed_at < one_year_ago:
+            continue
+        if repo_info.open_issues == 0:  # counter includes PRs, so zero means there are no issues for sure
             continue
+        repo = g.get_repo(f"{gorg}/{repo_info.name}", lazy=True)
         issues = repo.get_issues(state="open")
         for issue in issues:
-            insert_issue_data(conn, cur, table_name, repo, issue)
+            insert_issue_data(conn, cur, table_name, repo_info, issue)
 
 
-def main(gorg, table_name, token):
-    g = Github(token)
-    ghorg = g.get_organization(gorg)
+def main(gorg, table_name):
+    g = create_github(token_pool, http_cache)
     conn = database.connect_to_db(env_vars.db_csv)
     cur = conn.cursor()
 
@@ -86,7 +88,8 @@ def main(gorg, table_name, token):
     conn.commit()
 
     create_open_issues_table(conn, cur, table_name)
-    gather_issues(ghorg, conn, cur, table_name)
+    with stage("issues"):
+        gather_issues(g, gorg, conn, cur, table_name)
 
     cur.close()
     conn.close()
@@ -102,17 +105,12 @@ def run():
     GH_ORG_STR = "opentelekomcloud"
     ISSUES_TABLE = "open_issues_eco"
 
-    DONE = False
-    try:
-        main(GH_ORG_STR, ISSUES_TABLE, github_token)
-        DONE = True
-    except Exception as e:
-        logging.error("Error has been occurred: %s", e)
-        main(GH_ORG_STR, ISSUES_TABLE, github_fallback_token)
-        DONE = True
-    if DONE:
-        logging.info("Github operations successfully done!")
+    recorder = RunRecorder("eod_8_ecosystem_issues", database, env_vars.db_csv)
+    with recorder.zone("Ecosystem"):
+        main(GH_ORG_STR, ISSUES_TABLE)
+    logging.info("Github operations successfully done!")
 
+    http_cache.close()
     timer.stop()
 
 
@@ -8,9 +8,8 @@ from datetime import datetime
 from urllib.parse import quote
 
 import zulip
-from psycopg2.extras import DictCursor
 
-from config import Database, EnvVariables, Timer, setup_logging
+from config import Database, EnvVariables, RunRecorder, Timer, setup_logging
 
 env_vars = EnvVariables()
 database = Database(env_vars)
@@ -56,17 +55,17 @@ def check_rate_limit():
 
 def check_orphans(conn_orph, squad_name, stream_name, topic_name):
     results = []
-    cur_orph = conn_orph.cursor(cursor_factory=DictCursor)
+    cur_orph = database.storage.dict_cursor(conn_orph)
     tables = ["open_prs", "open_prs_swiss"]
     for table in tables:
         if table == "open_prs":
             logging.info("Looking for orphaned PRs for %s in %s...", squad_name, table)
-            query = f"""SELECT *, 'Public' as zone, 'orphan' as type FROM {table} WHERE "Squad" = '{squad_name}';"""
+            query = f"""SELECT *, 'Public' as zone, 'orphan' as type FROM {table} WHERE "Squad" = %s;"""
             cur_orph.execute(query, (squad_name,))
             results = cur_orph.fetchall()
         elif table == "open_prs_swiss":
             logging.info("Looking for orphaned PRs for %s in %s...", squad_name, table)
-            query = f"""SELECT *, 'Hybrid' as zone, 'orphan' as type FROM {table} WHERE "Squad" = '{squad_name}';"""
+            query = f"""SELECT *, 'Hybrid' as zone, 'orphan' as type FROM {table} WHERE "Squad" = %s;"""
             cur_orph.execute(query, (squad_name,))
             results = cur_orph.fetchall()
         if results:
@@ -76,18 +75,18 @@ def check_orphans(conn_orph, squad_name, stream_name, topic_name):
 
 def check_open_issues(conn, squad_name, stream_name, topic_name):
     results = []
-    cur = conn.cursor(cursor_factory=DictCursor)
+    cur = database.storage.dict_cursor(conn)
     tables = ["open_issues", "open_issues_swiss"]
     for table in tables:
         if table == "open_issues":
             logging.info("Checking %s for %s", table, squad_name)
-            query = f"""SELECT *, 'Public' as zone, 'issue' as type FROM {table} WHERE "Squad" = '{squad_name}' AND
+            query = f"""SELECT *, 'Public' as zone, 'issue' as type FROM {table} WHERE "Squad" = %s AND
              "Environment" = 'Github' AND "Assignees" = '' AND "Duration" > '7' ;"""
             cur.execute(query, (squad_name,))
             results = cur.fetchall()
         elif table == "open_issues_swiss":
             logging.info("Checking %s for %s", table, squad_name)
-            query = f"""SELECT *, 'Hybrid' as zone, 'issue' as type FROM {table} WHERE "Squad" = '{squad_name}' AND
+            query = f"""SELECT *, 'Hybrid' as zone, 'issue' as type FROM {table} WHERE "Squad" = %s AND
              "Environment" = 'Github' AND "Assignees" = '' AND "Duration" > '7' ;"""
             cur.execute(query, (squad_name,))
             results = cur.fetchall()
@@ -98,7 +97,7 @@ def check_open_issues(conn, squad_name, stream_name, topic_name):
 
 def check_outdated_docs(conn, squad_name, stream_name, topic_name):
     results = []
-    cur = conn.cursor(cursor_factory=DictCursor)
+    cur = database.storage.dict_cursor(conn)
     tables = ["last_update_commit", "last_update_commit_swiss"]
     for table in tables:
         if table == "last_update_commit":
@@ -118,7 +117,7 @@ def check_outdated_docs(conn, squad_name, stream_name, topic_name):
 
 def check_labels_comments(conn, squad_name, stream_name, topic_name):
     results = []
-    cur = conn.cursor(cursor_factory=DictCursor)
+    cur = database.storage.dict_cursor(conn)
     tables = ["huawei_label", "huawei_label_swiss"]
     for table in tables:
         if table == "huawei_label":
@@ -143,7 +142,7 @@ def check_labels_comments(conn, squad_name, stream_name, topic_name):
 
 
 def check_rst(conn, squad_name, stream_name, topic_name):
-    cur = conn.cursor(cursor_factory=DictCursor)
+    cur = database.storage.dict_cursor(conn)
     tables = ["huawei_to_otc", "huawei_to_otc_swiss"]
 
     for table in tables:
@@ -172,7 +171,7 @@ def check_rst(conn, squad_name, stream_name, topic_name):
 
 
 def check_files_lines(conn, squad_name, stream_name, topic_name):
-    cur = conn.cursor(cursor_factory=DictCursor)
+    cur = database.storage.dict_cursor(conn)
     tables = [
         ("huawei_files_lines", "Public"),
         ("huawei_files_lines_swiss", "Hybrid")
@@ -341,7 +340,8 @@ def run():
     timer.start()
     setup_logging()
     logging.info("-------------------------SCHEDULER IS RUNNING-------------------------")
-    main()
+    with RunRecorder("eod_9_scheduler", database, env_vars.db_csv).zone("All"):
+        main()
     timer.stop()
 
 
@@ -0,0 +1,11 @@
+"""
+Environment shared by Eyes-on-Docs tests
+"""
+
+import os
+
+# Collectors build EnvVariables at import time, so the tests need placeholder values to import them
+for _var in ("DB_HOST", "DB_PORT", "DB_CSV", "DB_USER", "DB_ORPH", "DB_ZUUL", "DB_PASSWORD", "GITEA_TOKEN",
+             "GITHUB_TOKEN", "GITHUB_FALLBACK_TOKEN"):
+    os.environ.setdefault(_var, "test")
+os.environ.setdefault("EOD_STORAGE", "sqlite")
@@ -0,0 +1,48 @@
+"""
+Local stand-ins of external services the collectors talk to
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class ZuulStandIn:
+    """Local stand-in of Zuul buildsets API of a tenant, serves preset buildsets by skip/limit and records requests"""
+
+    def __init__(self, buildsets, tenant="eco"):
+        self.buildsets = buildsets
+        self.tenant = tenant
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                stand_in.requests.append(self.path)
+                if url.path != f"/api/tenant/{stand_in.tenant}/buildsets":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                skip, limit = int(query.get("skip", ["0"])[0]), int(query.get("limit", ["50"])[0])
+                body = json.dumps(stand_in.buildsets[skip:skip + limit]).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
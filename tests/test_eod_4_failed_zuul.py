@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from scripts import eod_4_failed_zuul
+from tests.stand_ins import ZuulStandIn
+
+
+@pytest.fixture
+def zuul(monkeypatch):
+    def start(buildsets):
+        stand_in = ZuulStandIn(buildsets)
+        monkeypatch.setattr(eod_4_failed_zuul.env_vars, "zuul_url", stand_in.url)
+        monkeypatch.setattr(eod_4_failed_zuul.env_vars, "zuul_tenant", stand_in.tenant)
+        eod_4_failed_zuul.tenant_buildsets.clear()
+        return stand_in
+    yield start
+    eod_4_failed_zuul.tenant_buildsets.clear()
+
+
+def test_zuul_statuses(zuul):
+    now = datetime.utcnow()
+
+    def buildset(uuid, project, result, minutes_ago, patchset="sha-1"):
+        return {"uuid": uuid, "project": project, "change": "1", "patchset": patchset, "result": result,
+                "event_timestamp": (now - timedelta(minutes=minutes_ago)).isoformat()}
+
+    with zuul([
+        buildset("dequeued", "docs/ecs", "DEQUEUED", 1),  # superseded by a recheck, ignored
+        buildset("failed", "docs/ecs", "POST_FAILURE", 2),
+        buildset("canceled", "docs/obs", "CANCELED", 3),
+        buildset("passed", "docs/evs", "SUCCESS", 4),
+        buildset("swiss", "docs-swiss/ecs", "TIMED_OUT", 5),
+        buildset("expired", "docs/rds", "FAILURE", (eod_4_failed_zuul.ZUUL_DAYS + 1) * 24 * 60),
+    ]) as stand_in:
+        docs = eod_4_failed_zuul.get_zuul_buildsets("docs")
+        swiss = eod_4_failed_zuul.get_zuul_buildsets("docs-swiss")
+
+    # Tenant is crawled once for both zones
+    assert len(stand_in.requests) == 1
+    assert set(docs) == {("ecs", 1, "sha-1"), ("evs", 1, "sha-1")}
+    assert set(swiss) == {("ecs", 1, "sha-1")}
+    zuul_url, status, _, days_passed = eod_4_failed_zuul.get_zuul_status(docs[("ecs", 1, "sha-1")])
+    assert zuul_url.endswith("/t/eco/buildset/failed") and status == "failure" and days_passed == 0
+    assert eod_4_failed_zuul.get_zuul_status(docs[("evs", 1, "sha-1")]) == (None, None, None, None)
+    assert eod_4_failed_zuul.get_zuul_status({"result": "CANCELED"}) == (None, None, None, None)